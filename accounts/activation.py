@@ -1,9 +1,10 @@
 from django.core import signing
 from django.utils import timezone
 from django.conf import settings
-from django.core.mail import send_mail
 from django.urls import reverse
 
+from .outbox import enqueue_email
+
 DEFAULT_TIMEOUT = getattr(settings, 'ACCOUNT_ACTIVATION_TIMEOUT', 60*60*24)  # 24h
 SIGNER = signing.TimestampSigner()
 
@@ -25,7 +26,8 @@ def validate_activation_token(token):
         return None
 
 
-def send_activation_mail(request, user, token):
+def enqueue_activation_mail(request, user, token):
+    """有効化メールを送信待ちに積む（送信は send_outbox_emails が行う）"""
     # Heroku環境での正しいURL生成
     if hasattr(settings, 'MY_URL') and settings.MY_URL:
         base_url = settings.MY_URL.rstrip('/')
@@ -43,4 +45,4 @@ def send_activation_mail(request, user, token):
         "心当たりがない場合は本メールを破棄してください。\n"
         "NagoyaMeshi サポート"
     )
-    send_mail(subject, body, getattr(settings, 'DEFAULT_FROM_EMAIL', None), [user.email])
+    return enqueue_email(subject, body, [user.email])
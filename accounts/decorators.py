@@ -2,8 +2,8 @@ from functools import wraps
 from django.shortcuts import redirect
 from django.http import JsonResponse
 from django.urls import reverse
-from .models import Subscription
-from .utils import sync_subscription_from_stripe
+from .idempotency import MAX_KEY_LENGTH, KeyReused, key_from_request, run_once
+from .entitlements import get_subscription, has_entitlement
 
 
 def subscription_required(view_func):
@@ -11,7 +11,7 @@ def subscription_required(view_func):
     - 未契約/無効の場合:
       - 通常リクエスト: マイページ(サブスク管理)へリダイレクト
       - AJAXリクエスト: 200 JSON を返し、redirect_url を通知（ネットワークエラー回避）
-    実行直前にStripeと同期して最新状態を反映。
+    判定はローカルの Subscription 行で行い、同期から一定時間が経っている場合だけ Stripe と同期する（entitlements.py）。
     """
     @wraps(view_func)
     def _wrapped(request, *args, **kwargs):
@@ -29,15 +29,9 @@ def subscription_required(view_func):
                 }, status=200)
             return redirect('accounts:login')
 
-        # 実行前に同期して最新化
-        try:
-            sync_subscription_from_stripe(request.user)
-        except Exception:
-            pass
-
-        try:
-            subscription = request.user.subscription
-        except Subscription.DoesNotExist:
+        # ローカルの行で判定（古ければ同期してから）
+        subscription = get_subscription(request.user)
+        if subscription is None:
             if is_ajax(request):
                 return JsonResponse({
                     'success': False,
@@ -46,8 +40,7 @@ def subscription_required(view_func):
                 }, status=200)
             return redirect(redirect_url)
 
-        has_valid_stripe_subscription = bool(getattr(subscription, 'stripe_subscription_id', None))
-        if not (getattr(subscription, 'is_active', False) and has_valid_stripe_subscription):
+        if not has_entitlement(subscription):
             if is_ajax(request):
                 return JsonResponse({
                     'success': False,
@@ -59,3 +52,28 @@ def subscription_required(view_func):
         return view_func(request, *args, **kwargs)
 
     return _wrapped
+
+
+def idempotent(view_func):
+    """Idempotency-Key 付きの更新リクエストを1回だけ処理するデコレータ。
+    - キーが無ければ従来どおり処理する
+    - 同じキーの再送には最初の応答をそのまま返す（別のワーカーで受けても同じ）
+    - 同じキーで内容が違う場合は 422
+    ログイン必須のビューに付け、認証・会員チェックのデコレータより内側に置く。
+    """
+    @wraps(view_func)
+    def _wrapped(request, *args, **kwargs):
+        key = key_from_request(request)
+        if not key or not request.user.is_authenticated:
+            return view_func(request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return JsonResponse({'success': False, 'message': 'Idempotency-Key が長すぎます。'}, status=400)
+        try:
+            return run_once(request, key, lambda req: view_func(req, *args, **kwargs))
+        except KeyReused:
+            return JsonResponse({
+                'success': False,
+                'message': '同じ Idempotency-Key で異なる内容のリクエストが送信されました。',
+            }, status=422)
+
+    return _wrapped
@@ -2,6 +2,8 @@ from django.core.mail import send_mail
 from django.conf import settings
 from django.utils import timezone
 
+from .outbox import enqueue_email
+
 
 def send_safe_mail(subject: str, body: str, to_list: list[str], fail_silently: bool = True) -> bool:
     """Wrap send_mail with exception handling.
@@ -34,9 +36,7 @@ def build_reservation_mail(user, shop, reserve_date, people: int) -> tuple[str,
     return subject, body
 
 
-def send_reservation_mail(user, shop, reserve_date, people: int) -> bool:
-    try:
-        subject, body = build_reservation_mail(user, shop, reserve_date, people)
-        return send_safe_mail(subject, body, [user.email])
-    except Exception:
-        return False
+def enqueue_reservation_mail(user, shop, reserve_date, people: int):
+    """予約確認メールを送信待ちに積む（予約の作成と同じトランザクション内で呼ぶ）"""
+    subject, body = build_reservation_mail(user, shop, reserve_date, people)
+    return enqueue_email(subject, body, [user.email])
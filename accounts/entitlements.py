@@ -0,0 +1,77 @@
+"""
+サブスクリプション会員の利用資格(entitlement)
+- 判定はローカルの Subscription 行（is_active / end_date / stripe_subscription_id）で行う
+- Stripe と同期するのは last_synced_at が ENTITLEMENT_FRESHNESS_SECONDS（既定15分）より古いときだけ
+  （Webhook を受けたら last_synced_at を None に戻し、次の判定で同期する）
+- 同期せずに判定できた件数/同期した件数はワーカーごとに数える（ops_status）
+"""
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Subscription
+from .stripe_gateway import get_gateway
+from .utils import sync_subscription_from_stripe
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'refreshes': 0, 'no_subscription': 0}
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def entitlement_cache_stats():
+    """このワーカーでの利用状況（hits: ローカルの行で判定 / refreshes: Stripe と同期）"""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['refreshes']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else None
+    return stats
+
+
+def freshness():
+    return timedelta(seconds=getattr(settings, 'ENTITLEMENT_FRESHNESS_SECONDS', 60 * 15))
+
+
+def is_stale(subscription, now=None):
+    now = now or timezone.now()
+    return subscription.last_synced_at is None or subscription.last_synced_at < now - freshness()
+
+
+def get_subscription(user, refresh=True):
+    """ユーザーの Subscription を返す（無ければ None）。古ければ先に Stripe と同期する"""
+    try:
+        subscription = user.subscription
+    except Subscription.DoesNotExist:
+        _count('no_subscription')
+        return None
+    if refresh and subscription.stripe_subscription_id and is_stale(subscription):
+        _count('refreshes')
+        # 同期は user.subscription をその場で更新する（失敗時は従来どおりローカルの値を使う）
+        sync_subscription_from_stripe(user)
+    else:
+        _count('hits')
+    return subscription
+
+
+def has_entitlement(subscription, today=None):
+    """有効なStripe契約があり、終了日を過ぎていないこと"""
+    if not subscription or not subscription.is_active or not subscription.stripe_subscription_id:
+        return False
+    today = today or timezone.localdate()
+    return not (subscription.end_date and subscription.end_date < today)
+
+
+def invalidate_entitlement(**filters):
+    """次の判定で Stripe と同期させる（Webhook 受信時など）。キャッシュ済みの Stripe のサブスクリプションも捨てる"""
+    if not any(filters.values()):
+        return 0
+    subscriptions = Subscription.objects.filter(**filters)
+    gateway = get_gateway()
+    for subscription_id in subscriptions.values_list('stripe_subscription_id', flat=True):
+        gateway.forget('subscription', subscription_id)
+    return subscriptions.update(last_synced_at=None)
@@ -0,0 +1,87 @@
+"""
+更新系リクエストの冪等キー(idempotency_keys)
+- クライアントは Idempotency-Key ヘッダー（またはフォームの idempotency_key）で操作ごとのキーを送る
+- キーの登録と view の処理は同じトランザクションで行う。同じキーの同時リクエストは一意制約で待たされ、
+  先の処理がコミットされた後に保存済みの応答を返す（処理は1回だけ）
+- 5xx の応答は保存せず、処理ごとロールバックする（同じキーで再試行できる）
+- 保存期間は IDEMPOTENCY_KEY_TTL_HOURS（既定24時間）。古い行は purge_idempotency_keys で消す
+"""
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils import timezone
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+FIELD = 'idempotency_key'
+MAX_KEY_LENGTH = 64
+IGNORED_FIELDS = {'csrfmiddlewaretoken', FIELD}
+
+
+class KeyReused(Exception):
+    """同じキーで内容の異なるリクエストが送られた"""
+
+
+def ttl():
+    return timedelta(hours=getattr(settings, 'IDEMPOTENCY_KEY_TTL_HOURS', 24))
+
+
+def key_from_request(request):
+    return (request.headers.get(HEADER) or request.POST.get(FIELD) or '').strip()
+
+
+def request_hash(request):
+    """パス＋送信内容（CSRF トークンとキー自身を除く）のハッシュ"""
+    parts = [request.method, request.path]
+    for name, values in sorted(request.POST.lists()):
+        if name not in IGNORED_FIELDS:
+            parts.extend(f'{name}={value}' for value in values)
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def replay(record):
+    response = HttpResponse(record.body, status=record.status_code,
+                            content_type=record.content_type or None)
+    if record.location:
+        response['Location'] = record.location
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def run_once(request, key, handler):
+    """key について handler(request) を1回だけ実行する。再送には保存済みの応答を返す。"""
+    digest = request_hash(request)
+    # 期限切れの同じキーは新しいキーとして扱う
+    IdempotencyKey.objects.filter(user=request.user, key=key, created_at__lt=timezone.now() - ttl()).delete()
+
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(user=request.user, key=key, request_hash=digest, status_code=0)
+        except IntegrityError:
+            record = IdempotencyKey.objects.get(user=request.user, key=key)
+            if record.request_hash != digest:
+                raise KeyReused(key)
+            return replay(record)
+
+        response = handler(request)
+        if response.status_code >= 500 or response.streaming:
+            transaction.set_rollback(True)
+            return response
+
+        record.status_code = response.status_code
+        record.content_type = response.get('Content-Type', '')
+        record.location = response.get('Location', '')
+        record.body = response.content.decode(response.charset or 'utf-8', errors='replace')
+        record.save(update_fields=['status_code', 'content_type', 'location', 'body'])
+        return response
+
+
+def purge_expired_keys(now=None):
+    now = now or timezone.now()
+    deleted, _ = IdempotencyKey.objects.filter(created_at__lt=now - ttl()).delete()
+    return deleted
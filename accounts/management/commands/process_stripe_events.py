@@ -0,0 +1,50 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from accounts.models import StripeEvent
+from accounts.stripe_events import process_pending, requeue_failed
+
+
+class Command(BaseCommand):
+    help = '受信済みの Stripe イベント(stripe_events)を作成順に反映する（worker）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='未処理のイベントを一通り反映して終了する')
+        parser.add_argument('--batch-size', type=int, default=100, help='1回に反映する件数（既定: 100）')
+        parser.add_argument('--interval', type=float, default=2.0,
+                            help='未処理のイベントが無いときに待つ秒数（既定: 2）')
+        parser.add_argument('--requeue-failed', action='store_true',
+                            help='失敗(failed)のイベントを未処理に戻してから開始する')
+
+    def handle(self, *args, **options):
+        self.running = True
+        signal.signal(signal.SIGTERM, self._stop)
+        if options['requeue_failed']:
+            self.stdout.write(f'{requeue_failed()}件を未処理に戻しました。')
+
+        totals = {}
+        try:
+            while self.running:
+                close_old_connections()
+                result = process_pending(options['batch_size'])
+                for status, count in result.items():
+                    totals[status] = totals.get(status, 0) + count
+                if result:
+                    self.stdout.write(' / '.join(f'{status} {count}件' for status, count in result.items()))
+                # 失敗して未処理に戻ったものだけなら、すぐには取り直さない
+                if set(result) - {StripeEvent.STATUS_PENDING}:
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+
+        summary = ' / '.join(f'{status} {count}件' for status, count in totals.items()) or '0件'
+        self.stdout.write(self.style.SUCCESS(f'終了しました（{summary}）'))
+
+    def _stop(self, signum, frame):
+        self.running = False
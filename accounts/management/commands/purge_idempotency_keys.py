@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from accounts.idempotency import purge_expired_keys
+
+
+class Command(BaseCommand):
+    help = '保存期間(IDEMPOTENCY_KEY_TTL_HOURS)を過ぎた冪等キーを削除する（Heroku Scheduler 等で定期実行）'
+
+    def handle(self, *args, **options):
+        deleted = purge_expired_keys()
+        self.stdout.write(self.style.SUCCESS(f'{deleted}件の冪等キーを削除しました。'))
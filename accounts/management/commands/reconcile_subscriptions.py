@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from accounts.reconcile import iter_stripe_subscriptions, reconcile_subscriptions
+
+
+class Command(BaseCommand):
+    help = ('Stripe のサブスクリプション一覧とローカルの契約情報を一括で照合する（Heroku Scheduler 等で定期実行）。'
+            'ローカルでは STRIPE_API_BASE=http://localhost:12111 で stripe-mock に向けて実行できる')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=100, help='Stripe 一覧APIの1ページの件数（最大100）')
+        parser.add_argument('--batch-size', type=int, default=500, help='まとめて更新する行数')
+        parser.add_argument('--dry-run', action='store_true', help='照合結果の件数だけ表示して更新しない')
+
+    def handle(self, *args, **options):
+        result = reconcile_subscriptions(
+            iter_stripe_subscriptions(options['page_size']),
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Stripe {result['seen']}件 / 照合 {result['matched']}件 / 更新 {result['updated']}件 / "
+            f"照合中に更新されたため対象外 {result['skipped']}件 / "
+            f"期限切れで無効化 {result['expired']}件"
+        ))
@@ -0,0 +1,62 @@
+import signal
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from accounts.outbox import deliver_batch, requeue_dead
+
+
+class Command(BaseCommand):
+    help = 'メール送信待ち(outbox_emails)をまとめて送信する（worker）。SMTP 接続は送信が続く間使い回す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='送信待ちが無くなるまで送って終了する（cron 等から使う場合）')
+        parser.add_argument('--batch-size', type=int, default=50, help='1回に取り出す件数（既定: 50）')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='送信待ちが無いときに待つ秒数（既定: 5）')
+        parser.add_argument('--requeue-dead', action='store_true',
+                            help='送信断念(dead)のメールを送信待ちに戻してから開始する')
+
+    def handle(self, *args, **options):
+        self.running = True
+        signal.signal(signal.SIGTERM, self._stop)
+
+        if options['requeue_dead']:
+            self.stdout.write(f'{requeue_dead()}件を送信待ちに戻しました。')
+
+        connection = None
+        totals = {'sent': 0, 'retry': 0, 'dead': 0, 'deferred': 0}
+        try:
+            while self.running:
+                close_old_connections()
+                if connection is None:
+                    connection = get_connection(fail_silently=False)
+                result = deliver_batch(options['batch_size'], connection=connection)
+                for key, value in result.items():
+                    totals[key] += value
+                if result['sent'] or result['retry'] or result['dead']:
+                    self.stdout.write(f"送信 {result['sent']}件 / 再送予定 {result['retry']}件 / 断念 {result['dead']}件")
+                    continue
+                if result['deferred']:
+                    self.stdout.write(f"SMTP が利用できないため {result['deferred']}件を送信待ちに戻しました")
+                # 送信待ちが無い（または SMTP が止まっている）ときは接続を閉じて待つ
+                connection.close()
+                connection = None
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if connection is not None:
+                connection.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"終了しました（送信 {totals['sent']}件 / 再送予定 {totals['retry']}件 / 断念 {totals['dead']}件）"
+        ))
+
+    def _stop(self, signum, frame):
+        self.running = False
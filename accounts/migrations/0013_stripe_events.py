@@ -0,0 +1,38 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0012_subscription_last_synced_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='stripe_event_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='StripeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True)),
+                ('event_type', models.CharField(max_length=100)),
+                ('stripe_subscription_id', models.CharField(blank=True, db_index=True, max_length=255)),
+                ('stripe_created', models.DateTimeField()),
+                ('payload', models.JSONField()),
+                ('status', models.CharField(choices=[('pending', '未処理'), ('processed', '反映済み'), ('skipped', 'スキップ'), ('failed', '失敗')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'stripe_events',
+                'indexes': [models.Index(fields=['status', 'stripe_created'], name='stripe_event_status_idx')],
+            },
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 
 # Create your models here.
@@ -54,6 +55,106 @@ class Subscription(models.Model):
     # 追加: Stripe連携に必要なID
     stripe_customer_id = models.CharField(max_length=255, null=True, blank=True)
     stripe_subscription_id = models.CharField(max_length=255, null=True, blank=True)
+    # 最後にStripeと同期した時刻（利用資格の判定はこの時刻から一定時間はローカルの値を使う。Webhookで None に戻す）
+    last_synced_at = models.DateTimeField(null=True, blank=True)
+    # 最後に反映したStripeイベントの作成時刻（これより古いイベントは反映しない）
+    stripe_event_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
-        db_table = 'subscriptions'
\ No newline at end of file
+        db_table = 'subscriptions'
+
+# メール送信待ち行列（アウトボックス）
+# 業務データと同じトランザクションで書き込み、送信は send_outbox_emails コマンド（worker）が行う
+class OutboxEmail(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_DEAD = 'dead'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, '送信待ち'),
+        (STATUS_SENT, '送信済み'),
+        (STATUS_DEAD, '送信断念'),
+    ]
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255, blank=True)
+    recipients = models.JSONField(default=list)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    # 次に送信を試みる時刻（送信中はリース期限として先へ進める）
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claim_token = models.CharField(max_length=32, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'outbox_emails'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_status_next_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.subject} -> {", ".join(self.recipients)} ({self.status})'
+
+
+# 更新系リクエストの冪等キー（Idempotency-Key）
+# 同じキーで再送されたリクエストは処理せず、保存した応答を返す（全ワーカー共通）
+class IdempotencyKey(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=64)
+    # 同じキーで別の内容が送られてきたことを検出するためのリクエストのハッシュ
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField()
+    content_type = models.CharField(max_length=100, blank=True)
+    location = models.CharField(max_length=500, blank=True)
+    body = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        db_table = 'idempotency_keys'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='uniq_idempotency_user_key'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id}:{self.key} ({self.status_code})'
+
+
+# Stripe Webhook で受け取ったイベントの記録
+# 受信時はイベントIDで重複を除いて保存するだけで、反映は process_stripe_events コマンド（worker）が作成順に行う
+class StripeEvent(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSED = 'processed'
+    STATUS_SKIPPED = 'skipped'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, '未処理'),
+        (STATUS_PROCESSED, '反映済み'),
+        (STATUS_SKIPPED, 'スキップ'),
+        (STATUS_FAILED, '失敗'),
+    ]
+
+    event_id = models.CharField(max_length=255, unique=True)
+    event_type = models.CharField(max_length=100)
+    # 対象のStripeサブスクリプションID（イベントの順序判定用。無いイベントは空）
+    stripe_subscription_id = models.CharField(max_length=255, blank=True, db_index=True)
+    # Stripe 側でイベントが作成された時刻
+    stripe_created = models.DateTimeField()
+    payload = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    # 失敗後に次に反映を試みる時刻（指数バックオフ）
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'stripe_events'
+        indexes = [
+            models.Index(fields=['status', 'stripe_created'], name='stripe_event_status_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.event_id} {self.event_type} ({self.status})'
@@ -0,0 +1,148 @@
+"""
+メール送信のアウトボックス(outbox_emails)
+- 画面側は enqueue_email で行を書き込むだけ（業務データと同じトランザクション内で呼ぶ。ロールバックされればメールも出ない）
+- 送信は send_outbox_emails コマンドが deliver_batch でまとめて行い、1つの SMTP 接続を使い回す
+- 失敗したら指数バックオフ（基準秒 * 2^(試行回数-1)、上限あり、ゆらぎ付き）で再送し、上限回数に達したら dead にする
+- 取り出した行は next_attempt_at をリース期限まで進めておくので、ワーカーが途中で落ちても期限後に再送される
+- 送信はサーキットブレーカーとバルクヘッドを通す（nagoyameshi.resilience の 'smtp'）。SMTP が落ちている間は送らずに
+  残りを送信待ちに戻す（試行回数は増やさないので、障害が長引いても dead にならない）
+
+ローカル確認用（デバッグ用 SMTP サーバーに送る）:
+    python -m aiosmtpd -n -l localhost:1025
+    EMAIL_BACKEND=django.core.mail.backends.smtp.EmailBackend EMAIL_HOST=localhost EMAIL_PORT=1025 \
+        EMAIL_USE_TLS=False python manage.py send_outbox_emails --once
+"""
+import random
+import smtplib
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.utils import timezone
+
+from nagoyameshi.resilience import DependencyUnavailable, guard
+
+from .models import OutboxEmail
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def max_attempts():
+    return _setting('OUTBOX_MAX_ATTEMPTS', 8)
+
+
+def retry_delay(attempts):
+    """attempts 回目の失敗後に待つ時間"""
+    base = _setting('OUTBOX_RETRY_BASE_SECONDS', 60)
+    cap = _setting('OUTBOX_RETRY_MAX_SECONDS', 60 * 60 * 6)
+    seconds = min(base * 2 ** max(attempts - 1, 0), cap)
+    return timedelta(seconds=seconds * random.uniform(0.9, 1.1))
+
+
+def enqueue_email(subject, body, recipients, from_email=None):
+    """送信待ちに積む。宛先が無ければ何もしない"""
+    recipients = [address for address in recipients if address]
+    if not recipients:
+        return None
+    return OutboxEmail.objects.create(
+        subject=subject,
+        body=body,
+        recipients=recipients,
+        from_email=from_email or '',
+    )
+
+
+def claim_batch(batch_size, now=None):
+    """送信時刻を過ぎた行を取り出す（他のワーカーと重ならないよう条件付き UPDATE で確保）"""
+    now = now or timezone.now()
+    lease = timedelta(seconds=_setting('OUTBOX_LEASE_SECONDS', 300))
+    due = OutboxEmail.objects.filter(status=OutboxEmail.STATUS_PENDING, next_attempt_at__lte=now)
+    ids = list(due.order_by('next_attempt_at', 'id').values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return []
+    token = uuid.uuid4().hex
+    due.filter(id__in=ids).update(next_attempt_at=now + lease, claim_token=token)
+    return list(OutboxEmail.objects.filter(claim_token=token, status=OutboxEmail.STATUS_PENDING).order_by('id'))
+
+
+def _mark_sent(email):
+    OutboxEmail.objects.filter(pk=email.pk, claim_token=email.claim_token).update(
+        status=OutboxEmail.STATUS_SENT,
+        attempts=email.attempts + 1,
+        sent_at=timezone.now(),
+        last_error='',
+        claim_token='',
+    )
+
+
+def _mark_failed(email, error):
+    attempts = email.attempts + 1
+    update = {'attempts': attempts, 'last_error': f'{type(error).__name__}: {error}'[:2000], 'claim_token': ''}
+    if attempts >= max_attempts():
+        update['status'] = OutboxEmail.STATUS_DEAD
+    else:
+        update['next_attempt_at'] = timezone.now() + retry_delay(attempts)
+    OutboxEmail.objects.filter(pk=email.pk, claim_token=email.claim_token).update(**update)
+    return update.get('status') == OutboxEmail.STATUS_DEAD
+
+
+def _defer(emails, retry_after):
+    """送らなかった行を送信待ちに戻す（試行回数はそのまま）"""
+    OutboxEmail.objects.filter(pk__in=[email.pk for email in emails], claim_token=emails[0].claim_token).update(
+        next_attempt_at=timezone.now() + timedelta(seconds=retry_after or 0), claim_token='')
+    return len(emails)
+
+
+def is_outage(error):
+    """SMTP サーバー側の障害（ブレーカーの失敗に数える）か。宛先/送信元/本文の拒否は1通ごとの問題なので数えない"""
+    refused = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+    return isinstance(error, OSError) and not isinstance(error, refused)
+
+
+def deliver_batch(batch_size=50, connection=None):
+    """1バッチ分を送信して {'sent', 'retry', 'dead', 'deferred'} の件数を返す。
+    connection を渡せばそれを使い回す（開閉は呼び出し側）。渡さなければこのバッチの間だけ開く。
+    """
+    result = {'sent': 0, 'retry': 0, 'dead': 0, 'deferred': 0}
+    emails = claim_batch(batch_size)
+    if not emails:
+        return result
+
+    own_connection = connection is None
+    if own_connection:
+        connection = get_connection(fail_silently=False)
+    default_from = _setting('DEFAULT_FROM_EMAIL', None)
+    try:
+        for index, email in enumerate(emails):
+            try:
+                with guard('smtp', is_failure=is_outage):
+                    connection.open()
+                    EmailMessage(email.subject, email.body, email.from_email or default_from,
+                                 email.recipients, connection=connection).send()
+            except DependencyUnavailable as e:
+                print(f'Outbox send deferred: {e}')
+                result['deferred'] += _defer(emails[index:], e.retry_after)
+                break
+            except Exception as e:
+                print(f'Outbox send failed (id={email.pk}): {e}')
+                result['dead' if _mark_failed(email, e) else 'retry'] += 1
+                # 接続が壊れている可能性があるので次の送信で開き直す
+                connection.close()
+                continue
+            _mark_sent(email)
+            result['sent'] += 1
+    finally:
+        if own_connection:
+            connection.close()
+    return result
+
+
+def requeue_dead(ids=None):
+    """dead になったメールを送信待ちに戻す（SMTP 設定の修正後など）"""
+    emails = OutboxEmail.objects.filter(status=OutboxEmail.STATUS_DEAD)
+    if ids:
+        emails = emails.filter(id__in=ids)
+    return emails.update(status=OutboxEmail.STATUS_PENDING, attempts=0, next_attempt_at=timezone.now())
@@ -0,0 +1,113 @@
+"""
+Stripe のサブスクリプションとローカルの Subscription 行の一括照合（reconcile_subscriptions コマンド）
+- Stripe の一覧API（status=all）をページ単位で読み、stripe_subscription_id（無ければ stripe_customer_id）で照合する
+- バッチごとに行を select_for_update で読み直し、変わった行だけ bulk_update でまとめて反映し、
+  照合できた行は last_synced_at を更新する
+- 照合の開始後に Webhook（stripe_event_at）や同期（last_synced_at）で更新された行は、一覧の方が古いので飛ばす
+  （利用資格の判定がしばらく Stripe に問い合わせなくて済む）
+- 最後に終了日を過ぎた有効な行を UPDATE 1文で無効にする
+- 接続先は STRIPE_API_BASE（stripe-mock 等のローカルの代替サーバーでも動く）
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Subscription
+from .stripe_gateway import get_gateway
+from .utils import stripe_subscription_state
+
+UPDATE_FIELDS = ['stripe_customer_id', 'stripe_subscription_id', 'end_date', 'is_active']
+
+
+def iter_stripe_subscriptions(page_size=100):
+    """Stripe の全サブスクリプション（解約済みを含む）を1ページずつ取得しながら返す"""
+    return get_gateway().list_subscriptions(page_size)
+
+
+def _local_index():
+    """照合用の ID → 行の pk（行の中身はバッチごとに読み直す）"""
+    rows = Subscription.objects.values_list('pk', 'stripe_subscription_id', 'stripe_customer_id')
+    by_subscription, by_customer = {}, {}
+    for pk, subscription_id, customer_id in rows:
+        if subscription_id:
+            by_subscription[subscription_id] = pk
+        elif customer_id:
+            by_customer.setdefault(customer_id, pk)
+    return by_subscription, by_customer
+
+
+def _apply_batch(batch, started, today, dry_run):
+    """(pk, Stripe のサブスクリプション) のバッチを行ロックを取って反映し、(更新した行数, 飛ばした行数) を返す。
+    照合の開始後に Webhook や決済完了画面で更新された行は、一覧の方が古いので触らない"""
+    if not batch:
+        return 0, 0
+    with transaction.atomic():
+        rows = Subscription.objects.filter(pk__in=[pk for pk, _ in batch])
+        if not dry_run:
+            rows = rows.select_for_update()
+        rows = rows.in_bulk()
+        changed, synced, skipped = [], [], 0
+        for pk, s in batch:
+            row = rows.get(pk)
+            if row is None:
+                continue
+            if ((row.stripe_event_at and row.stripe_event_at > started)
+                    or (row.last_synced_at and row.last_synced_at > started)):
+                skipped += 1
+                continue
+            before = [getattr(row, field) for field in UPDATE_FIELDS]
+            if not row.stripe_subscription_id:
+                row.stripe_subscription_id = s['id']
+            if s.get('customer'):
+                row.stripe_customer_id = s['customer']
+            row.end_date, row.is_active = stripe_subscription_state(s, row.end_date, today)
+            if [getattr(row, field) for field in UPDATE_FIELDS] != before:
+                changed.append(row)
+            synced.append(row.pk)
+        if not dry_run:
+            if changed:
+                Subscription.objects.bulk_update(changed, UPDATE_FIELDS)
+            if synced:
+                Subscription.objects.filter(pk__in=synced).update(last_synced_at=timezone.now())
+    return len(changed), skipped
+
+
+def expire_ended_subscriptions(today=None):
+    """終了日を過ぎた有効な行を無効にする（UPDATE 1文）"""
+    today = today or timezone.localdate()
+    return Subscription.objects.filter(is_active=True, end_date__lt=today).update(is_active=False)
+
+
+def reconcile_subscriptions(stripe_subscriptions=None, batch_size=500, dry_run=False):
+    """照合して件数 {'seen', 'matched', 'updated', 'skipped', 'expired'} を返す"""
+    if stripe_subscriptions is None:
+        stripe_subscriptions = iter_stripe_subscriptions()
+    started = timezone.now()
+    today = timezone.localdate()
+    by_subscription, by_customer = _local_index()
+    result = {'seen': 0, 'matched': 0, 'updated': 0, 'skipped': 0, 'expired': 0}
+    batch = []
+
+    def flush():
+        updated, skipped = _apply_batch(batch, started, today, dry_run)
+        result['updated'] += updated
+        result['skipped'] += skipped
+        batch.clear()
+
+    for s in stripe_subscriptions:
+        result['seen'] += 1
+        pk = by_subscription.get(s['id'])
+        if pk is None:
+            # サブスクリプションIDが未保存の行は顧客IDで照合（1行に1回だけ）
+            pk = by_customer.pop(s.get('customer'), None)
+            if pk is None:
+                continue
+            by_subscription[s['id']] = pk
+        result['matched'] += 1
+        batch.append((pk, s))
+        if len(batch) >= batch_size:
+            flush()
+
+    flush()
+    if not dry_run:
+        result['expired'] = expire_ended_subscriptions(today)
+    return result
@@ -0,0 +1,208 @@
+"""
+Stripe Webhook イベントの記録と反映(stripe_events)
+- Webhook はイベントIDで重複を除いて保存し、すぐ 200 を返す（record_event）
+- process_stripe_events コマンド（worker）が未処理のイベントを Stripe での作成順に反映する（process_pending）
+- サブスクリプションの状態を含むイベントは、そのサブスクリプションに反映済みのイベントより古ければスキップする
+  （Stripe は順不同・重複ありで配信するため）
+- 反映に失敗したイベントは指数バックオフ（next_attempt_at）で再試行し、STRIPE_EVENT_MAX_ATTEMPTS 回で failed にする。
+  同じサブスクリプションに先に作成された未処理/失敗のイベントがあれば、後のイベントは反映しない（作成順を守る。
+  failed のイベントは requeue_failed で未処理に戻すまで、そのサブスクリプションのイベントを止める）
+- 対応するイベントの種類は @handles で関数を登録するだけで増やせる
+- worker は1プロセスで動かす（Procfile の stripe_worker）
+"""
+import logging
+import random
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Exists, Max, Min, OuterRef, Q
+from django.utils import timezone
+
+from .entitlements import invalidate_entitlement
+from .models import StripeEvent, Subscription
+from .stripe_gateway import get_gateway
+from .utils import stripe_subscription_state
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+
+def handles(*event_types):
+    def register(func):
+        for event_type in event_types:
+            HANDLERS[event_type] = func
+        return func
+    return register
+
+
+def max_attempts():
+    return getattr(settings, 'STRIPE_EVENT_MAX_ATTEMPTS', 5)
+
+
+def retry_delay(attempts):
+    """attempts 回目の失敗後に待つ時間"""
+    base = getattr(settings, 'STRIPE_EVENT_RETRY_BASE_SECONDS', 30)
+    cap = getattr(settings, 'STRIPE_EVENT_RETRY_MAX_SECONDS', 60 * 60)
+    seconds = min(base * 2 ** max(attempts - 1, 0), cap)
+    return timedelta(seconds=seconds * random.uniform(0.9, 1.1))
+
+
+def _subscription_id(event_type, data_object):
+    if event_type.startswith('customer.subscription.'):
+        return data_object.get('id') or ''
+    subscription = data_object.get('subscription')
+    return subscription if isinstance(subscription, str) else ''
+
+
+def record_event(event):
+    """受信したイベントを保存する。既に受信済み（Stripe の再送）なら False"""
+    event_type = event.get('type') or ''
+    data_object = event.get('data', {}).get('object', {}) or {}
+    try:
+        with transaction.atomic():
+            StripeEvent.objects.create(
+                event_id=event['id'],
+                event_type=event_type,
+                stripe_subscription_id=_subscription_id(event_type, data_object),
+                stripe_created=datetime.fromtimestamp(event.get('created') or 0, tz=dt_timezone.utc),
+                payload=event,
+                # 対応していない種類は記録だけして処理しない
+                status=StripeEvent.STATUS_PENDING if event_type in HANDLERS else StripeEvent.STATUS_SKIPPED,
+            )
+    except IntegrityError:
+        return False
+    return True
+
+
+# ================================
+# イベントごとの反映処理（戻り値が False ならスキップ扱い）
+# ================================
+@handles('customer.subscription.created', 'customer.subscription.updated', 'customer.subscription.deleted')
+def apply_subscription_event(event, data_object):
+    """Apply changes from Stripe subscription object to local Subscription row."""
+    sub_id = data_object.get('id')
+    customer_id = data_object.get('customer')
+
+    sub_model = None
+    if sub_id:
+        sub_model = Subscription.objects.select_for_update().filter(stripe_subscription_id=sub_id).first()
+    if not sub_model and customer_id:
+        sub_model = Subscription.objects.select_for_update().filter(stripe_customer_id=customer_id).first()
+
+    if not sub_model:
+        return False
+    # 反映済みのイベントより古い（遅れて届いた）イベントは無視
+    if sub_model.stripe_event_at and event.stripe_created < sub_model.stripe_event_at:
+        return False
+
+    # Save IDs if missing
+    if customer_id and not sub_model.stripe_customer_id:
+        sub_model.stripe_customer_id = customer_id
+    if sub_id and not sub_model.stripe_subscription_id:
+        sub_model.stripe_subscription_id = sub_id
+
+    # Determine end_date / is_active flag
+    # 決済が成功してStripeのSubscriptionがactiveになっている場合のみ有効とする。
+    # incomplete/trialing/past_due等は有効化しない。
+    sub_model.end_date, sub_model.is_active = stripe_subscription_state(
+        data_object, sub_model.end_date, timezone.localdate())
+    sub_model.stripe_event_at = event.stripe_created
+    # 次の利用資格の判定で Stripe の最新状態を取り直す
+    sub_model.last_synced_at = None
+    sub_model.save()
+    get_gateway().forget('subscription', sub_model.stripe_subscription_id)
+    return True
+
+
+@handles('checkout.session.completed')
+def apply_checkout_completed(event, data_object):
+    """決済完了: Checkout セッションから顧客ID/サブスクリプションIDを保存（有効化は subscription イベントで）"""
+    ids = {'stripe_customer_id': data_object.get('customer'),
+           'stripe_subscription_id': data_object.get('subscription')}
+    ids = {field: value for field, value in ids.items() if isinstance(value, str) and value}
+    if not data_object.get('id') or not ids:
+        return False
+    return bool(Subscription.objects.filter(stripe_id=data_object['id']).update(last_synced_at=None, **ids))
+
+
+@handles('invoice.paid', 'invoice.payment_failed')
+def apply_invoice_event(event, data_object):
+    """支払い状況が変わったので次の利用資格の判定で同期させる"""
+    return bool(invalidate_entitlement(stripe_customer_id=data_object.get('customer')))
+
+
+# ================================
+# worker
+# ================================
+def process_event(event):
+    """1件を反映して status を更新する（反映と status の更新は同じトランザクション）"""
+    handler = HANDLERS.get(event.event_type)
+    data_object = event.payload.get('data', {}).get('object', {}) or {}
+    attempts = event.attempts + 1
+    try:
+        with transaction.atomic():
+            applied = handler is not None and handler(event, data_object)
+            StripeEvent.objects.filter(pk=event.pk).update(
+                status=StripeEvent.STATUS_PROCESSED if applied else StripeEvent.STATUS_SKIPPED,
+                attempts=attempts, processed_at=timezone.now(), last_error='',
+            )
+    except Exception as e:
+        update = {'attempts': attempts, 'last_error': f'{type(e).__name__}: {e}'[:2000]}
+        if attempts >= max_attempts():
+            logger.error('Stripe event failed, giving up (%s, attempt %d): %s', event.event_id, attempts, e)
+            update['status'] = StripeEvent.STATUS_FAILED
+        else:
+            logger.warning('Stripe event failed (%s, attempt %d): %s', event.event_id, attempts, e)
+            update['status'] = StripeEvent.STATUS_PENDING
+            update['next_attempt_at'] = timezone.now() + retry_delay(attempts)
+        StripeEvent.objects.filter(pk=event.pk).update(**update)
+    event.refresh_from_db(fields=['status', 'attempts', 'next_attempt_at', 'processed_at', 'last_error'])
+    return event.status
+
+
+def process_pending(batch_size=100, now=None):
+    """再試行時刻を過ぎた未処理のイベントを作成順に1バッチ分反映して {status: 件数} を返す。
+    同じサブスクリプションに先のイベント（未処理/失敗）が残っているイベントは取り出さないので、
+    1バッチで反映するのはサブスクリプションごとに一番古いイベントだけになる
+    """
+    now = now or timezone.now()
+    earlier = StripeEvent.objects.filter(
+        Q(stripe_created__lt=OuterRef('stripe_created')) | Q(stripe_created=OuterRef('stripe_created'),
+                                                             id__lt=OuterRef('id')),
+        stripe_subscription_id=OuterRef('stripe_subscription_id'),
+        status__in=[StripeEvent.STATUS_PENDING, StripeEvent.STATUS_FAILED],
+    )
+    result = {}
+    events = (StripeEvent.objects
+              .filter(status=StripeEvent.STATUS_PENDING, next_attempt_at__lte=now)
+              .filter(Q(stripe_subscription_id='') | ~Exists(earlier))
+              .order_by('stripe_created', 'id')[:batch_size])
+    for event in events:
+        status = process_event(event)
+        result[status] = result.get(status, 0) + 1
+    return result
+
+
+def requeue_failed(ids=None):
+    """failed になったイベントを未処理に戻す（原因の修正後など）。止まっていた後続のイベントも流れ出す"""
+    events = StripeEvent.objects.filter(status=StripeEvent.STATUS_FAILED)
+    if ids:
+        events = events.filter(id__in=ids)
+    return events.update(status=StripeEvent.STATUS_PENDING, attempts=0, next_attempt_at=timezone.now())
+
+
+def stripe_event_stats(now=None):
+    """処理の遅れ（未処理で一番古いイベントの受信からの秒数）と状態別の件数"""
+    now = now or timezone.now()
+    pending = StripeEvent.objects.filter(status=StripeEvent.STATUS_PENDING).aggregate(
+        oldest=Min('received_at'))
+    last = StripeEvent.objects.aggregate(last_processed=Max('processed_at'))
+    counts = {status: 0 for status, _ in StripeEvent.STATUS_CHOICES}
+    counts.update(StripeEvent.objects.values_list('status').annotate(total=Count('id')).order_by())
+    return {
+        'counts': counts,
+        'lag_seconds': round((now - pending['oldest']).total_seconds(), 1) if pending['oldest'] else 0,
+        'last_processed_at': last['last_processed'].isoformat() if last['last_processed'] else None,
+    }
@@ -0,0 +1,270 @@
+"""
+Stripe API の呼び出し口(gateway)
+- Stripe への通信はすべてここを通す（views / utils / reconcile から直接 stripe.* を呼ばない）
+- 参照系と更新系で別のクライアントを使い、それぞれにタイムアウトを設定する
+  （STRIPE_READ_TIMEOUT / STRIPE_WRITE_TIMEOUT 秒）
+- 取得した顧客・サブスクリプション・Checkout セッションは STRIPE_CACHE_SECONDS（既定30秒）だけキャッシュする
+  （ポータル遷移などで同じオブジェクトを何度も取りに行かない。更新したものは入れ替える）
+- 操作ごとの呼び出し回数・エラー数・キャッシュヒット数・所要時間はワーカーごとに数える（ops_status）
+- 呼び出しはサーキットブレーカーとバルクヘッドを通す（nagoyameshi.resilience の 'stripe'）。Stripe が落ちている/遅いときは
+  DependencyUnavailable ですぐに失敗させ、呼び出し側は従来のエラー時の動作（ローカルの利用資格で判定 等）になる
+- STRIPE_GATEWAY で実装を切り替える。FakeStripeGateway は通信せずにプロセス内で決済の流れを再現する（負荷試験用。
+  状態はプロセスごとなので gunicorn は1ワーカーで動かす）
+"""
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from nagoyameshi.resilience import guard
+
+_metrics_lock = threading.Lock()
+_metrics = {}
+
+
+def _record(operation, elapsed_ms=None, error=False, cache_hit=False):
+    with _metrics_lock:
+        m = _metrics.setdefault(operation, {'calls': 0, 'errors': 0, 'cache_hits': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        if cache_hit:
+            m['cache_hits'] += 1
+            return
+        m['calls'] += 1
+        m['errors'] += int(error)
+        m['total_ms'] += elapsed_ms
+        m['max_ms'] = max(m['max_ms'], elapsed_ms)
+
+
+def stripe_gateway_stats():
+    """このワーカーでの Stripe 呼び出し状況（操作ごと）"""
+    with _metrics_lock:
+        metrics = {operation: dict(m) for operation, m in _metrics.items()}
+    for m in metrics.values():
+        m['avg_ms'] = round(m['total_ms'] / m['calls'], 1) if m['calls'] else None
+        m['total_ms'] = round(m['total_ms'], 1)
+        m['max_ms'] = round(m['max_ms'], 1)
+    return metrics
+
+
+def is_outage(error):
+    """Stripe 側の障害（ブレーカーの失敗に数える）か。カードエラーや入力誤りなどの 4xx は数えない"""
+    if isinstance(error, (stripe.APIConnectionError, stripe.RateLimitError)):
+        return True
+    return isinstance(error, stripe.StripeError) and (error.http_status or 500) >= 500
+
+
+class StripeGateway:
+    def __init__(self):
+        self.read_client = self._client(getattr(settings, 'STRIPE_READ_TIMEOUT', 5))
+        self.write_client = self._client(getattr(settings, 'STRIPE_WRITE_TIMEOUT', 15))
+
+    @staticmethod
+    def _client(timeout):
+        api_base = getattr(settings, 'STRIPE_API_BASE', '')
+        return stripe.StripeClient(
+            settings.STRIPE_API_SECRET_KEY,
+            http_client=stripe.RequestsClient(timeout=timeout),
+            max_network_retries=getattr(settings, 'STRIPE_MAX_NETWORK_RETRIES', 1),
+            base_addresses={'api': api_base} if api_base else {},
+        )
+
+    # ---- 共通処理 ----
+    def _call(self, operation, func, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            with guard('stripe', is_failure=is_outage):
+                result = func(*args, **kwargs)
+        except Exception:
+            _record(operation, (time.perf_counter() - started) * 1000, error=True)
+            raise
+        _record(operation, (time.perf_counter() - started) * 1000)
+        return result
+
+    @staticmethod
+    def _cache_key(kind, object_id):
+        return f'stripe:{kind}:{object_id}'
+
+    def _cached(self, kind, object_id, fetch, fresh=False):
+        key = self._cache_key(kind, object_id)
+        if not fresh:
+            obj = cache.get(key)
+            if obj is not None:
+                _record(f'{kind}.retrieve', cache_hit=True)
+                return obj
+        obj = self._call(f'{kind}.retrieve', fetch, object_id)
+        self._remember(kind, obj)
+        return obj
+
+    def _remember(self, kind, obj):
+        cache.set(self._cache_key(kind, obj['id']), obj, getattr(settings, 'STRIPE_CACHE_SECONDS', 30))
+
+    def forget(self, kind, object_id):
+        """キャッシュを捨てる（Webhook で変更を受けたときなど）"""
+        if object_id:
+            cache.delete(self._cache_key(kind, object_id))
+
+    # ---- 参照 ----
+    def retrieve_subscription(self, subscription_id, fresh=False):
+        return self._cached('subscription', subscription_id, self._fetch_subscription, fresh)
+
+    def retrieve_customer(self, customer_id, fresh=False):
+        return self._cached('customer', customer_id, self._fetch_customer, fresh)
+
+    def retrieve_checkout_session(self, session_id, fresh=False):
+        return self._cached('checkout_session', session_id, self._fetch_checkout_session, fresh)
+
+    def list_subscriptions(self, page_size=100, status='all'):
+        """全件を1ページずつ取得しながら返す（各ページの取得を _call に通す）"""
+        starting_after = None
+        while True:
+            page = self._call('subscription.list', self._list_subscriptions, page_size, status, starting_after)
+            yield from page.data
+            if not page.has_more or not page.data:
+                return
+            starting_after = page.data[-1]['id']
+
+    # ---- 更新 ----
+    def cancel_subscription_at_period_end(self, subscription_id):
+        subscription = self._call('subscription.update', self._update_subscription,
+                                  subscription_id, {'cancel_at_period_end': True})
+        self._remember('subscription', subscription)
+        return subscription
+
+    def create_checkout_session(self, **params):
+        return self._call('checkout_session.create', self._create_checkout_session, params)
+
+    def create_billing_portal_session(self, **params):
+        return self._call('billing_portal_session.create', self._create_billing_portal_session, params)
+
+    # ---- Stripe API（Fake で差し替える部分）----
+    def _fetch_subscription(self, subscription_id):
+        return self.read_client.subscriptions.retrieve(subscription_id)
+
+    def _fetch_customer(self, customer_id):
+        return self.read_client.customers.retrieve(customer_id)
+
+    def _fetch_checkout_session(self, session_id):
+        return self.read_client.checkout.sessions.retrieve(session_id)
+
+    def _list_subscriptions(self, page_size, status, starting_after=None):
+        params = {'limit': page_size, 'status': status}
+        if starting_after:
+            params['starting_after'] = starting_after
+        return self.read_client.subscriptions.list(params=params)
+
+    def _update_subscription(self, subscription_id, params):
+        return self.write_client.subscriptions.update(subscription_id, params=params)
+
+    def _create_checkout_session(self, params):
+        return self.write_client.checkout.sessions.create(params=params)
+
+    def _create_billing_portal_session(self, params):
+        return self.write_client.billing_portal.sessions.create(params=params)
+
+
+class FakeStripeGateway(StripeGateway):
+    """通信しない Stripe（負荷試験・オフライン開発用）
+    - Checkout セッションを作ると、その場で支払い済みになり顧客と有効なサブスクリプションができる
+    - サブスクリプションの作成/変更は Webhook と同じく stripe_events に記録する（stripe_worker が反映する）
+    """
+    API_KEY = 'sk_test_fake'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.objects = {'subscription': {}, 'customer': {}, 'checkout_session': {}}
+
+    def _new_id(self, prefix):
+        return f'{prefix}_fake_{uuid.uuid4().hex[:16]}'
+
+    def _store(self, kind, cls, values):
+        obj = cls.construct_from(values, self.API_KEY)
+        with self._lock:
+            self.objects[kind][obj.id] = obj
+        return obj
+
+    def _get(self, kind, object_id):
+        with self._lock:
+            obj = self.objects[kind].get(object_id)
+        if obj is None:
+            raise stripe.InvalidRequestError(f"No such {kind}: '{object_id}'", 'id', code='resource_missing',
+                                             http_status=404)
+        return obj
+
+    def _emit(self, event_type, subscription):
+        from .stripe_events import record_event
+        record_event({'id': self._new_id('evt'), 'type': event_type, 'created': int(time.time()),
+                      'data': {'object': subscription.to_dict()}})
+
+    def _fetch_subscription(self, subscription_id):
+        return self._get('subscription', subscription_id)
+
+    def _fetch_customer(self, customer_id):
+        return self._get('customer', customer_id)
+
+    def _fetch_checkout_session(self, session_id):
+        return self._get('checkout_session', session_id)
+
+    def _list_subscriptions(self, page_size, status, starting_after=None):
+        with self._lock:
+            data = [obj.to_dict() for obj in self.objects['subscription'].values()
+                    if status == 'all' or obj.status == status]
+        ids = [item['id'] for item in data]
+        start = ids.index(starting_after) + 1 if starting_after in ids else 0
+        return stripe.ListObject.construct_from(
+            {'object': 'list', 'url': '/v1/subscriptions', 'has_more': start + page_size < len(data),
+             'data': data[start:start + page_size]}, self.API_KEY)
+
+    def _update_subscription(self, subscription_id, params):
+        values = {**self._get('subscription', subscription_id).to_dict(), **params}
+        subscription = self._store('subscription', stripe.Subscription, values)
+        self._emit('customer.subscription.updated', subscription)
+        return subscription
+
+    def _create_checkout_session(self, params):
+        now = timezone.now()
+        customer = self._store('customer', stripe.Customer, {
+            'id': self._new_id('cus'), 'object': 'customer', 'created': int(now.timestamp()),
+        })
+        subscription = self._store('subscription', stripe.Subscription, {
+            'id': self._new_id('sub'), 'object': 'subscription', 'customer': customer.id, 'status': 'active',
+            'cancel_at_period_end': False, 'canceled_at': None, 'created': int(now.timestamp()),
+            'current_period_end': int((now + timedelta(days=30)).timestamp()),
+        })
+        session_id = self._new_id('cs')
+        session = self._store('checkout_session', stripe.checkout.Session, {
+            'id': session_id, 'object': 'checkout.session', 'mode': params.get('mode'),
+            'payment_status': 'paid', 'status': 'complete',
+            'customer': customer.id, 'subscription': subscription.id,
+            'url': params['success_url'].replace('{CHECKOUT_SESSION_ID}', session_id),
+        })
+        self._emit('customer.subscription.created', subscription)
+        return session
+
+    def _create_billing_portal_session(self, params):
+        self._get('customer', params['customer'])
+        return stripe.billing_portal.Session.construct_from({
+            'id': self._new_id('bps'), 'object': 'billing_portal.session',
+            'customer': params['customer'], 'url': params['return_url'],
+        }, self.API_KEY)
+
+
+_gateway = None
+_gateway_config = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    """settings.STRIPE_GATEWAY の実装（プロセスで1つ。設定が変わったら作り直す）"""
+    global _gateway, _gateway_config
+    config = (getattr(settings, 'STRIPE_GATEWAY', 'accounts.stripe_gateway.StripeGateway'),
+              getattr(settings, 'STRIPE_API_BASE', ''))
+    with _gateway_lock:
+        if _gateway is None or _gateway_config != config:
+            _gateway = import_string(config[0])()
+            _gateway_config = config
+        return _gateway
@@ -1,3 +1,431 @@
-from django.test import TestCase
+import json
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import stripe
+from django.core import mail
+from django.db import OperationalError, close_old_connections, connection, transaction
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from nagoyameshi import resilience
+from shops.models import History, Shop
+
+from .entitlements import get_subscription, has_entitlement, invalidate_entitlement
+from .models import IdempotencyKey, OutboxEmail, StripeEvent, Subscription, User
+from .outbox import deliver_batch, enqueue_email
+from .reconcile import iter_stripe_subscriptions, reconcile_subscriptions
+from .stripe_events import HANDLERS, process_pending, requeue_failed, stripe_event_stats
+from .stripe_gateway import stripe_gateway_stats
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                   OUTBOX_MAX_ATTEMPTS=3, OUTBOX_RETRY_BASE_SECONDS=60)
+class OutboxTests(TestCase):
+    def setUp(self):
+        resilience.reset()
+        self.addCleanup(resilience.reset)
+
+    def test_enqueue_does_not_send_until_delivered(self):
+        enqueue_email('件名', '本文', ['guest@example.com'])
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(deliver_batch(), {'sent': 1, 'retry': 0, 'dead': 0, 'deferred': 0})
+        self.assertEqual(mail.outbox[0].to, ['guest@example.com'])
+        email = OutboxEmail.objects.get()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.STATUS_SENT, 1))
+        self.assertEqual(deliver_batch(), {'sent': 0, 'retry': 0, 'dead': 0, 'deferred': 0})
+
+    def test_enqueue_is_rolled_back_with_transaction(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                enqueue_email('件名', '本文', ['guest@example.com'])
+                raise RuntimeError
+        self.assertFalse(OutboxEmail.objects.exists())
+
+    def test_failures_back_off_then_dead_letter(self):
+        email = enqueue_email('件名', '本文', ['guest@example.com'])
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=ConnectionRefusedError('refused')):
+            self.assertEqual(deliver_batch()['retry'], 1)
+            email.refresh_from_db()
+            self.assertEqual(email.attempts, 1)
+            self.assertGreater(email.next_attempt_at, timezone.now())
+            # 再送時刻前は取り出されない
+            self.assertEqual(deliver_batch()['retry'], 0)
+
+            for _ in range(2):
+                OutboxEmail.objects.update(next_attempt_at=timezone.now())
+                deliver_batch()
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.STATUS_DEAD, 3))
+        self.assertIn('refused', email.last_error)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', RESILIENCE={
+    'stripe': {'minimum_calls': 2, 'open_seconds': 60},
+    'smtp': {'minimum_calls': 1, 'open_seconds': 60, 'max_concurrent': 1, 'acquire_timeout': 0},
+})
+class ResilienceTests(TestCase):
+    def setUp(self):
+        resilience.reset()
+        self.addCleanup(resilience.reset)
+
+    @mock.patch('accounts.stripe_gateway.StripeGateway._fetch_subscription',
+                side_effect=stripe.APIConnectionError('timed out'))
+    def test_stripe_outage_opens_breaker_and_falls_back_to_local_row(self, fetch):
+        user = User.objects.create_user(email='member@example.com', password='pass')
+        Subscription.objects.create(user=user, is_active=True, stripe_subscription_id='sub_123')
+        for _ in range(3):
+            invalidate_entitlement(user=user)
+            self.assertTrue(has_entitlement(get_subscription(User.objects.get(pk=user.pk))))
+        # 2回失敗した時点で open になり、3回目は Stripe を呼ばない
+        self.assertEqual(fetch.call_count, 2)
+        status = resilience.resilience_status()['stripe']['breaker']
+        self.assertEqual((status['state'], status['rejected']), ('open', 1))
+
+    def test_half_open_probe_closes_or_reopens(self):
+        breaker = resilience.CircuitBreaker('test', 0.5, 2, 60, 30, 1)
+        breaker.record(False, now=100)
+        breaker.record(False, now=101)
+        self.assertFalse(breaker.allow(now=110))
+        self.assertTrue(breaker.allow(now=131))
+        self.assertFalse(breaker.allow(now=131))  # 試行は1件だけ
+        breaker.record(False, now=132)
+        self.assertEqual(breaker.state, resilience.OPEN)
+        self.assertTrue(breaker.allow(now=163))
+        breaker.record(True, now=164)
+        self.assertEqual(breaker.state, resilience.CLOSED)
+
+    def test_smtp_outage_defers_rest_of_batch_without_using_attempts(self):
+        for i in range(3):
+            enqueue_email('件名', '本文', [f'guest{i}@example.com'])
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=ConnectionRefusedError('refused')):
+            self.assertEqual(deliver_batch(), {'sent': 0, 'retry': 1, 'dead': 0, 'deferred': 2})
+        self.assertEqual(sorted(OutboxEmail.objects.values_list('attempts', flat=True)), [0, 0, 1])
+        self.assertFalse(OutboxEmail.objects.exclude(claim_token='').exists())
+        self.assertEqual(resilience.resilience_status()['smtp']['breaker']['state'], 'open')
+
+    def test_bulkhead_rejects_when_full(self):
+        with resilience.guard('smtp'):
+            with self.assertRaises(resilience.DependencyUnavailable):
+                with resilience.guard('smtp'):
+                    pass
+        self.assertEqual(resilience.resilience_status()['smtp']['bulkhead']['rejected'], 1)
+        self.assertEqual(resilience.resilience_status()['smtp']['breaker']['state'], 'closed')
+
+
+@override_settings(RATE_LIMIT_ENABLED=False)
+class IdempotencyKeyTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='member@example.com', password='pass')
+        Subscription.objects.create(user=self.user, is_active=True)
+        self.shop = Shop.objects.create(name='テスト店', address='名古屋市', seat_count=10, user=self.user)
+        self.client.force_login(self.user)
+        self.url = reverse('accounts:cancel_reservation')
+
+    def _reservation(self):
+        return History.objects.create(shop=self.shop, user=self.user,
+                                      date=date.today() + timedelta(days=3), number_of_people=2)
+
+    def _cancel(self, reservation_id, key):
+        return self.client.post(self.url, {'reservation_id': reservation_id},
+                                HTTP_IDEMPOTENCY_KEY=key, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def test_retry_replays_first_response(self):
+        reservation = self._reservation()
+        first = self._cancel(reservation.pk, 'key-1')
+        retry = self._cancel(reservation.pk, 'key-1')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+        # キーが変われば新しいリクエストとして処理される（予約は削除済み）
+        self.assertEqual(self._cancel(reservation.pk, 'key-2').status_code, 404)
+
+    def test_same_key_with_different_body_is_rejected(self):
+        self._cancel(self._reservation().pk, 'key-1')
+        self.assertEqual(self._cancel(self._reservation().pk, 'key-1').status_code, 422)
+
+
+@override_settings(RATE_LIMIT_ENABLED=False)
+class ConcurrentIdempotencyKeyTests(TransactionTestCase):
+    """同じキーの予約が別々のワーカーに同時に届いても、予約は1件で応答は同じになること"""
+
+    THREADS = 8
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='member@example.com', password='pass')
+        Subscription.objects.create(user=self.user, is_active=True, stripe_subscription_id='sub_1',
+                                    last_synced_at=timezone.now())
+        self.shop = Shop.objects.create(name='テスト店', address='名古屋市', seat_count=10, user=self.user)
+        client = Client()
+        client.force_login(self.user)
+        self.cookies = client.cookies
+        self.data = {'shop_id': self.shop.pk, 'date': (date.today() + timedelta(days=3)).isoformat(), 'people': 2}
+
+    def _post(self, barrier, responses):
+        client = Client()
+        client.cookies = self.cookies
+        barrier.wait()
+        try:
+            # SQLite はロック待ちでエラーになることがあるため、その場合のみ同じキーで再送する
+            for _ in range(200):
+                try:
+                    response = client.post(reverse('shops:create_reservation'), self.data,
+                                           HTTP_IDEMPOTENCY_KEY='reserve-1', HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+                except OperationalError:
+                    time.sleep(0.01)
+                    continue
+                responses.append(response)
+                return
+        finally:
+            close_old_connections()
+            connection.close()
+
+    def test_parallel_duplicates_are_processed_once(self):
+        barrier = threading.Barrier(self.THREADS)
+        responses = []
+        threads = [threading.Thread(target=self._post, args=(barrier, responses)) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(responses), self.THREADS)
+        self.assertEqual(History.objects.filter(shop=self.shop).count(), 1)
+        self.assertEqual({(r.status_code, r.content) for r in responses}, {(200, responses[0].content)})
+        self.assertTrue(json.loads(responses[0].content)['success'])
+        # 処理したワーカーもコミット後のロック待ちで再送することがあるので、再生された応答は THREADS - 1 件以上
+        self.assertGreaterEqual(sum(r.has_header('Idempotent-Replayed') for r in responses), self.THREADS - 1)
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+
+class EntitlementTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='member@example.com', password='pass')
+        Subscription.objects.create(user=self.user, is_active=True, stripe_subscription_id='sub_123')
+
+    def _lookup(self):
+        # リクエストごとにユーザーを読み直す想定
+        return get_subscription(User.objects.get(pk=self.user.pk))
+
+    @mock.patch('accounts.stripe_gateway.StripeGateway._fetch_subscription')
+    def test_stripe_is_called_only_when_stale(self, fetch):
+        def subscription(status):
+            return stripe.Subscription.construct_from({'id': 'sub_123', 'customer': 'cus_123', 'status': status}, 'sk')
+
+        fetch.return_value = subscription('active')
+        self.assertTrue(has_entitlement(self._lookup()))
+        self.assertTrue(has_entitlement(self._lookup()))
+        self.assertEqual(fetch.call_count, 1)
+
+        invalidate_entitlement(stripe_customer_id='cus_123')
+        fetch.return_value = subscription('canceled')
+        self.assertFalse(has_entitlement(self._lookup()))
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_expired_end_date_is_not_entitled(self):
+        subscription = Subscription.objects.get(user=self.user)
+        subscription.end_date = date.today() - timedelta(days=1)
+        self.assertFalse(has_entitlement(subscription))
+
+
+class _FixtureStripeHandler(BaseHTTPRequestHandler):
+    """Stripe の一覧APIを記録済みのデータで返すローカルサーバー（starting_after でページ送り）"""
+    subscriptions = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        limit = int(params.get('limit', ['10'])[0])
+        start = 0
+        if 'starting_after' in params:
+            start = [s['id'] for s in self.subscriptions].index(params['starting_after'][0]) + 1
+        page = self.subscriptions[start:start + limit]
+        body = json.dumps({'object': 'list', 'url': url.path, 'data': page,
+                           'has_more': start + limit < len(self.subscriptions)}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ReconcileSubscriptionsTests(TestCase):
+    def setUp(self):
+        yesterday = int((timezone.now() - timedelta(days=1)).timestamp())
+        _FixtureStripeHandler.subscriptions = [
+            {'id': 'sub_a', 'object': 'subscription', 'customer': 'cus_a', 'status': 'canceled',
+             'cancel_at_period_end': False, 'current_period_end': None, 'canceled_at': yesterday},
+            {'id': 'sub_b', 'object': 'subscription', 'customer': 'cus_b', 'status': 'active',
+             'cancel_at_period_end': False, 'current_period_end': None, 'canceled_at': None},
+            {'id': 'sub_x', 'object': 'subscription', 'customer': 'cus_x', 'status': 'active',
+             'cancel_at_period_end': False, 'current_period_end': None, 'canceled_at': None},
+        ]
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _FixtureStripeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.enterContext(override_settings(STRIPE_API_BASE=f'http://127.0.0.1:{server.server_port}'))
+
+        def member(email, **fields):
+            user = User.objects.create_user(email=email, password='pass')
+            return Subscription.objects.create(user=user, **fields)
+
+        self.canceled = member('a@example.com', is_active=True, stripe_subscription_id='sub_a')
+        self.by_customer = member('b@example.com', is_active=False, stripe_customer_id='cus_b')
+        self.ended = member('c@example.com', is_active=True, stripe_subscription_id='sub_c',
+                            end_date=date.today() - timedelta(days=2))
+
+    def test_pages_through_stripe_and_applies_changes(self):
+        calls = stripe_gateway_stats().get('subscription.list', {}).get('calls', 0)
+        result = reconcile_subscriptions(iter_stripe_subscriptions(page_size=2))
+        # 2ページとも gateway の呼び出しとして数えられる
+        self.assertEqual(stripe_gateway_stats()['subscription.list']['calls'] - calls, 2)
+        self.assertEqual(result, {'seen': 3, 'matched': 2, 'updated': 2, 'skipped': 0, 'expired': 1})
+
+        self.canceled.refresh_from_db()
+        self.assertFalse(self.canceled.is_active)
+        self.assertIsNotNone(self.canceled.end_date)
+        self.assertIsNotNone(self.canceled.last_synced_at)
+        self.by_customer.refresh_from_db()
+        self.assertEqual((self.by_customer.stripe_subscription_id, self.by_customer.is_active), ('sub_b', True))
+        self.ended.refresh_from_db()
+        self.assertFalse(self.ended.is_active)
+
+    def test_rows_updated_during_the_run_are_left_alone(self):
+        # 一覧を読んでいる間に Webhook で新しい状態が反映された
+        def listing():
+            for s in iter_stripe_subscriptions(page_size=2):
+                if s['id'] == 'sub_a':
+                    Subscription.objects.filter(pk=self.canceled.pk).update(stripe_event_at=timezone.now())
+                yield s
+
+        result = reconcile_subscriptions(listing())
+        self.assertEqual((result['updated'], result['skipped']), (1, 1))
+        self.canceled.refresh_from_db()
+        self.assertTrue(self.canceled.is_active)
+        self.assertIsNone(self.canceled.last_synced_at)
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class StripeEventTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(email='member@example.com', password='pass')
+        self.subscription = Subscription.objects.create(user=user, stripe_subscription_id='sub_1')
+        self.url = reverse('accounts:stripe_webhook')
+
+    def _deliver(self, event_id, created, status, signed=True):
+        event = {'id': event_id, 'type': 'customer.subscription.updated', 'created': created,
+                 'data': {'object': {'id': 'sub_1', 'customer': 'cus_1', 'status': status}}}
+        payload = json.dumps(event)
+        headers = {}
+        if signed:
+            timestamp = int(time.time())
+            signature = stripe.WebhookSignature._compute_signature(f'{timestamp}.{payload}', 'whsec_test')
+            headers['HTTP_STRIPE_SIGNATURE'] = f't={timestamp},v1={signature}'
+        return self.client.post(self.url, payload, content_type='application/json', **headers)
+
+    def test_unsigned_events_are_rejected(self):
+        future = int(timezone.now().timestamp()) + 60 * 60 * 24 * 365
+        self.assertEqual(self._deliver('evt_forged', future, 'active', signed=False).status_code, 400)
+        with override_settings(STRIPE_WEBHOOK_SECRET=''), self.assertLogs('accounts.webhooks', 'ERROR'):
+            self.assertEqual(self._deliver('evt_forged', future, 'active', signed=False).status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    def test_duplicates_and_stale_events_are_skipped(self):
+        now = int(timezone.now().timestamp())
+        self.assertEqual(self._deliver('evt_new', now, 'active').status_code, 200)
+        self.assertEqual(self._deliver('evt_new', now, 'active').status_code, 200)
+        # 反映前は何も変わらない
+        self.subscription.refresh_from_db()
+        self.assertFalse(self.subscription.is_active)
+        self.assertEqual(process_pending(), {'processed': 1})
+
+        # 遅れて届いた古いイベントは反映しない
+        self._deliver('evt_old', now - 60, 'canceled')
+        self.assertEqual(process_pending(), {'skipped': 1})
+        self.subscription.refresh_from_db()
+        self.assertTrue(self.subscription.is_active)
+        self.assertEqual(StripeEvent.objects.count(), 2)
+        self.assertEqual(stripe_event_stats()['lag_seconds'], 0)
+
+    def test_failed_event_backs_off_and_holds_later_events(self):
+        now = int(timezone.now().timestamp())
+        self._deliver('evt_first', now - 60, 'active')
+        self._deliver('evt_second', now, 'canceled')
+        broken = mock.Mock(side_effect=RuntimeError('db down'))
+        with mock.patch.dict(HANDLERS, {'customer.subscription.updated': broken}), \
+                self.assertLogs('accounts.stripe_events', 'WARNING'):
+            # 後のイベントは先のイベントが残っている間は取り出さない
+            self.assertEqual(process_pending(), {'pending': 1})
+            # 再試行時刻までは取り直さない
+            self.assertEqual(process_pending(), {})
+        first = StripeEvent.objects.get(event_id='evt_first')
+        self.assertEqual(first.attempts, 1)
+        self.assertGreater(first.next_attempt_at, timezone.now())
+
+        later = timezone.now() + timedelta(hours=2)
+        self.assertEqual(process_pending(now=later), {'processed': 1})
+        self.assertEqual(process_pending(now=later), {'processed': 1})
+        self.subscription.refresh_from_db()
+        self.assertFalse(self.subscription.is_active)
+        self.assertEqual(self.subscription.stripe_event_at.timestamp(), now)
+
+    @override_settings(STRIPE_EVENT_MAX_ATTEMPTS=1)
+    def test_failed_event_blocks_its_subscription_until_requeued(self):
+        now = int(timezone.now().timestamp())
+        self._deliver('evt_first', now - 60, 'active')
+        self._deliver('evt_second', now, 'canceled')
+        broken = mock.Mock(side_effect=RuntimeError('db down'))
+        with mock.patch.dict(HANDLERS, {'customer.subscription.updated': broken}), \
+                self.assertLogs('accounts.stripe_events', 'ERROR'):
+            self.assertEqual(process_pending(), {'failed': 1})
+        self.assertEqual(process_pending(), {})
+
+        self.assertEqual(requeue_failed(), 1)
+        self.assertEqual(process_pending(), {'processed': 1})
+        self.assertEqual(process_pending(), {'processed': 1})
+        self.subscription.refresh_from_db()
+        self.assertFalse(self.subscription.is_active)
+
+
+@override_settings(STRIPE_GATEWAY='accounts.stripe_gateway.FakeStripeGateway', RATE_LIMIT_ENABLED=False)
+class FakeStripeGatewayTests(TestCase):
+    """通信せずに 決済 -> 有効化 -> ポータル -> 解約予約 の流れが通ること"""
+
+    def test_payment_flow_without_network(self):
+        user = User.objects.create_user(email='member@example.com', password='pass')
+        self.client.force_login(user)
+
+        checkout = self.client.get(reverse('accounts:pay_with_stripe'))
+        self.assertEqual(checkout.status_code, 302)
+        success_url = urlparse(checkout['Location'])
+        self.client.get(f'{success_url.path}?{success_url.query}')
+        subscription = Subscription.objects.get(user=user)
+        self.assertTrue(subscription.stripe_subscription_id.startswith('sub_fake_'))
+
+        # Webhook 相当のイベントを worker が反映して有効になる
+        self.assertEqual(process_pending(), {'processed': 1})
+        subscription.refresh_from_db()
+        self.assertTrue(has_entitlement(subscription))
+
+        portal = self.client.get(reverse('accounts:subscription_portal'))
+        self.assertTrue(portal['Location'].endswith(reverse('accounts:mypage')))
+
+        self.client.post(reverse('accounts:cancel_subscription'))
+        subscription.refresh_from_db()
+        self.assertIsNotNone(subscription.end_date)
+        self.assertIn('subscription.update', stripe_gateway_stats())
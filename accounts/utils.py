@@ -1,18 +1,32 @@
 from __future__ import annotations
 
 from datetime import datetime, timezone as dt_timezone
-import stripe
-from django.conf import settings
 from django.utils import timezone as dj_timezone
 from .models import Subscription
+from .stripe_gateway import get_gateway
 
-# Ensure API key (safe to set multiple times)
-stripe.api_key = settings.STRIPE_API_SECRET_KEY
+
+def stripe_subscription_state(s, current_end_date, today):
+    """Return (end_date, is_active) for a Stripe Subscription object/dict.
+    - end_date: period end when cancel_at_period_end, cancel date when canceled, else unchanged.
+    - is_active: True only when status is active and end_date has not passed.
+    """
+    get = s.get if isinstance(s, dict) else (lambda name, default=None: getattr(s, name, default))
+    status = get('status')  # active, canceled, trialing, past_due, etc.
+    current_period_end = get('current_period_end')
+    canceled_at = get('canceled_at')
+
+    end_date = current_end_date
+    if bool(get('cancel_at_period_end', False)) and current_period_end:
+        end_date = datetime.fromtimestamp(current_period_end, tz=dt_timezone.utc).date()
+    if status == 'canceled' and canceled_at:
+        end_date = datetime.fromtimestamp(canceled_at, tz=dt_timezone.utc).date()
+    return end_date, (status == 'active') and not (end_date and end_date < today)
 
 
 def sync_subscription_from_stripe(user) -> None:
     """Fetch latest Stripe Subscription and sync local Subscription model.
-    - Updates: stripe_customer_id, end_date, is_active
+    - Updates: stripe_customer_id, end_date, is_active, last_synced_at
     - Handles cancel_at_period_end and canceled status.
     - No-op on errors.
     """
@@ -28,44 +42,33 @@ def sync_subscription_from_stripe(user) -> None:
             return
 
         try:
-            s = stripe.Subscription.retrieve(sub_id)
+            s = get_gateway().retrieve_subscription(sub_id)
         except Exception:
             return
 
-        status = getattr(s, 'status', None)  # active, canceled, trialing, past_due, etc.
-        cancel_at_period_end = bool(getattr(s, 'cancel_at_period_end', False))
-        current_period_end = getattr(s, 'current_period_end', None)
-        canceled_at = getattr(s, 'canceled_at', None)
         customer_id = getattr(s, 'customer', None)
 
-        updated_fields = []
+        # 取得できたので同期時刻を更新（利用資格の判定はしばらくこの行を使う）
+        sub_model.last_synced_at = dj_timezone.now()
+        updated_fields = ['last_synced_at']
 
         # customer_id補完
         if customer_id and customer_id != sub_model.stripe_customer_id:
             sub_model.stripe_customer_id = customer_id
             updated_fields.append('stripe_customer_id')
 
-        # 終了日の決定
-        end_date = sub_model.end_date
-        if cancel_at_period_end and current_period_end:
-            end_date = datetime.fromtimestamp(current_period_end, tz=dt_timezone.utc).date()
-        if status == 'canceled' and canceled_at:
-            end_date = datetime.fromtimestamp(canceled_at, tz=dt_timezone.utc).date()
+        # 終了日の決定 / 有効/無効: StripeのstatusがactiveのときのみTrue
+        end_date, new_is_active = stripe_subscription_state(s, sub_model.end_date, dj_timezone.localdate())
 
         if end_date != sub_model.end_date:
             sub_model.end_date = end_date
             updated_fields.append('end_date')
 
-        # 有効/無効: StripeのstatusがactiveのときのみTrue
-        today = dj_timezone.localdate()
-        new_is_active = (status == 'active') and not (end_date and end_date < today)
-
         if new_is_active != sub_model.is_active:
             sub_model.is_active = new_is_active
             updated_fields.append('is_active')
 
-        if updated_fields:
-            sub_model.save(update_fields=updated_fields)
+        sub_model.save(update_fields=updated_fields)
     except Exception:
         # Fail silently
         return
@@ -1,6 +1,8 @@
 from django.shortcuts import render, redirect
 from .models import User, Subscription
 from shops.models import Favorite, Review, History
+from shops.inventory import release_seats
+from shops.similarity import recommended_shops_for_user
 from django.views.generic import ListView, TemplateView, View
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.forms import AuthenticationForm
@@ -14,13 +16,17 @@ from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_protect, csrf_exempt
 from django.http import JsonResponse
 from django.conf import settings
+from django.db import transaction
 import stripe
 from django.utils.decorators import method_decorator
 import urllib.parse
 from datetime import datetime, timezone, date
-from .utils import sync_subscription_from_stripe
+from .entitlements import get_subscription
+from .stripe_gateway import get_gateway
+from nagoyameshi.resilience import DependencyUnavailable
+from .decorators import idempotent
 from django.views.generic import TemplateView
-from .activation import validate_activation_token, generate_activation_token, send_activation_mail
+from .activation import validate_activation_token, generate_activation_token, enqueue_activation_mail
 
 # ユーザー一覧
 class AccountListView(ListView):
@@ -117,21 +123,19 @@ class RegisterView(TemplateView):
         
         # ユーザー作成 (メール認証待ち: is_active=False)
         try:
-            user = User.objects.create_user(
-                email=email,
-                password=password
-            )
-            # 一旦無効
-            user.is_active = False
-            user.save()
+            # ユーザー作成と有効化メールの送信待ち登録を同じトランザクションで（送信はワーカー）
+            with transaction.atomic():
+                user = User.objects.create_user(
+                    email=email,
+                    password=password
+                )
+                # 一旦無効
+                user.is_active = False
+                user.save()
 
-            # アクティベーショントークン生成 & メール送信
-            from .activation import generate_activation_token, send_activation_mail
-            token = generate_activation_token(user)
-            try:
-                send_activation_mail(request, user, token)
-            except Exception:
-                messages.warning(request, '確認メールの送信に失敗しました。後でもう一度試してください。', extra_tags='auth')
+                # アクティベーショントークン生成 & メール送信待ちに登録
+                token = generate_activation_token(user)
+                enqueue_activation_mail(request, user, token)
 
             # ペンディング画面へ
             request.session['pending_activation_email'] = user.email
@@ -148,24 +152,15 @@ class MyPageView(LoginRequiredMixin, TemplateView):
         context = super().get_context_data(**kwargs)
         user = self.request.user
 
-        # 表示前に同期（解約期日経過時に自動で無効化/終了日反映）
-        try:
-            sync_subscription_from_stripe(user)
-        except Exception:
-            pass
-
-        # サブスクリプション情報の取得
-        try:
-            subscription = user.subscription
-        except Subscription.DoesNotExist:
-            subscription = None
+        # サブスクリプション情報の取得（前回の同期から時間が経っていれば Stripe と同期して終了日/有効状態を反映）
+        subscription = get_subscription(user)
 
         # 顧客ID未保存で、CheckoutセッションIDがある場合はStripeから補完（表示直前に一度だけ試行）
         if subscription and not getattr(subscription, 'stripe_customer_id', None) and getattr(subscription, 'stripe_id', None):
             try:
                 sid = str(subscription.stripe_id)
                 if sid.startswith('cs_'):
-                    cs = stripe.checkout.Session.retrieve(sid)
+                    cs = get_gateway().retrieve_checkout_session(sid)
                     cust = getattr(cs, 'customer', None)
                     subid = getattr(cs, 'subscription', None)
                     updated = False
@@ -209,6 +204,8 @@ class MyPageView(LoginRequiredMixin, TemplateView):
             'reservations': reservations,
             'reservation_count': reservation_count,
             'today': today,
+            # お気に入り/予約した店舗に似たお店（事前計算済みの類似店舗から）
+            'recommended_shops': recommended_shops_for_user(user),
         })
         # ここでのみStripe関連のエラーを表示
         err = self.request.GET.get('err')
@@ -313,7 +310,7 @@ def update_subscription(request):
                     'message': '有効化はStripeでのご契約完了後に自動で行われます。マイページの「プレミアム会員になる」から決済を完了してください。'
                 }, status=403)
             try:
-                s = stripe.Subscription.retrieve(subscription.stripe_subscription_id)
+                s = get_gateway().retrieve_subscription(subscription.stripe_subscription_id)
                 status = getattr(s, 'status', None)
             except Exception:
                 status = None
@@ -365,7 +362,7 @@ def cancel_subscription(request):
             return redirect('accounts:mypage')
 
         # Stripe上のサブスクを取得
-        sub = stripe.Subscription.retrieve(sub_id)
+        sub = get_gateway().retrieve_subscription(sub_id)
 
         # すでに解約予約済みかチェック
         if getattr(sub, 'cancel_at_period_end', False):
@@ -377,7 +374,7 @@ def cancel_subscription(request):
             return redirect('accounts:mypage')
 
         # 今期末で解約に更新
-        sub = stripe.Subscription.modify(sub_id, cancel_at_period_end=True)
+        sub = get_gateway().cancel_subscription_at_period_end(sub_id)
 
         # ローカルに終了日を反映
         period_end_ts = getattr(sub, 'current_period_end', None)
@@ -389,6 +386,9 @@ def cancel_subscription(request):
         messages.success(request, '解約を受け付けました。現在の支払期間の終了日までご利用いただけます。')
         return redirect('accounts:mypage')
 
+    except DependencyUnavailable:
+        messages.error(request, '決済サービスに接続できないため解約を受け付けられませんでした。しばらくしてからお試しください。')
+        return redirect('accounts:mypage')
     except stripe.error.StripeError as e:
         messages.error(request, f"解約に失敗しました: {getattr(e, 'user_message', None) or str(e)}")
         return redirect('accounts:mypage')
@@ -407,9 +407,6 @@ def logout_view(request):
     return redirect('shops:shop_list')
 
 
-# StripeのAPIキー設定
-stripe.api_key = settings.STRIPE_API_SECRET_KEY
-
 # 決済成功ページ
 class PaySuccessView(TemplateView):
     template_name = 'accounts/pay_success.html'
@@ -428,7 +425,7 @@ class PaySuccessView(TemplateView):
         
         try:
             # stripeのチェックアウトセッションを取得
-            session = stripe.checkout.Session.retrieve(session_id)
+            session = get_gateway().retrieve_checkout_session(session_id, fresh=True)
 
             # 支払いが成功してる場合はDB更新
             if session.payment_status == 'paid' and self.request.user.is_authenticated:
@@ -474,7 +471,7 @@ class StripeBillingPortalView(View):
                 try:
                     sid = str(subscription.stripe_id)
                     if sid.startswith('cs_'):
-                        cs = stripe.checkout.Session.retrieve(sid)
+                        cs = get_gateway().retrieve_checkout_session(sid)
                         cust = getattr(cs, 'customer', None)
                         subid = getattr(cs, 'subscription', None)
                         updated = False
@@ -492,7 +489,7 @@ class StripeBillingPortalView(View):
             # 追加フォールバック: subscription_id から顧客IDを補完
             if not getattr(subscription, 'stripe_customer_id', None) and getattr(subscription, 'stripe_subscription_id', None):
                 try:
-                    sub = stripe.Subscription.retrieve(subscription.stripe_subscription_id)
+                    sub = get_gateway().retrieve_subscription(subscription.stripe_subscription_id)
                     cust = getattr(sub, 'customer', None)
                     if cust:
                         subscription.stripe_customer_id = cust
@@ -506,12 +503,12 @@ class StripeBillingPortalView(View):
 
             # 顧客IDの妥当性チェック（削除済み/環境不一致の検知）
             try:
-                _ = stripe.Customer.retrieve(subscription.stripe_customer_id)
+                _ = get_gateway().retrieve_customer(subscription.stripe_customer_id)
             except stripe.error.InvalidRequestError as e:
                 # 既存IDが無効。subscription_idから再補完を試みる
                 try:
                     if getattr(subscription, 'stripe_subscription_id', None):
-                        sub = stripe.Subscription.retrieve(subscription.stripe_subscription_id)
+                        sub = get_gateway().retrieve_subscription(subscription.stripe_subscription_id)
                         cust2 = getattr(sub, 'customer', None)
                         if cust2:
                             subscription.stripe_customer_id = cust2
@@ -540,7 +537,7 @@ class StripeBillingPortalView(View):
                 config_id = getattr(settings, 'STRIPE_BILLING_PORTAL_CONFIGURATION_ID', None)
                 if config_id:
                     kwargs['configuration'] = config_id
-                portal = stripe.billing_portal.Session.create(**kwargs)
+                portal = get_gateway().create_billing_portal_session(**kwargs)
             except stripe.error.StripeError as e:
                 reason = getattr(e, 'user_message', None) or str(e)
                 qs = '?err=portal_failed&reason=' + urllib.parse.quote(reason)
@@ -569,7 +566,7 @@ class PayWithStripeView(View):
         try:
             if price_id:
                 # まずは既存のPriceで作成を試す
-                checkout_session = stripe.checkout.Session.create(
+                checkout_session = get_gateway().create_checkout_session(
                     mode='subscription',
                     line_items=[{'price': price_id, 'quantity': 1}],
                     success_url=success_url,
@@ -581,7 +578,7 @@ class PayWithStripeView(View):
 
         if checkout_session is None:
             # フォールバック: その場でJPY 300/月を組み立て
-            checkout_session = stripe.checkout.Session.create(
+            checkout_session = get_gateway().create_checkout_session(
                 mode='subscription',
                 line_items=[{
                     'price_data': {
@@ -670,7 +667,7 @@ class ActivationResendView(TemplateView):
                 messages.info(request, '既に有効化済みです。', extra_tags='auth')
                 return redirect('accounts:login')
             token = generate_activation_token(user)
-            send_activation_mail(request, user, token)
+            enqueue_activation_mail(request, user, token)
             request.session['pending_activation_email'] = user.email
             messages.success(request, '確認メールを再送しました。', extra_tags='auth')
             return redirect('accounts:activation_pending')
@@ -751,6 +748,7 @@ class SimplePasswordResetConfirmView(TemplateView):
 
 @login_required
 @require_POST
+@idempotent
 def cancel_reservation(request):
     """予約キャンセル"""
     try:
@@ -788,10 +786,14 @@ def cancel_reservation(request):
                 'error': '過去の予約はキャンセルできません。'
             }, status=400)
         
-        # 予約のキャンセル（削除）
+        # 予約のキャンセル（削除）と残席の戻しを同じトランザクションで
         shop_name = reservation.shop.name
         reserved_date = reservation.date
-        reservation.delete()
+        with transaction.atomic():
+            # 同時にキャンセルされた場合に二重に戻さないよう、実際に削除できたときだけ戻す
+            deleted, _ = History.objects.filter(pk=reservation.pk).delete()
+            if deleted:
+                release_seats(reservation.shop_id, reserved_date, reservation.number_of_people)
         
         return JsonResponse({
             'success': True, 
@@ -11,11 +11,21 @@ from django.http import HttpResponse, JsonResponse
 from django.views.decorators.http import require_POST
 from django.core.cache import cache
 import csv
+import os
 from datetime import datetime, timedelta
 from django.utils import timezone
 
+from accounts.entitlements import entitlement_cache_stats
 from accounts.models import User
+from accounts.stripe_events import stripe_event_stats
+from accounts.stripe_gateway import stripe_gateway_stats
 from shops.models import Shop, Category, ShopCategory
+from shops.catalog import CATALOG, POPULARITY, get_version
+from shops.normalize import normalize_text, normalize_phone, is_phone_like
+from shops.search_cache import search_cache_stats
+from shops.stats import get_shop_stats
+from nagoyameshi.ratelimit import rate_limit_stats
+from nagoyameshi.resilience import resilience_status
 from .models import CompanyInfo
 
 
@@ -183,9 +193,13 @@ class ShopListView(AdminRequiredMixin, ListView):
         queryset = Shop.objects.select_related('user').prefetch_related(
             'categories__category'
         )
-        search = self.request.GET.get('search')
+        search = normalize_text(self.request.GET.get('search'))
         if search:
-            queryset = queryset.filter(name__icontains=search)
+            # 正規化カラムに対する前方一致（かな/全角半角/大文字小文字の違いを吸収し、インデックスを使う）
+            condition = Q(name_normalized__startswith=search)
+            if is_phone_like(search):
+                condition |= Q(phone_digits__startswith=normalize_phone(search))
+            queryset = queryset.filter(condition)
         return queryset.order_by('-id')
 
 
@@ -271,15 +285,19 @@ class ShopDetailView(AdminRequiredMixin, DetailView):
     template_name = 'admin_panel/shop_detail.html'
     context_object_name = 'shop'
     
+    def get_queryset(self):
+        return Shop.objects.select_related('user', 'stats')
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        shop = self.get_object()
+        shop = self.object
         
-        # 店舗の統計情報
-        context['total_reviews'] = shop.reviews.count()
-        context['avg_rating'] = shop.reviews.aggregate(avg_rating=Avg('rating'))['avg_rating'] or 0
+        # 店舗の統計情報（レビュー/お気に入りは集計テーブルから）
+        stats = get_shop_stats(shop)
+        context['total_reviews'] = stats.review_count
+        context['avg_rating'] = stats.avg_rating
         context['total_reservations'] = shop.histories.count()
-        context['total_favorites'] = shop.favorites.count()
+        context['total_favorites'] = stats.favorite_count
         
         # 最近のレビュー
         context['recent_reviews'] = shop.reviews.select_related('user').order_by('-created_at')[:5]
@@ -566,7 +584,7 @@ class CategoryShopsView(AdminRequiredMixin, ListView):
         shop_categories = ShopCategory.objects.filter(category_id=category_id)
         shop_ids = shop_categories.values_list('shop_id', flat=True)
         
-        queryset = Shop.objects.filter(id__in=shop_ids).select_related('user').prefetch_related('images')
+        queryset = Shop.objects.filter(id__in=shop_ids).select_related('user', 'cover_image')
         
         # 検索機能
         search = self.request.GET.get('search')
@@ -637,3 +655,20 @@ class CategoryDeleteView(AdminRequiredMixin, DeleteView):
     def delete(self, request, *args, **kwargs):
         messages.success(request, 'カテゴリを削除しました。')
         return super().delete(request, *args, **kwargs)
+
+
+@login_required
+@user_passes_test(lambda u: u.manager_flag)
+def ops_status(request):
+    """運用状況(JSON)。キャッシュ等の値はこの応答を返したワーカー単位（rate_limit の件数はホスト全体）
+    dependencies は外部サービスごとのサーキットブレーカーの状態とバルクヘッドの使用状況"""
+    return JsonResponse({
+        'pid': os.getpid(),
+        'catalog_versions': {name: get_version(name) for name in (CATALOG, POPULARITY)},
+        'search_cache': search_cache_stats(),
+        'rate_limit': rate_limit_stats(),
+        'entitlements': entitlement_cache_stats(),
+        'stripe_events': stripe_event_stats(),
+        'stripe_gateway': stripe_gateway_stats(),
+        'dependencies': resilience_status(),
+    })
@@ -0,0 +1,121 @@
+"""
+メディアファイル（アップロード画像）の保存と配信
+- HashedMediaStorage: 内容の SHA-256 をファイル名にして保存する。同じ内容のアップロードは1ファイルを共有する
+- MediaWhiteNoiseMiddleware: 静的ファイルに加えて MEDIA_URL 以下も WhiteNoise で配信する
+  ハッシュ名のファイルは内容が変わらないため Cache-Control: immutable を付ける
+- MEDIA_SERVE_MODE = 'x-accel' の場合は X-Accel-Redirect を返し、ファイル本体は nginx に送らせる
+"""
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.http import HttpResponse
+from whitenoise.base import WhiteNoise
+from whitenoise.middleware import WhiteNoiseMiddleware
+from whitenoise.responders import MissingFileError
+
+HASH_LENGTH = 32
+HASHED_NAME_RE = re.compile(r'^[0-9a-f]{%d}\.[0-9a-z]+$' % HASH_LENGTH)
+IMMUTABLE_CACHE_CONTROL = f'max-age={WhiteNoise.FOREVER}, public, immutable'
+
+
+def content_hash(content):
+    hasher = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks():
+        hasher.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return hasher.hexdigest()[:HASH_LENGTH]
+
+
+def is_hashed_name(name):
+    return bool(HASHED_NAME_RE.match(posixpath.basename(name)))
+
+
+class HashedMediaStorage(FileSystemStorage):
+    """ファイル名を内容のハッシュにする FileSystemStorage。
+    保存先のディレクトリ(upload_to)と拡張子は元の名前のものを使う。
+    """
+
+    def hashed_name(self, name, content):
+        directory, basename = posixpath.split(name.replace('\\', '/'))
+        ext = os.path.splitext(basename)[1].lower()
+        return posixpath.join(directory, content_hash(content) + ext)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.hashed_name(name, content)
+        # 同じ内容のファイルが既にあればそれを使う
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length=max_length)
+
+
+class MediaWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    """WhiteNoiseMiddleware の代わりに使う。MEDIA_URL 以下のファイルも配信する。
+    起動後にアップロードされたファイルは初回アクセス時にファイル一覧へ追加する。
+    """
+
+    def __init__(self, get_response=None, settings=settings):
+        # 親クラスの初期化中に immutable_file_test が呼ばれるため先に設定する
+        self.media_mode = getattr(settings, 'MEDIA_SERVE_MODE', 'whitenoise')
+        self.media_prefix = settings.MEDIA_URL if settings.MEDIA_URL.startswith('/') else None
+        self.media_root = os.path.abspath(settings.MEDIA_ROOT) + os.path.sep
+        super().__init__(get_response, settings=settings)
+        if self.media_prefix and self.media_mode == 'whitenoise' and os.path.isdir(self.media_root):
+            self.add_files(self.media_root, prefix=self.media_prefix)
+
+    def __call__(self, request):
+        path = request.path_info
+        if not self.media_prefix or not path.startswith(self.media_prefix):
+            return super().__call__(request)
+        if not self.url_is_canonical(path):
+            return self.get_response(request)
+        if self.media_mode == 'x-accel':
+            return self.x_accel_response(path)
+        if self.media_mode != 'whitenoise':
+            return self.get_response(request)
+
+        media_file = self.files.get(path) or self.find_media_file(path)
+        if media_file is None:
+            return self.get_response(request)
+        try:
+            response = self.serve(media_file, request)
+        except FileNotFoundError:
+            # 起動後に削除されたファイル
+            self.files.pop(path, None)
+            return self.get_response(request)
+        self.files[path] = media_file
+        return response
+
+    def find_media_file(self, url):
+        path = os.path.join(self.media_root, url[len(self.media_prefix):])
+        if os.path.commonprefix((self.media_root, path)) != self.media_root or not os.path.isfile(path):
+            return None
+        try:
+            return self.get_static_file(path, url)
+        except MissingFileError:
+            return None
+
+    def x_accel_response(self, path):
+        name = path[len(self.media_prefix):]
+        response = HttpResponse(content_type=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+        response['X-Accel-Redirect'] = getattr(settings, 'MEDIA_X_ACCEL_PREFIX', '/protected-media/') + name
+        if is_hashed_name(name):
+            response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+    def immutable_file_test(self, path, url):
+        if self.media_prefix and url.startswith(self.media_prefix):
+            return is_hashed_name(url)
+        return super().immutable_file_test(path, url)
@@ -1,15 +1,15 @@
 """
 リクエスト数削減用ミドルウェア
 """
-from django.core.cache import cache
-from django.http import HttpResponse
-from django.conf import settings
-import time
+from django.http import HttpResponse, JsonResponse
+
+from .ratelimit import check_request
+
 
 class RequestOptimizationMiddleware:
     """
     リクエスト最適化ミドルウェア
-    - 重複リクエストの防止
+    - レート制限（トークンバケット。全ワーカー共通。nagoyameshi/ratelimit.py）
     - 静的ファイルのキャッシュ制御
     """
     
@@ -22,25 +22,21 @@ class RequestOptimizationMiddleware:
             response = self.get_response(request)
             response['Cache-Control'] = 'public, max-age=86400'  # 24時間キャッシュ
             return response
-            
-        # 開発環境では重複チェックを無効にする
-        if settings.DEBUG:
-            response = self.get_response(request)
-            return response
-            
-        # 重複リクエストの防止（認証後のユーザーのみ、本番環境のみ）
-        # hasattrでrequest.userの存在確認をしてからアクセス
-        if hasattr(request, 'user') and request.user.is_authenticated:
-            # POST/PUT/DELETEリクエストのみ重複チェック（GET/HEAD/OPTIONSは除外）
-            if request.method in ['POST', 'PUT', 'DELETE']:
-                cache_key = f"user_request_{request.user.id}_{request.path}_{request.method}"
-                last_request_time = cache.get(cache_key)
-                
-                current_time = time.time()
-                if last_request_time and (current_time - last_request_time) < 0.5:  # 0.5秒以内の重複防止
-                    return HttpResponse("Too many requests", status=429)
-                    
-                cache.set(cache_key, current_time, 2)  # 2秒間記録
-        
+
+        # レート制限（認証後に判定するため、ログイン中はユーザー単位・未ログインはIP単位）
+        decision = check_request(request)
+        if decision is not None and not decision.allowed:
+            return self.too_many_requests(request, decision)
+
         response = self.get_response(request)
         return response
+
+    def too_many_requests(self, request, decision):
+        message = 'リクエストが多すぎます。しばらくしてから再度お試しください。'
+        if request.headers.get('x-requested-with') == 'XMLHttpRequest' or request.path.startswith('/shops/api/'):
+            response = JsonResponse({'success': False, 'message': message, 'retry_after': decision.retry_after},
+                                    status=429)
+        else:
+            response = HttpResponse(message, status=429, content_type='text/plain; charset=utf-8')
+        response['Retry-After'] = str(decision.retry_after)
+        return response
@@ -0,0 +1,179 @@
+"""
+トークンバケット方式のレート制限（同じホストの全ワーカーで共有）
+- バケットはルートグループ（login / search / api / write）× 利用者（ログイン中はユーザーID、未ログインはIP）ごと
+- 容量(capacity)までのまとまったリクエストは通し、トークンは毎分 per_minute ずつ回復する
+- 状態はローカルの SQLite ファイル(RATE_LIMIT_DB)に置き、BEGIN IMMEDIATE で読み書きを1回の排他更新にする
+  （gunicorn の複数ワーカーから同時に更新しても数え漏れない）
+- 許可/制限の件数もグループごとに同じファイルへ数える（ops_status で確認できる）
+- SQLite が使えないときは制限せずに通す（レート制限の不具合でサイトを止めない）
+"""
+import math
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+
+# 既定値（settings.RATE_LIMITS で上書き）
+DEFAULT_LIMITS = {
+    'login': {'capacity': 10, 'per_minute': 5},
+    'search': {'capacity': 30, 'per_minute': 60},
+    'api': {'capacity': 60, 'per_minute': 120},
+    'write': {'capacity': 20, 'per_minute': 30},
+}
+
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+# (グループ, 対象メソッド, パスの正規表現) 上から順に最初に一致したもの
+ROUTES = [
+    ('login', ('POST',), re.compile(r'^/accounts/(login|register|password/reset|activate/resend)/')),
+    ('search', ('GET',), re.compile(r'^/shops/(search|api/suggest)/')),
+    ('api', ('GET', 'POST'), re.compile(r'^/shops/api/')),
+    ('write', WRITE_METHODS, re.compile(r'^/(accounts|shops|admin-panel)/')),
+]
+
+# Stripe からの Webhook は制限しない（再送は Stripe 側が行う）
+EXEMPT_PATHS = re.compile(r'^/accounts/stripe/webhook/')
+
+# 使われなくなったバケットを消す頻度（呼び出し回数に対する確率）と、消すまでの放置時間
+PRUNE_PROBABILITY = 0.001
+PRUNE_IDLE_SECONDS = 60 * 60
+
+_local = threading.local()
+_errors_lock = threading.Lock()
+_errors = 0
+
+
+@dataclass
+class Decision:
+    allowed: bool
+    remaining: int
+    retry_after: int = 0
+
+
+def enabled():
+    return getattr(settings, 'RATE_LIMIT_ENABLED', True)
+
+
+def limits():
+    configured = getattr(settings, 'RATE_LIMITS', None) or {}
+    return {**DEFAULT_LIMITS, **configured}
+
+
+def db_path():
+    return str(getattr(settings, 'RATE_LIMIT_DB', None)
+               or os.path.join(tempfile.gettempdir(), 'nagoyameshi_ratelimit.sqlite3'))
+
+
+def route_group(method, path):
+    if EXEMPT_PATHS.match(path):
+        return None
+    for group, methods, pattern in ROUTES:
+        if method in methods and pattern.match(path):
+            return group
+    return None
+
+
+def client_key(request, group):
+    """ログイン中はユーザー単位、未ログイン（とログイン試行）は IP 単位"""
+    user = getattr(request, 'user', None)
+    if group != 'login' and user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    ip = request.META.get('REMOTE_ADDR', '')
+    if getattr(settings, 'RATE_LIMIT_TRUST_FORWARDED', False):
+        # Heroku のルーターが付ける X-Forwarded-For の最後が接続元
+        forwarded = request.META.get('HTTP_X_FORWARDED_FOR', '')
+        if forwarded:
+            ip = forwarded.split(',')[-1].strip()
+    return f'ip:{ip}'
+
+
+def _connection():
+    path = db_path()
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'path', None) != path:
+        conn = sqlite3.connect(path, timeout=1.0, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # クラッシュでバケットが失われても困らないので、コミットごとの fsync はしない（WAL では整合性は保たれる）
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS buckets '
+                     '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS counters '
+                     '(grp TEXT NOT NULL, outcome TEXT NOT NULL, count INTEGER NOT NULL, '
+                     'PRIMARY KEY (grp, outcome))')
+        _local.conn, _local.path = conn, path
+    return conn
+
+
+def _count_error():
+    global _errors
+    with _errors_lock:
+        _errors += 1
+
+
+def consume(group, key, cost=1, now=None):
+    """group/key のバケットから cost 分のトークンを取る。取れなければ allowed=False と待ち秒数"""
+    config = limits()[group]
+    capacity = float(config['capacity'])
+    rate = config['per_minute'] / 60.0
+    now = time.time() if now is None else now
+    bucket = f'{group}:{key}'
+
+    conn = _connection()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (bucket,)).fetchone()
+        tokens = capacity if row is None else min(capacity, row[0] + max(now - row[1], 0) * rate)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        conn.execute('INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) '
+                     'ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                     (bucket, tokens, now))
+        conn.execute('INSERT INTO counters (grp, outcome, count) VALUES (?, ?, 1) '
+                     'ON CONFLICT(grp, outcome) DO UPDATE SET count = count + 1',
+                     (group, 'allowed' if allowed else 'limited'))
+        if random.random() < PRUNE_PROBABILITY:
+            conn.execute('DELETE FROM buckets WHERE updated < ?', (now - PRUNE_IDLE_SECONDS,))
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+
+    if allowed:
+        return Decision(True, int(tokens))
+    return Decision(False, 0, max(1, math.ceil((cost - tokens) / rate)) if rate > 0 else 60)
+
+
+def check_request(request):
+    """リクエストを制限するなら Decision(allowed=False) を返す。対象外・エラー時は None"""
+    if not enabled():
+        return None
+    group = route_group(request.method, request.path)
+    if group is None:
+        return None
+    try:
+        return consume(group, client_key(request, group))
+    except sqlite3.Error as e:
+        print(f'Rate limit check failed: {e}')
+        _count_error()
+        return None
+
+
+def rate_limit_stats():
+    """グループごとの許可/制限件数（ホスト全体）と、このワーカーでのエラー件数"""
+    stats = {group: {'allowed': 0, 'limited': 0} for group in limits()}
+    try:
+        for group, outcome, count in _connection().execute('SELECT grp, outcome, count FROM counters'):
+            stats.setdefault(group, {'allowed': 0, 'limited': 0})[outcome] = count
+    except sqlite3.Error as e:
+        print(f'Rate limit stats failed: {e}')
+    with _errors_lock:
+        errors = _errors
+    return {'groups': stats, 'errors': errors, 'limits': limits()}
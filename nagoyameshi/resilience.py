@@ -0,0 +1,237 @@
+"""
+外部サービス（Stripe / SMTP）呼び出しのサーキットブレーカーとバルクヘッド
+- サーキットブレーカー（ワーカーごと）: 直近 window_seconds の呼び出しのうち失敗の割合が failure_rate 以上
+  （かつ minimum_calls 回以上）になったら open にして、open_seconds の間は呼び出さずに DependencyUnavailable を投げる。
+  その後 half_open で half_open_calls 回だけ試し、成功すれば closed に戻す
+- バルクヘッド（同じホストの全ワーカー共通）: max_concurrent 個のロックファイルを枠として使い、
+  空きが無ければ acquire_timeout 秒だけ待って DependencyUnavailable を投げる（遅い依存先に全ワーカーが張り付かない）
+- 失敗として数えるのは依存先の障害（接続エラー・タイムアウト・5xx 等）だけ。入力誤りなどの 4xx は数えない
+- 呼び出し側は DependencyUnavailable を受けたら代替動作をとる（ローカルの利用資格で判定する、メールは送信待ちに残す 等）
+"""
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows の開発環境ではプロセス内の上限だけにする
+    fcntl = None
+
+DEFAULTS = {
+    'stripe': {'failure_rate': 0.5, 'minimum_calls': 5, 'window_seconds': 60, 'open_seconds': 30,
+               'half_open_calls': 1, 'max_concurrent': 4, 'acquire_timeout': 0.5},
+    'smtp': {'failure_rate': 0.5, 'minimum_calls': 3, 'window_seconds': 120, 'open_seconds': 60,
+             'half_open_calls': 1, 'max_concurrent': 2, 'acquire_timeout': 2.0},
+}
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class DependencyUnavailable(Exception):
+    def __init__(self, name, reason, retry_after=None):
+        super().__init__(f'{name} is unavailable ({reason})')
+        self.name = name
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def config(name):
+    configured = (getattr(settings, 'RESILIENCE', None) or {}).get(name, {})
+    return {**DEFAULTS.get(name, DEFAULTS['stripe']), **configured}
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_rate, minimum_calls, window_seconds, open_seconds, half_open_calls):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.minimum_calls = minimum_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self._lock = threading.Lock()
+        self._calls = deque()  # (時刻, 成功したか)
+        self.state = CLOSED
+        self.opened_at = None
+        self._probes = 0
+        self.rejected = 0
+
+    def _prune(self, now):
+        while self._calls and self._calls[0][0] < now - self.window_seconds:
+            self._calls.popleft()
+
+    def allow(self, now=None):
+        now = now or time.monotonic()
+        with self._lock:
+            if self.state == OPEN:
+                if now - self.opened_at < self.open_seconds:
+                    self.rejected += 1
+                    return False
+                self.state, self._probes = HALF_OPEN, 0
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    self.rejected += 1
+                    return False
+                self._probes += 1
+            return True
+
+    def release_probe(self):
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def retry_after(self, now=None):
+        now = now or time.monotonic()
+        if self.state != OPEN:
+            return 0
+        return max(self.open_seconds - (now - self.opened_at), 0)
+
+    def record(self, success, now=None):
+        now = now or time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if success:
+                    self.state, self._calls = CLOSED, deque()
+                else:
+                    self.state, self.opened_at = OPEN, now
+                return
+            self._calls.append((now, success))
+            self._prune(now)
+            failures = sum(1 for _, ok in self._calls if not ok)
+            if len(self._calls) >= self.minimum_calls and failures / len(self._calls) >= self.failure_rate:
+                self.state, self.opened_at = OPEN, now
+
+    def status(self, now=None):
+        now = now or time.monotonic()
+        with self._lock:
+            self._prune(now)
+            calls = len(self._calls)
+            failures = sum(1 for _, ok in self._calls if not ok)
+            return {
+                'state': self.state,
+                'calls_in_window': calls,
+                'failure_rate': round(failures / calls, 3) if calls else None,
+                'retry_after': round(self.retry_after(now), 1),
+                'rejected': self.rejected,
+            }
+
+
+class Bulkhead:
+    """同時に依存先を待てる数の上限（ロックファイル max_concurrent 個を枠にする）"""
+
+    def __init__(self, name, max_concurrent, acquire_timeout):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.acquire_timeout = acquire_timeout
+        self._local_slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    def _slot_path(self, index):
+        directory = getattr(settings, 'BULKHEAD_LOCK_DIR', None) or tempfile.gettempdir()
+        return os.path.join(directory, f'nagoyameshi_bulkhead_{self.name}_{index}.lock')
+
+    def _try_lock_slot(self):
+        for index in range(self.max_concurrent):
+            handle = open(self._slot_path(index), 'a')
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return handle
+            except OSError:
+                handle.close()
+        return None
+
+    @contextmanager
+    def slot(self):
+        # まずプロセス内で上限を確保し、その上でホスト全体の枠（ロックファイル）を取る
+        if not self._local_slots.acquire(timeout=self.acquire_timeout):
+            self._reject()
+        handle = None
+        try:
+            if fcntl is not None:
+                deadline = time.monotonic() + self.acquire_timeout
+                while (handle := self._try_lock_slot()) is None:
+                    if time.monotonic() >= deadline:
+                        self._reject()
+                    time.sleep(0.05)
+            with self._lock:
+                self.in_flight += 1
+            try:
+                yield
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+        finally:
+            if handle is not None:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+                handle.close()
+            self._local_slots.release()
+
+    def _reject(self):
+        with self._lock:
+            self.rejected += 1
+        raise DependencyUnavailable(self.name, 'bulkhead full')
+
+    def status(self):
+        with self._lock:
+            return {'max_concurrent': self.max_concurrent, 'in_flight': self.in_flight, 'rejected': self.rejected}
+
+
+_registry_lock = threading.Lock()
+_breakers = {}
+_bulkheads = {}
+
+
+def get_breaker(name):
+    with _registry_lock:
+        if name not in _breakers:
+            c = config(name)
+            _breakers[name] = CircuitBreaker(name, c['failure_rate'], c['minimum_calls'], c['window_seconds'],
+                                             c['open_seconds'], c['half_open_calls'])
+        return _breakers[name]
+
+
+def get_bulkhead(name):
+    with _registry_lock:
+        if name not in _bulkheads:
+            c = config(name)
+            _bulkheads[name] = Bulkhead(name, c['max_concurrent'], c['acquire_timeout'])
+        return _bulkheads[name]
+
+
+@contextmanager
+def guard(name, is_failure=lambda error: True):
+    """name の依存先を呼ぶブロックを囲む。止めている間/枠が無いときは DependencyUnavailable"""
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise DependencyUnavailable(name, 'circuit open', breaker.retry_after())
+    try:
+        with get_bulkhead(name).slot():
+            yield
+    except DependencyUnavailable:
+        # 枠が取れなかっただけなので失敗には数えない（half_open の試行枠は戻す）
+        breaker.release_probe()
+        raise
+    except Exception as e:
+        breaker.record(not is_failure(e))
+        raise
+    breaker.record(True)
+
+
+def resilience_status():
+    """依存先ごとのブレーカーの状態（このワーカー）とバルクヘッドの使用状況"""
+    names = sorted(set(DEFAULTS) | set(_breakers) | set(_bulkheads))
+    return {name: {'breaker': get_breaker(name).status(), 'bulkhead': get_bulkhead(name).status()}
+            for name in names}
+
+
+def reset():
+    """状態を捨てる（テスト用）"""
+    with _registry_lock:
+        _breakers.clear()
+        _bulkheads.clear()
@@ -14,6 +14,7 @@ import os
 from dotenv import load_dotenv
 from pathlib import Path
 import environ
+from django.core.exceptions import ImproperlyConfigured
 
 load_dotenv()
 
@@ -69,7 +70,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',  # Heroku用静的ファイル配信
+    'nagoyameshi.media.MediaWhiteNoiseMiddleware',  # 静的ファイル・メディアファイル配信
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -168,6 +169,13 @@ CACHES = {
     }
 }
 
+# レート制限（トークンバケット。状態は同じホストの全ワーカーで共有する SQLite ファイル）
+# 開発環境では従来どおり無効。グループごとの容量/回復量は RATE_LIMITS で上書き（nagoyameshi/ratelimit.py 参照）
+RATE_LIMIT_ENABLED = env.bool('RATE_LIMIT_ENABLED', default=not DEBUG)
+RATE_LIMIT_DB = env.str('RATE_LIMIT_DB', default='') or None
+# Heroku 等のロードバランサー配下では X-Forwarded-For から接続元IPを取る
+RATE_LIMIT_TRUST_FORWARDED = env.bool('RATE_LIMIT_TRUST_FORWARDED', default=False)
+
 # データベースクエリログ設定（本番でのデバッグ用）
 if env.bool('ENABLE_DB_LOGGING', default=False):
     LOGGING = {
@@ -243,14 +251,6 @@ USE_TZ = True
 STATIC_URL = 'static/'
 STATIC_ROOT = BASE_DIR / 'staticfiles'  # Heroku 用
 
-# 静的ファイルディレクトリの設定（メディアファイルの代替パス）
-STATICFILES_DIRS = [
-    BASE_DIR / 'media',  # メディアファイルを静的ファイルとして配信
-]
-
-# WhiteNoise設定（Heroku用）
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
-
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -260,10 +260,19 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
-# Heroku用：静的ファイルディレクトリにメディアファイルも含める
-STATICFILES_DIRS = [
-    BASE_DIR / 'media',  # メディアファイルも静的ファイルとして配信
-]
+# アップロード画像は内容のハッシュ名で保存する（同じ画像は1ファイルを共有）
+# 静的ファイルは WhiteNoise の圧縮+マニフェスト付きで配信する（Heroku 用。collectstatic が必要なので DEBUG 時は通常の保存先）
+STORAGES = {
+    'default': {'BACKEND': 'nagoyameshi.media.HashedMediaStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage' if DEBUG
+                    else 'whitenoise.storage.CompressedManifestStaticFilesStorage'},
+}
+
+# メディアファイルの配信方法
+# 'whitenoise': アプリ内で配信（ハッシュ名のファイルは Cache-Control: immutable）
+# 'x-accel': X-Accel-Redirect で nginx に配信させる（nginx 側で MEDIA_X_ACCEL_PREFIX を internal location にする）
+MEDIA_SERVE_MODE = env.str('MEDIA_SERVE_MODE', default='whitenoise')
+MEDIA_X_ACCEL_PREFIX = env.str('MEDIA_X_ACCEL_PREFIX', default='/protected-media/')
 
 # CSRF設定
 CSRF_COOKIE_SECURE = env.bool('CSRF_COOKIE_SECURE', default=False)  # 本番環境ではTrue
@@ -291,6 +300,26 @@ MY_URL = env.str('MY_URL')
 
 # Stripeの価格ID
 STRIPE_PRICE_ID = env.str('STRIPE_PRICE_ID')
+# Stripe Webhook の署名シークレット（whsec_...）。本番(DEBUG=False)では必須（無いと全 Webhook を 400 で拒否することになるため起動させない）
+STRIPE_WEBHOOK_SECRET = env.str('STRIPE_WEBHOOK_SECRET', default='')
+if not DEBUG and not STRIPE_WEBHOOK_SECRET:
+    raise ImproperlyConfigured('Set the STRIPE_WEBHOOK_SECRET environment variable (required when DEBUG=False)')
+# Stripe API の接続先（空なら本番API。ローカルでは stripe-mock 等: http://localhost:12111）
+STRIPE_API_BASE = env.str('STRIPE_API_BASE', default='')
+# Stripe 呼び出しの実装（負荷試験・オフライン開発では accounts.stripe_gateway.FakeStripeGateway）
+STRIPE_GATEWAY = env.str('STRIPE_GATEWAY', default='accounts.stripe_gateway.StripeGateway')
+# Stripe 呼び出しのタイムアウト（秒。参照系/更新系）と、取得したオブジェクトのキャッシュ秒数
+STRIPE_READ_TIMEOUT = env.float('STRIPE_READ_TIMEOUT', default=5)
+STRIPE_WRITE_TIMEOUT = env.float('STRIPE_WRITE_TIMEOUT', default=15)
+STRIPE_MAX_NETWORK_RETRIES = env.int('STRIPE_MAX_NETWORK_RETRIES', default=1)
+STRIPE_CACHE_SECONDS = env.int('STRIPE_CACHE_SECONDS', default=30)
+# Webhook で受けた Stripe イベントの反映を諦めるまでの試行回数（worker: python manage.py process_stripe_events）
+STRIPE_EVENT_MAX_ATTEMPTS = env.int('STRIPE_EVENT_MAX_ATTEMPTS', default=5)
+# 反映に失敗したイベントを再試行するまでの待ち時間（秒。失敗のたびに倍にし、上限で止める）
+STRIPE_EVENT_RETRY_BASE_SECONDS = env.int('STRIPE_EVENT_RETRY_BASE_SECONDS', default=30)
+STRIPE_EVENT_RETRY_MAX_SECONDS = env.int('STRIPE_EVENT_RETRY_MAX_SECONDS', default=60*60)
+# サブスク会員の利用資格はこの秒数の間ローカルの行で判定し、過ぎたらStripeと同期する（Webhook受信時は即時）
+ENTITLEMENT_FRESHNESS_SECONDS = env.int('ENTITLEMENT_FRESHNESS_SECONDS', default=60*15)
 
 # ==============================
 # メール設定 (パスワードリセット用)
@@ -308,6 +337,37 @@ if EMAIL_HOST:
     EMAIL_HOST_PASSWORD = env.str('EMAIL_HOST_PASSWORD', default='')
     EMAIL_TIMEOUT = env.int('EMAIL_TIMEOUT', default=30)
 
+# メール送信待ち(outbox)の再送設定（送信は worker: python manage.py send_outbox_emails）
+OUTBOX_MAX_ATTEMPTS = env.int('OUTBOX_MAX_ATTEMPTS', default=8)
+OUTBOX_RETRY_BASE_SECONDS = env.int('OUTBOX_RETRY_BASE_SECONDS', default=60)
+OUTBOX_RETRY_MAX_SECONDS = env.int('OUTBOX_RETRY_MAX_SECONDS', default=60*60*6)
+OUTBOX_LEASE_SECONDS = env.int('OUTBOX_LEASE_SECONDS', default=300)
+
+# 外部サービスのサーキットブレーカー/バルクヘッド（nagoyameshi/resilience.py）
+# 直近 window_seconds の失敗率が failure_rate 以上（minimum_calls 回以上）で open_seconds の間呼び出しを止める。
+# 同時に待てるのは同じホストの全ワーカーで max_concurrent 件まで（空きを acquire_timeout 秒待って諦める）
+RESILIENCE = {
+    'stripe': {
+        'failure_rate': env.float('STRIPE_BREAKER_FAILURE_RATE', default=0.5),
+        'minimum_calls': env.int('STRIPE_BREAKER_MINIMUM_CALLS', default=5),
+        'window_seconds': env.int('STRIPE_BREAKER_WINDOW_SECONDS', default=60),
+        'open_seconds': env.int('STRIPE_BREAKER_OPEN_SECONDS', default=30),
+        'max_concurrent': env.int('STRIPE_BULKHEAD_SIZE', default=4),
+        'acquire_timeout': env.float('STRIPE_BULKHEAD_TIMEOUT', default=0.5),
+    },
+    'smtp': {
+        'failure_rate': env.float('SMTP_BREAKER_FAILURE_RATE', default=0.5),
+        'minimum_calls': env.int('SMTP_BREAKER_MINIMUM_CALLS', default=3),
+        'window_seconds': env.int('SMTP_BREAKER_WINDOW_SECONDS', default=120),
+        'open_seconds': env.int('SMTP_BREAKER_OPEN_SECONDS', default=60),
+        'max_concurrent': env.int('SMTP_BULKHEAD_SIZE', default=2),
+        'acquire_timeout': env.float('SMTP_BULKHEAD_TIMEOUT', default=2.0),
+    },
+}
+
+# 冪等キー(Idempotency-Key)の保存期間（時間）
+IDEMPOTENCY_KEY_TTL_HOURS = env.int('IDEMPOTENCY_KEY_TTL_HOURS', default=24)
+
 # パスワードリセットトークン有効期限 (秒) - 3日 (デフォルトは1日)
 from datetime import timedelta
 PASSWORD_RESET_TIMEOUT = env.int('PASSWORD_RESET_TIMEOUT', default=60*60*24*3)
\ No newline at end of file
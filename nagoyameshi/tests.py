@@ -0,0 +1,32 @@
+import os
+import tempfile
+import time
+
+from django.test import TestCase, override_settings
+
+from .ratelimit import consume, rate_limit_stats
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        handle, self.db = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        self.addCleanup(os.remove, self.db)
+        limits = {'search': {'capacity': 2, 'per_minute': 60}}
+        self.enterContext(override_settings(RATE_LIMIT_ENABLED=True, RATE_LIMIT_DB=self.db, RATE_LIMITS=limits))
+
+    def test_burst_then_retry_after(self):
+        url = '/shops/api/suggest/?q=x'
+        self.assertEqual([self.client.get(url).status_code for _ in range(2)], [200, 200])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(rate_limit_stats()['groups']['search'], {'allowed': 2, 'limited': 1})
+
+    def test_tokens_refill_over_time(self):
+        now = time.time()
+        self.assertTrue(consume('search', 'ip:1', now=now).allowed)
+        self.assertTrue(consume('search', 'ip:1', now=now).allowed)
+        self.assertFalse(consume('search', 'ip:1', now=now).allowed)
+        self.assertTrue(consume('search', 'ip:2', now=now).allowed)
+        self.assertTrue(consume('search', 'ip:1', now=now + 1).allowed)
@@ -17,8 +17,6 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 from django.urls import include
-from django.conf import settings
-from django.conf.urls.static import static
 from django.shortcuts import redirect
 
 urlpatterns = [
@@ -29,6 +27,4 @@ urlpatterns = [
     path('admin-panel/', include('admin_panel.urls')),  # 管理者パネル
 ]
 
-# Heroku本番環境でもメディアファイルを配信（一時的な解決策）
-if settings.DEBUG or True:  # Heroku用に強制的に有効化
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+# メディアファイルは nagoyameshi.media.MediaWhiteNoiseMiddleware が配信する
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'nagoyameshi.settings')
 
 application = get_wsgi_application()
+
+# 入力補完の辞書をワーカー起動時に作っておく（初回リクエストの待ちを無くす）
+from shops.suggest import warm_up  # noqa: E402
+
+warm_up()
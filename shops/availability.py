@@ -0,0 +1,83 @@
+"""
+予約カレンダー用の月間空席状況
+- 在庫行(SeatInventory)のある日はその残席数、無い日は予約履歴の日付別合計(GROUP BY date 1回)から計算する
+- 結果は店舗・月ごとに短時間キャッシュし、ETag を付けて返す
+- 予約/キャンセル時は該当する店舗・月のキャッシュだけを消す（他ワーカーのキャッシュは TTL で切れる）
+"""
+import calendar
+import hashlib
+import json
+import re
+from datetime import date
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Sum
+
+from .models import History, SeatInventory
+
+MONTH_RE = re.compile(r'^(\d{4})-(\d{2})$')
+
+
+def _timeout():
+    return getattr(settings, 'AVAILABILITY_CACHE_TIMEOUT', 30)
+
+
+def _cache_key(shop_id, year, month):
+    return f'availability:{shop_id}:{year:04d}-{month:02d}'
+
+
+def parse_month(value, today=None):
+    """'YYYY-MM' を (year, month) にする。未指定は今月。不正なら ValueError"""
+    if not value:
+        today = today or date.today()
+        return today.year, today.month
+    match = MONTH_RE.match(value)
+    if not match:
+        raise ValueError('月は YYYY-MM 形式で指定してください。')
+    year, month = int(match.group(1)), int(match.group(2))
+    if not 1 <= month <= 12 or not 2000 <= year <= 2100:
+        raise ValueError('月は YYYY-MM 形式で指定してください。')
+    return year, month
+
+
+def compute_month_availability(shop, year, month):
+    first = date(year, month, 1)
+    last = date(year, month, calendar.monthrange(year, month)[1])
+    remaining = dict(SeatInventory.objects
+                     .filter(shop=shop, date__range=(first, last))
+                     .values_list('date', 'remaining'))
+    booked = dict(History.objects
+                  .filter(shop=shop, date__range=(first, last))
+                  .exclude(date__in=list(remaining))
+                  .values('date')
+                  .annotate(total=Sum('number_of_people'))
+                  .values_list('date', 'total'))
+
+    days = []
+    for day in range(1, last.day + 1):
+        current = date(year, month, day)
+        seats = remaining.get(current)
+        if seats is None:
+            seats = max(shop.seat_count - (booked.get(current) or 0), 0)
+        days.append({'date': current.isoformat(), 'remaining': seats})
+    return {'shop_id': shop.pk, 'month': f'{year:04d}-{month:02d}', 'seat_count': shop.seat_count, 'days': days}
+
+
+def get_month_availability(shop, year, month):
+    """(payload, etag) を返す（キャッシュ優先）"""
+    key = _cache_key(shop.pk, year, month)
+    cached = cache.get(key)
+    if cached is None:
+        payload = compute_month_availability(shop, year, month)
+        body = json.dumps(payload, sort_keys=True).encode('utf-8')
+        cached = (payload, hashlib.md5(body).hexdigest())
+        cache.set(key, cached, _timeout())
+    return cached
+
+
+def invalidate_availability(shop_id, on_date):
+    """予約/キャンセルで変わった店舗・月のキャッシュを消す（コミット後）"""
+    key = _cache_key(shop_id, on_date.year, on_date.month)
+    transaction.on_commit(lambda: cache.delete(key))
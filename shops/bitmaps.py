@@ -0,0 +1,72 @@
+"""
+カテゴリごとの店舗ビットマップ（ワーカー内メモリ）
+- ビット位置 = 店舗ID。Python の int をビット列として使う
+- 複数カテゴリの AND/OR 絞り込みとカテゴリ別件数(ファセット)を、JOIN や COUNT を発行せずに計算する
+- カタログのバージョンが変わったら（ShopCategory/Category/Shop の変更）作り直す
+"""
+import threading
+
+from .catalog import CATALOG, get_version
+from .models import Category, Shop, ShopCategory
+
+_lock = threading.Lock()
+_state = {'version': None, 'index': None}
+
+
+class CategoryBitmaps:
+    def __init__(self, categories, universe, bitmaps):
+        self.categories = categories  # [(id, name), ...] 名前順
+        self.universe = universe      # 全店舗
+        self.bitmaps = bitmaps        # {category_id: int}
+
+    @classmethod
+    def build(cls):
+        bitmaps = {}
+        for category_id, shop_id in ShopCategory.objects.values_list('category_id', 'shop_id'):
+            bitmaps[category_id] = bitmaps.get(category_id, 0) | (1 << shop_id)
+        universe = cls.from_ids(Shop.objects.values_list('pk', flat=True))
+        categories = list(Category.objects.order_by('name').values_list('id', 'name'))
+        return cls(categories, universe, bitmaps)
+
+    @staticmethod
+    def from_ids(shop_ids):
+        bitmap = 0
+        for shop_id in shop_ids:
+            bitmap |= 1 << shop_id
+        return bitmap
+
+    @staticmethod
+    def to_ids(bitmap):
+        """立っているビットの位置(店舗ID)を昇順で返す"""
+        return [i for i, bit in enumerate(reversed(bin(bitmap)[2:])) if bit == '1']
+
+    def contains(self, bitmap, shop_id):
+        return bool(bitmap >> shop_id & 1)
+
+    def select(self, category_ids, op='or'):
+        """指定カテゴリの店舗ビットマップ。op='and' は全カテゴリに属する店舗、'or' はいずれか"""
+        selected = [self.bitmaps.get(category_id, 0) for category_id in category_ids]
+        if not selected:
+            return self.universe
+        result = selected[0]
+        for bitmap in selected[1:]:
+            result = result & bitmap if op == 'and' else result | bitmap
+        return result
+
+    def facet_counts(self, base):
+        """base に含まれる店舗のカテゴリ別件数 {category_id: count}"""
+        return {category_id: (self.bitmaps.get(category_id, 0) & base).bit_count()
+                for category_id, _ in self.categories}
+
+
+def get_category_bitmaps():
+    """現在のカタログバージョンのビットマップを返す（古ければ作り直す）"""
+    version = get_version(CATALOG)
+    index = _state['index']
+    if index is not None and _state['version'] == version:
+        return index
+    with _lock:
+        if _state['index'] is None or _state['version'] != version:
+            _state['index'] = CategoryBitmaps.build()
+            _state['version'] = version
+        return _state['index']
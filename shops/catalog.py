@@ -0,0 +1,52 @@
+"""
+カタログ(店舗/画像/カテゴリ)とお気に入り等の変更を表すバージョン番号の管理
+キャッシュキーにバージョンを含めることで、書き込み時に明示的にキャッシュを無効化する。
+バージョンはDBに保持し、各ワーカーは CATALOG_VERSION_CACHE_TTL 秒だけローカルに保持する。
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import CatalogVersion
+
+CATALOG = 'catalog'
+POPULARITY = 'popularity'
+
+
+def _cache_key(name):
+    return f'catalog_version:{name}'
+
+
+def get_version(name):
+    """バージョン番号を返す（ローカルキャッシュ優先）"""
+    key = _cache_key(name)
+    version = cache.get(key)
+    if version is None:
+        version = (CatalogVersion.objects
+                   .filter(name=name)
+                   .values_list('version', flat=True)
+                   .first()) or 0
+        cache.set(key, version, getattr(settings, 'CATALOG_VERSION_CACHE_TTL', 5))
+    return version
+
+
+def _bump_now(name):
+    updated = CatalogVersion.objects.filter(name=name).update(
+        version=F('version') + 1, updated_at=timezone.now()
+    )
+    if not updated:
+        try:
+            CatalogVersion.objects.create(name=name, version=1)
+        except IntegrityError:
+            # 同時作成された場合は既存行を更新
+            CatalogVersion.objects.filter(name=name).update(
+                version=F('version') + 1, updated_at=timezone.now()
+            )
+    cache.delete(_cache_key(name))
+
+
+def bump_version(name):
+    """バージョンを1つ進める。トランザクション中ならコミット後に実行する。"""
+    transaction.on_commit(lambda: _bump_now(name))
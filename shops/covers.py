@@ -0,0 +1,57 @@
+"""
+店舗の代表画像(Shop.cover_image)と画像の表示順(Image.position)の維持
+一覧では代表画像を select_related で1回のJOINで取得し、全画像の prefetch を不要にする。
+"""
+from django.db.models import Count, F, Max, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Shop, Image
+
+
+def next_position(shop_id):
+    last = Image.objects.filter(shop_id=shop_id).aggregate(last=Max('position'))['last']
+    return 0 if last is None else last + 1
+
+
+def assign_cover_if_missing(shop_id):
+    """代表画像が未設定なら表示順の先頭の画像を設定する"""
+    first_id = (Image.objects
+                .filter(shop_id=shop_id)
+                .order_by('position', 'id')
+                .values_list('pk', flat=True)
+                .first())
+    if first_id is not None:
+        Shop.objects.filter(pk=shop_id, cover_image__isnull=True).update(cover_image=first_id)
+
+
+def close_position_gap(shop_id, removed_position):
+    """削除された画像より後ろの表示順を1つずつ詰める"""
+    Image.objects.filter(shop_id=shop_id, position__gt=removed_position).update(position=F('position') - 1)
+
+
+def with_cover_images(queryset, thumbnails=0):
+    """代表画像を JOIN で取得する。thumbnails > 0 のときは表示順の先頭から
+    その枚数分の画像(leading_images)と画像枚数(image_count)も取得する。
+    """
+    queryset = queryset.select_related('cover_image')
+    if thumbnails:
+        count = (Image.objects
+                 .filter(shop=OuterRef('pk'))
+                 .order_by()
+                 .values('shop')
+                 .annotate(total=Count('pk'))
+                 .values('total'))
+        queryset = (queryset
+                    .annotate(image_count=Coalesce(Subquery(count), 0))
+                    .prefetch_related(Prefetch('images',
+                                               queryset=Image.objects.filter(position__lte=thumbnails),
+                                               to_attr='leading_images')))
+    return queryset
+
+
+def sub_images(shop, limit=4):
+    """代表画像以外の画像を表示順に limit 枚（with_cover_images(thumbnails=limit) 済みを想定）"""
+    images = getattr(shop, 'leading_images', None)
+    if images is None:
+        images = shop.images.all()[:limit + 1]
+    return [image for image in images if image.pk != shop.cover_image_id][:limit]
@@ -0,0 +1,176 @@
+"""
+位置情報（近くのお店検索）
+- 店舗の緯度経度を geohash に変換して保存し、近傍セルの前方一致で SQL 上で候補を絞る
+- 候補に対する正確な距離(haversine)は numpy でまとめて計算する
+- 住所 -> 緯度経度はローカルのガゼッティア(CSV/JSON)から引く（外部APIは使わない）
+"""
+import csv
+import json
+import math
+
+import numpy as np
+from django.db.models import Q
+
+from .normalize import normalize_text
+
+EARTH_RADIUS_KM = 6371.0088
+GEOHASH_PRECISION = 9  # 約5m四方
+MAX_RADIUS_KM = 50.0
+DEFAULT_RADIUS_KM = 1.0
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_BASE32_INDEX = {char: i for i, char in enumerate(_BASE32)}
+
+
+def encode_geohash(lat, lng, precision=GEOHASH_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True  # 偶数ビットは経度
+    while len(chars) < precision:
+        value, value_range = (lng, lng_range) if even else (lat, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            value_range[0] = mid
+        else:
+            bits = bits * 2
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+
+def decode_geohash(geohash):
+    """セル中心の (lat, lng) を返す"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        bits = _BASE32_INDEX[char]
+        for shift in range(4, -1, -1):
+            value_range = lng_range if even else lat_range
+            mid = (value_range[0] + value_range[1]) / 2
+            if bits >> shift & 1:
+                value_range[0] = mid
+            else:
+                value_range[1] = mid
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lng_range[0] + lng_range[1]) / 2
+
+
+def cell_size_deg(precision):
+    """geohash セルの (緯度方向, 経度方向) の幅（度）"""
+    total_bits = precision * 5
+    lng_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def precision_for_radius(lat, radius_km):
+    """近傍3x3セルで半径を覆える最も細かい精度（見つからなければ 0 = 絞り込み無し）"""
+    km_per_deg_lat = math.pi * EARTH_RADIUS_KM / 180
+    km_per_deg_lng = km_per_deg_lat * max(math.cos(math.radians(lat)), 0.01)
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        lat_deg, lng_deg = cell_size_deg(precision)
+        if lat_deg * km_per_deg_lat >= radius_km and lng_deg * km_per_deg_lng >= radius_km:
+            return precision
+    return 0
+
+
+def neighbor_cells(lat, lng, precision):
+    """(lat, lng) を含むセルと周囲8セルの geohash"""
+    center_lat, center_lng = decode_geohash(encode_geohash(lat, lng, precision))
+    lat_deg, lng_deg = cell_size_deg(precision)
+    cells = set()
+    for d_lat in (-1, 0, 1):
+        cell_lat = center_lat + d_lat * lat_deg
+        if not -90 <= cell_lat <= 90:
+            continue
+        for d_lng in (-1, 0, 1):
+            cell_lng = (center_lng + d_lng * lng_deg + 180) % 360 - 180
+            cells.add(encode_geohash(cell_lat, cell_lng, precision))
+    return sorted(cells)
+
+
+def haversine_km(lat, lng, lats, lngs):
+    """1点から複数点への距離(km)を numpy 配列で返す"""
+    lat1 = math.radians(lat)
+    lat2 = np.radians(np.asarray(lats, dtype=float))
+    d_lat = lat2 - lat1
+    d_lng = np.radians(np.asarray(lngs, dtype=float) - lng)
+    a = np.sin(d_lat / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin(d_lng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def parse_point(lat, lng, radius=None):
+    """GETパラメーターの緯度/経度/半径(km)を検証して (lat, lng, radius_km) を返す。不正なら ValueError"""
+    lat = float(lat)
+    lng = float(lng)
+    radius_km = float(radius) if radius not in (None, '') else DEFAULT_RADIUS_KM
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180) or not 0 < radius_km <= MAX_RADIUS_KM:
+        raise ValueError('緯度/経度/半径の値が不正です。')
+    return lat, lng, radius_km
+
+
+def nearby_shop_distances(queryset, lat, lng, radius_km):
+    """半径内の店舗を距離の近い順に [(shop_id, distance_km), ...] で返す。
+    queryset は Shop の QuerySet（位置未登録の店舗は除外される）。
+    """
+    candidates = queryset.filter(latitude__isnull=False, longitude__isnull=False)
+    precision = precision_for_radius(lat, radius_km)
+    if precision:
+        cells = Q()
+        for cell in neighbor_cells(lat, lng, precision):
+            cells |= Q(geohash__startswith=cell)
+        candidates = candidates.filter(cells)
+
+    rows = list(candidates.values_list('pk', 'latitude', 'longitude'))
+    if not rows:
+        return []
+    ids, lats, lngs = zip(*rows)
+    distances = haversine_km(lat, lng, lats, lngs)
+    within = np.flatnonzero(distances <= radius_km)
+    # 距離 -> id の順で安定ソート
+    order = within[np.lexsort((np.asarray(ids)[within], distances[within]))]
+    return [(ids[i], float(distances[i])) for i in order]
+
+
+def load_gazetteer(path):
+    """ガゼッティアを {正規化住所: (lat, lng)} で読み込む。
+    CSV: address,latitude,longitude のヘッダー付き
+    JSON: [{"address":..., "latitude":..., "longitude":...}, ...] または {"住所": [lat, lng], ...}
+    """
+    if str(path).lower().endswith('.json'):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            rows = ((address, point[0], point[1]) for address, point in data.items())
+        else:
+            rows = ((row['address'], row['latitude'], row['longitude']) for row in data)
+    else:
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            rows = [(row['address'], row['latitude'], row['longitude']) for row in csv.DictReader(f)]
+
+    gazetteer = {}
+    for address, lat, lng in rows:
+        key = normalize_text(address).replace(' ', '')
+        if key:
+            gazetteer[key] = (float(lat), float(lng))
+    return gazetteer
+
+
+def geocode_address(gazetteer, address):
+    """住所に一致する最長の前方一致エントリの (lat, lng)。見つからなければ None"""
+    key = normalize_text(address).replace(' ', '')
+    for end in range(len(key), 0, -1):
+        point = gazetteer.get(key[:end])
+        if point is not None:
+            return point
+    return None
@@ -0,0 +1,99 @@
+"""
+店舗画像のサイズ別派生画像（サムネイル/カード/詳細）を WebP と JPEG で生成する
+- 生成した派生画像のストレージ上の名前は Image.variants に記録する
+  {'card': {'webp': 'images/variants/xxx_card.webp', 'jpeg': '...', 'width': 400, 'height': 300}, ...}
+- テンプレートは srcset で幅に応じた派生画像を選ばせる（Image.srcset / Image.webp_srcset）
+"""
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image as PILImage, ImageOps
+
+from .catalog import CATALOG, bump_version
+from .models import Image
+
+# name: (幅, 高さ, 切り抜き)。切り抜き無しは縦横比を保って枠内に収める
+VARIANTS = {
+    'thumb': (160, 120, True),
+    'card': (400, 300, True),
+    'detail': (1200, 900, False),
+}
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+VARIANT_DIR = 'images/variants'
+
+
+def variant_name(original_name, variant, ext):
+    stem = os.path.splitext(os.path.basename(original_name))[0]
+    return f'{VARIANT_DIR}/{stem}_{variant}.{ext}'
+
+
+def _resize(source, width, height, crop):
+    if crop:
+        return ImageOps.fit(source, (width, height), PILImage.LANCZOS)
+    resized = source.copy()
+    resized.thumbnail((width, height), PILImage.LANCZOS)
+    return resized
+
+
+def generate_variants(original_name, storage=None):
+    """元画像から派生画像を作って保存し、Image.variants に入れる dict を返す"""
+    storage = storage or default_storage
+    with storage.open(original_name, 'rb') as f:
+        source = PILImage.open(f)
+        source.load()
+    source = ImageOps.exif_transpose(source).convert('RGB')
+
+    variants = {}
+    for variant, (width, height, crop) in VARIANTS.items():
+        resized = _resize(source, width, height, crop)
+        entry = {'width': resized.width, 'height': resized.height}
+        for ext, (pil_format, options) in FORMATS.items():
+            buffer = BytesIO()
+            resized.save(buffer, pil_format, **options)
+            name = variant_name(original_name, variant, ext)
+            if storage.exists(name):
+                storage.delete(name)
+            entry[ext] = storage.save(name, ContentFile(buffer.getvalue()))
+        variants[variant] = entry
+    return variants
+
+
+def delete_variants(variants, storage=None):
+    storage = storage or default_storage
+    for entry in (variants or {}).values():
+        for ext in FORMATS:
+            name = entry.get(ext)
+            if name and storage.exists(name):
+                storage.delete(name)
+
+
+def refresh_image_variants(image_ids):
+    """指定画像の派生画像を作り直して Image.variants を更新する。更新した件数を返す。"""
+    updated = 0
+    for image in Image.objects.filter(pk__in=list(image_ids)).only('pk', 'image', 'variants'):
+        if not image.image:
+            continue
+        old = image.variants
+        variants = generate_variants(image.image.name, image.image.storage)
+        Image.objects.filter(pk=image.pk).update(variants=variants)
+        _delete_stale(old, variants, image.image.storage)
+        updated += 1
+    if updated:
+        # 一覧キャッシュの画像URLを差し替えるため
+        bump_version(CATALOG)
+    return updated
+
+
+def _delete_stale(old, new, storage):
+    """作り直しで使われなくなった派生画像を消す"""
+    keep = {entry[ext] for entry in new.values() for ext in FORMATS}
+    for entry in (old or {}).values():
+        for ext in FORMATS:
+            name = entry.get(ext)
+            if name and name not in keep and storage.exists(name):
+                storage.delete(name)
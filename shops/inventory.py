@@ -0,0 +1,81 @@
+"""
+店舗・日付ごとの残席在庫(SeatInventory)
+- 予約は「残席 >= 人数」を条件にした UPDATE 1文で減らす。行ロックや集計を伴う事前チェックは行わない
+  （同時に予約されても、条件を満たした UPDATE だけが成功するため売り越さない）
+- 在庫行はその日の最初の予約時に、既存の予約履歴から作る
+- キャンセルは同じく UPDATE 1文で戻す（座席数を超えない）
+- 残席が変わったら該当する店舗・月の空席カレンダーのキャッシュを消す
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest, Least
+
+from .availability import invalidate_availability
+from .models import SeatInventory
+
+
+class InsufficientSeats(Exception):
+    def __init__(self, remaining):
+        super().__init__(f'残席が不足しています。（残り {remaining} 席）')
+        self.remaining = remaining
+
+
+def ensure_inventory(shop, on_date):
+    """在庫行が無ければ予約履歴から作る"""
+    if SeatInventory.objects.filter(shop=shop, date=on_date).exists():
+        return
+    try:
+        with transaction.atomic():
+            SeatInventory.objects.create(shop=shop, date=on_date, seat_count=shop.seat_count,
+                                         remaining=shop.booked_remaining_seats_on(on_date))
+    except IntegrityError:
+        # 同時に作成された場合はそちらを使う
+        pass
+
+
+def reserve_seats(shop, on_date, people):
+    """残席を people 分減らして残りの席数を返す。足りなければ InsufficientSeats。
+    予約履歴の作成と同じトランザクション内で呼ぶこと（履歴の作成に失敗したら戻るように）。
+    """
+    ensure_inventory(shop, on_date)
+    inventory = SeatInventory.objects.filter(shop=shop, date=on_date)
+    if not inventory.filter(remaining__gte=people).update(remaining=F('remaining') - people):
+        raise InsufficientSeats(inventory.values_list('remaining', flat=True).first() or 0)
+    invalidate_availability(shop.pk, on_date)
+    return inventory.values_list('remaining', flat=True).first()
+
+
+def release_seats(shop_id, on_date, people):
+    """キャンセル分の席を戻す（座席数が上限）。在庫行が無い日は何もしない"""
+    invalidate_availability(shop_id, on_date)
+    return (SeatInventory.objects
+            .filter(shop_id=shop_id, date=on_date)
+            .update(remaining=Least(F('remaining') + people, F('seat_count'))))
+
+
+def adjust_capacity(shop_id, old_seat_count, new_seat_count, from_date):
+    """座席数の変更を from_date 以降の在庫行に反映する（増減分だけ残席も増減。0未満にはしない）"""
+    if old_seat_count == new_seat_count:
+        return 0
+    delta = new_seat_count - old_seat_count
+    return (SeatInventory.objects
+            .filter(shop_id=shop_id, date__gte=from_date)
+            .update(seat_count=new_seat_count,
+                    remaining=Greatest(Least(F('remaining') + delta, new_seat_count), 0)))
+
+
+def rebuild_inventory(shop_ids=None, from_date=None):
+    """在庫行を予約履歴から作り直す。更新した行数を返す。"""
+    inventories = SeatInventory.objects.select_related('shop')
+    if shop_ids is not None:
+        inventories = inventories.filter(shop_id__in=shop_ids)
+    if from_date is not None:
+        inventories = inventories.filter(date__gte=from_date)
+    updated = 0
+    for inventory in inventories:
+        shop = inventory.shop
+        remaining = shop.booked_remaining_seats_on(inventory.date)
+        updated += SeatInventory.objects.filter(pk=inventory.pk).exclude(
+            seat_count=shop.seat_count, remaining=remaining,
+        ).update(seat_count=shop.seat_count, remaining=remaining)
+    return updated
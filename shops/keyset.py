@@ -0,0 +1,88 @@
+"""
+店舗一覧のキーセット(カーソル)ページング
+OFFSET/COUNT を使わず、直前に表示した (並び替えキー, id) より後ろの行だけを取得する。
+カーソルは署名付きの不透明な文字列としてクライアントに渡す。
+"""
+from django.core import signing
+from django.db.models import F, Q
+
+CURSOR_SALT = 'shops.keyset'
+
+# 並び替えキー（降順）。同値の場合は店舗id昇順で安定させる。
+# 集計行は全店舗にある（店舗作成時の post_save と migration 0020 の補完）ので、集計行のカラムで直接並べて
+# ShopStats の (キー降順, shop) の複合インデックスをその順のまま読めるようにする
+SORT_FIELDS = {
+    # 時間減衰付きの人気度（shop_stats_popular_idx）
+    'popular': 'stats__popularity_score',
+    # ベイズ平均の評価（shop_stats_rating_idx）
+    'rating': 'stats__bayesian_rating',
+}
+SORTS = ('popular', 'rating', 'id')
+DEFAULT_SORT = 'popular'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def normalize_sort(sort):
+    return sort if sort in SORTS else DEFAULT_SORT
+
+
+def apply_sort(queryset, sort):
+    """並び順を適用する。id以外は sort_key をannotateする。"""
+    sort = normalize_sort(sort)
+    if sort == 'id':
+        return queryset.order_by('id')
+    field = SORT_FIELDS[sort]
+    # stats__isnull=False で INNER JOIN にし、集計行のインデックス順に読めるようにする
+    return (queryset.filter(stats__isnull=False)
+            .annotate(sort_key=F(field))
+            .order_by(f'-{field}', 'stats__shop_id'))
+
+
+def encode_cursor(sort, last_id, sort_key=None):
+    payload = {'s': normalize_sort(sort), 'id': last_id}
+    if sort_key is not None:
+        payload['k'] = sort_key
+    return signing.dumps(payload, salt=CURSOR_SALT)
+
+
+def decode_cursor(token):
+    try:
+        payload = signing.loads(token, salt=CURSOR_SALT)
+        return payload['s'], int(payload['id']), payload.get('k')
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        raise InvalidCursor('カーソルが不正です。')
+
+
+def cursor_for(sort, shop):
+    """apply_sort 済みQuerySetから取得した店舗の位置を表すカーソル"""
+    return encode_cursor(sort, shop.pk, getattr(shop, 'sort_key', None))
+
+
+def keyset_page(queryset, sort, cursor=None, limit=10):
+    """(shops, next_cursor) を返す。next_cursor が None なら続きは無い。
+    cursor を渡した場合はカーソルに記録された並び順を優先する。
+    """
+    last_id = last_key = None
+    if cursor:
+        sort, last_id, last_key = decode_cursor(cursor)
+    sort = normalize_sort(sort)
+    qs = apply_sort(queryset, sort)
+
+    if last_id is not None:
+        if sort == 'id':
+            qs = qs.filter(id__gt=last_id)
+        elif last_key is None:
+            raise InvalidCursor('カーソルが不正です。')
+        else:
+            field = SORT_FIELDS[sort]
+            qs = qs.filter(Q(**{f'{field}__lt': last_key}) | Q(**{field: last_key, 'stats__shop_id__gt': last_id}))
+
+    # 1件多く取得して続きの有無を判定（COUNT不要）
+    shops = list(qs[:limit + 1])
+    has_more = len(shops) > limit
+    shops = shops[:limit]
+    next_cursor = cursor_for(sort, shops[-1]) if has_more else None
+    return shops, next_cursor
@@ -0,0 +1,104 @@
+"""
+店舗一覧(人気順/評価順)のページ描画データを全ユーザー共通でキャッシュする
+- キーは並び順・ページ番号とカタログ/人気のバージョン番号
+- ユーザーごとのお気に入り状態はキャッシュせず、表示時に重ねる
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from .catalog import CATALOG, POPULARITY, get_version
+from .covers import sub_images, with_cover_images
+from .keyset import apply_sort, encode_cursor
+from .models import Shop, Favorite
+from .stats import get_shop_stats
+
+
+def _timeout():
+    return getattr(settings, 'SHOP_LIST_CACHE_TIMEOUT', 300)
+
+
+def _versions():
+    return f'{get_version(CATALOG)}.{get_version(POPULARITY)}'
+
+
+LIST_SORTS = ('popular', 'rating')
+
+
+def normalize_list_sort(sort):
+    return sort if sort in LIST_SORTS else 'popular'
+
+
+def shop_list_queryset(sort='popular'):
+    """人気順(人気度降順)/評価順(ベイズ平均降順) -> 同値時はid昇順で安定（load_more_shops のカーソルと同じ並び）"""
+    qs = with_cover_images(Shop.objects.select_related('stats'), thumbnails=4).prefetch_related('categories__category')
+    return apply_sort(qs, normalize_list_sort(sort))
+
+
+def build_shop_row(shop):
+    """テンプレート/JSONで使う1店舗分の描画データ（キャッシュ可能なdict）"""
+    main_image = shop.cover_image
+    return {
+        'shop': {
+            'pk': shop.pk,
+            'name': shop.name,
+            'address': shop.address,
+            'phone_number': shop.phone_number,
+            'seat_count': shop.seat_count,
+        },
+        'favorite_count': get_shop_stats(shop).favorite_count,
+        'categories': [
+            {'id': sc.category.id, 'name': sc.category.name}
+            for sc in shop.categories.all()
+        ],
+        'main_image_url': main_image.card_url if main_image else None,
+        'main_image_srcset': main_image.srcset if main_image else '',
+        'main_image_webp_srcset': main_image.webp_srcset if main_image else '',
+        'sub_image_urls': [image.thumb_url for image in sub_images(shop, 4)],
+        'image_count': shop.image_count,
+        'sort_key': getattr(shop, 'sort_key', None),
+    }
+
+
+def get_shop_list_count():
+    key = f'shop_list_count:{_versions()}'
+    count = cache.get(key)
+    if count is None:
+        count = Shop.objects.count()
+        cache.set(key, count, _timeout())
+    return count
+
+
+def get_shop_list_page(page_number, page_size, sort='popular'):
+    """指定ページの描画データ(list[dict])を返す"""
+    sort = normalize_list_sort(sort)
+    key = f'shop_list_page:{_versions()}:{sort}:{page_size}:{page_number}'
+    rows = cache.get(key)
+    if rows is None:
+        offset = (page_number - 1) * page_size
+        shops = shop_list_queryset(sort)[offset:offset + page_size]
+        rows = [build_shop_row(shop) for shop in shops]
+        cache.set(key, rows, _timeout())
+    return rows
+
+
+def next_cursor_for_page(rows, sort='popular'):
+    """ページ末尾の行から load_more_shops 用の同じ並び順のカーソルを作る"""
+    if not rows:
+        return None
+    last = rows[-1]
+    return encode_cursor(normalize_list_sort(sort), last['shop']['pk'], last['sort_key'])
+
+
+def favorite_shop_ids(user, shop_ids):
+    """表示中の店舗のうちユーザーがお気に入り済みの店舗IDの集合"""
+    if not user.is_authenticated or not shop_ids:
+        return set()
+    return set(Favorite.objects
+               .filter(user=user, shop_id__in=shop_ids)
+               .values_list('shop_id', flat=True))
+
+
+def overlay_favorites(rows, user):
+    """共通キャッシュの行データにユーザーごとの is_favorited を付与した新しいリストを返す"""
+    favorite_ids = favorite_shop_ids(user, [row['shop']['pk'] for row in rows])
+    return [dict(row, is_favorited=row['shop']['pk'] in favorite_ids) for row in rows]
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from shops.models import Shop, Category, fill_normalized_fields
+
+
+class Command(BaseCommand):
+    help = '店舗/カテゴリの検索用正規化カラム(name_normalized 等)を元の値から再計算する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        for model in (Shop, Category):
+            fields = list(model.NORMALIZED_FIELDS)
+            changed = []
+            total = 0
+            for obj in model.objects.order_by('pk').iterator(chunk_size=batch_size):
+                before = [getattr(obj, field) for field in fields]
+                fill_normalized_fields(obj)
+                if before != [getattr(obj, field) for field in fields]:
+                    changed.append(obj)
+                if len(changed) >= batch_size:
+                    model.objects.bulk_update(changed, fields)
+                    total += len(changed)
+                    changed = []
+            if changed:
+                model.objects.bulk_update(changed, fields)
+                total += len(changed)
+            self.stdout.write(self.style.SUCCESS(f'{model.__name__}: {total}件の正規化カラムを更新しました。'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from shops.similarity import CHUNK_SIZE, MIN_SCORE, TOP_K, build_shop_similarities
+
+
+class Command(BaseCommand):
+    help = 'お気に入り/レビュー/予約から店舗間の類似度(コサイン)を計算し、類似店舗テーブルを作り直す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=TOP_K, help='店舗ごとに保存する類似店舗数')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='一度に類似度を計算する店舗数')
+        parser.add_argument('--min-score', type=float, default=MIN_SCORE, help='保存する類似度の下限')
+
+    def handle(self, *args, **options):
+        saved = build_shop_similarities(options['top_k'], options['chunk_size'], options['min_score'])
+        self.stdout.write(self.style.SUCCESS(f'{saved}件の類似店舗を保存しました。'))
@@ -0,0 +1,58 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from shops.catalog import CATALOG, bump_version
+from shops.image_variants import generate_variants
+from shops.models import Image
+
+
+def _init_worker():
+    # spawn 方式で起動された子プロセスでも Django を使えるようにする
+    django.setup()
+    # fork で引き継いだ親のDB接続は使わない
+    connections.close_all()
+
+
+def _generate(name):
+    return name, generate_variants(name)
+
+
+class Command(BaseCommand):
+    help = '店舗画像のサイズ別派生画像(WebP/JPEG)を並列に生成し、Image.variants を更新する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='生成済みの画像も作り直す（省略時は未生成のみ）')
+        parser.add_argument('--workers', type=int, default=None, help='プロセス数（省略時はCPU数）')
+
+    def handle(self, *args, **options):
+        images = Image.objects.exclude(image='').only('pk', 'image', 'variants')
+        if not options['all']:
+            images = images.filter(variants={})
+        # 同じ元画像を参照する行は1回だけ生成する
+        ids_by_name = {}
+        for image in images.iterator():
+            ids_by_name.setdefault(image.image.name, []).append(image.pk)
+        if not ids_by_name:
+            self.stdout.write('対象の画像はありません。')
+            return
+
+        connections.close_all()
+        updated = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker) as executor:
+            futures = {executor.submit(_generate, name): name for name in ids_by_name}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    _, variants = future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'{name}: {e}')
+                    continue
+                updated += Image.objects.filter(pk__in=ids_by_name[name]).update(variants=variants)
+
+        if updated:
+            bump_version(CATALOG)
+        self.stdout.write(self.style.SUCCESS(f'{updated}件の画像の派生画像を生成しました（失敗: {failed}件）。'))
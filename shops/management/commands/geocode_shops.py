@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shops.catalog import CATALOG, bump_version
+from shops.geo import geocode_address, load_gazetteer
+from shops.models import Shop
+
+
+class Command(BaseCommand):
+    help = 'ローカルのガゼッティア(CSV/JSON)から店舗の緯度経度とgeohashを一括登録する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('gazetteer', help='address,latitude,longitude を持つ CSV または JSON ファイル')
+        parser.add_argument('--overwrite', action='store_true',
+                            help='位置登録済みの店舗も上書きする（省略時は未登録の店舗のみ）')
+        parser.add_argument('--dry-run', action='store_true', help='件数の表示のみで保存しない')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        try:
+            gazetteer = load_gazetteer(options['gazetteer'])
+        except (OSError, KeyError, ValueError, TypeError, IndexError) as e:
+            raise CommandError(f'ガゼッティアを読み込めません: {e}')
+
+        shops = Shop.objects.only('address', 'latitude', 'longitude', 'geohash').order_by('pk')
+        if not options['overwrite']:
+            shops = shops.filter(latitude__isnull=True)
+
+        matched = []
+        missing = 0
+        for shop in shops.iterator(chunk_size=options['batch_size']):
+            point = geocode_address(gazetteer, shop.address)
+            if point is None:
+                missing += 1
+                continue
+            shop.latitude, shop.longitude = point
+            shop.geohash = shop.compute_geohash()
+            matched.append(shop)
+
+        if not options['dry_run'] and matched:
+            Shop.objects.bulk_update(matched, ['latitude', 'longitude', 'geohash'], batch_size=options['batch_size'])
+            # bulk_update はシグナルを送らないので、近くのお店/検索のキャッシュをここで無効化する
+            bump_version(CATALOG)
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(matched)}件の店舗に位置を登録しました（一致なし: {missing}件）。'
+            + ('（dry-run のため保存していません）' if options['dry_run'] else '')
+        ))
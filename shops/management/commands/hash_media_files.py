@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from nagoyameshi.media import is_hashed_name
+from shops.image_variants import refresh_image_variants
+from shops.models import Image
+
+
+class Command(BaseCommand):
+    help = '旧形式の名前で保存された店舗画像を内容ハッシュ名に付け替え、派生画像を作り直す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='対象の表示のみ行う')
+        parser.add_argument('--keep-originals', action='store_true', help='付け替え前のファイルを削除しない')
+
+    def handle(self, *args, **options):
+        ids_by_name = {}
+        for image in Image.objects.exclude(image='').only('pk', 'image').iterator():
+            if not is_hashed_name(image.image.name):
+                ids_by_name.setdefault(image.image.name, []).append(image.pk)
+        if not ids_by_name:
+            self.stdout.write('対象の画像はありません。')
+            return
+
+        storage = Image._meta.get_field('image').storage
+        renamed = 0
+        for name, image_ids in ids_by_name.items():
+            if not storage.exists(name):
+                self.stderr.write(f'{name}: ファイルがありません')
+                continue
+            if options['dry_run']:
+                self.stdout.write(f'{name}: {len(image_ids)}件')
+                continue
+            with storage.open(name, 'rb') as f:
+                new_name = storage.save(name, f)
+            with transaction.atomic():
+                Image.objects.filter(pk__in=image_ids).update(image=new_name)
+            # 派生画像もハッシュ名で作り直す（古い派生画像は削除される）
+            refresh_image_variants(image_ids)
+            if not options['keep_originals'] and not Image.objects.filter(image=name).exists():
+                storage.delete(name)
+            self.stdout.write(f'{name} -> {new_name}')
+            renamed += 1
+        self.stdout.write(self.style.SUCCESS(f'{renamed}件のファイルを付け替えました。'))
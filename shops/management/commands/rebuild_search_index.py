@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from shops.search_index import index_shops, rebuild_index
+
+
+class Command(BaseCommand):
+    help = '店舗検索用の n-gram インデックス(shop_search_documents/shop_search_grams)を再構築する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shop', type=int, action='append', dest='shop_ids',
+                            help='対象の店舗ID（複数指定可）。省略時は全店舗')
+
+    def handle(self, *args, **options):
+        if options['shop_ids']:
+            indexed = index_shops(options['shop_ids'])
+        else:
+            indexed = rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f'{indexed}件の店舗を索引しました。'))
@@ -0,0 +1,38 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from shops.popularity import half_life_days, recompute_popularity
+
+
+class Command(BaseCommand):
+    help = ('店舗の人気度(お気に入り/レビュー/予約の時間減衰付き合計)を再計算する。'
+            '--interval を付けると常駐して定期的に再計算する（Procfile の popularity）')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='再計算の間隔（秒）。0なら1回だけ実行して終了する（cron 等から使う場合。既定: 0）')
+
+    def handle(self, *args, **options):
+        self.running = True
+        signal.signal(signal.SIGTERM, self._stop)
+        try:
+            while self.running:
+                close_old_connections()
+                changed = recompute_popularity()
+                self.stdout.write(self.style.SUCCESS(
+                    f'{changed}件の人気度を更新しました。（半減期 {half_life_days()}日）'
+                ))
+                if not options['interval']:
+                    break
+                # SIGTERM ですぐ止まれるよう1秒ずつ待つ
+                deadline = time.monotonic() + options['interval']
+                while self.running and time.monotonic() < deadline:
+                    time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+    def _stop(self, signum, frame):
+        self.running = False
@@ -0,0 +1,21 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from shops.inventory import rebuild_inventory
+
+
+class Command(BaseCommand):
+    help = '残席在庫(seat_inventories)を予約履歴から作り直す（管理画面等で予約を直接削除した場合のずれの修正）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shop', type=int, action='append', dest='shop_ids',
+                            help='対象の店舗ID（複数指定可）。省略時は全店舗')
+        parser.add_argument('--from-date', type=date.fromisoformat, default=None,
+                            help='この日付以降の在庫行が対象（YYYY-MM-DD。省略時は今日）')
+
+    def handle(self, *args, **options):
+        from_date = options['from_date'] or timezone.localdate()
+        updated = rebuild_inventory(options['shop_ids'], from_date)
+        self.stdout.write(self.style.SUCCESS(f'{updated}件の在庫行を修正しました。'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from shops.stats import rebuild_shop_stats
+
+
+class Command(BaseCommand):
+    help = ('店舗集計テーブル(shop_stats)をお気に入り/レビューの実データから再構築する。'
+            '全店舗のときは評価の全体平均(rating_prior)も計算し直す')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shop', type=int, action='append', dest='shop_ids',
+                            help='対象の店舗ID（複数指定可）。省略時は全店舗')
+
+    def handle(self, *args, **options):
+        changed = rebuild_shop_stats(options['shop_ids'])
+        self.stdout.write(self.style.SUCCESS(f'{changed}件の集計行を更新しました。'))
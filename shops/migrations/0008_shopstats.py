@@ -0,0 +1,53 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def populate_shop_stats(apps, schema_editor):
+    Shop = apps.get_model('shops', 'Shop')
+    ShopStats = apps.get_model('shops', 'ShopStats')
+    Favorite = apps.get_model('shops', 'Favorite')
+    Review = apps.get_model('shops', 'Review')
+
+    stats = {shop_id: ShopStats(shop_id=shop_id) for shop_id in Shop.objects.values_list('pk', flat=True)}
+    for row in Favorite.objects.values('shop_id').annotate(total=Count('id')):
+        stats[row['shop_id']].favorite_count = row['total']
+    rating_counts = {f'rating_{i}': Count('id', filter=Q(rating=i)) for i in range(1, 6)}
+    for row in Review.objects.values('shop_id').annotate(total=Count('id'), rating_total=Sum('rating'), **rating_counts):
+        item = stats[row['shop_id']]
+        item.review_count = row['total']
+        item.rating_sum = row['rating_total'] or 0
+        for i in range(1, 6):
+            setattr(item, f'rating_{i}', row[f'rating_{i}'])
+    ShopStats.objects.bulk_create(stats.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0007_history_created_at_review_is_visible'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShopStats',
+            fields=[
+                ('shop', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='shops.shop')),
+                ('favorite_count', models.PositiveIntegerField(default=0)),
+                ('review_count', models.PositiveIntegerField(default=0)),
+                ('rating_sum', models.PositiveIntegerField(default=0)),
+                ('rating_1', models.PositiveIntegerField(default=0)),
+                ('rating_2', models.PositiveIntegerField(default=0)),
+                ('rating_3', models.PositiveIntegerField(default=0)),
+                ('rating_4', models.PositiveIntegerField(default=0)),
+                ('rating_5', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'shop_stats',
+            },
+        ),
+        migrations.RunPython(populate_shop_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0009_catalogversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShopSearchDocument',
+            fields=[
+                ('shop', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='shops.shop')),
+                ('name', models.CharField(blank=True, default='', max_length=255)),
+                ('categories', models.TextField(blank=True, default='')),
+                ('address', models.CharField(blank=True, default='', max_length=255)),
+                ('phone', models.CharField(blank=True, default='', max_length=50)),
+                ('index_version', models.PositiveSmallIntegerField(default=0)),
+                ('indexed_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'shop_search_documents',
+            },
+        ),
+        migrations.CreateModel(
+            name='ShopSearchGram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gram', models.CharField(max_length=3)),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='shops.shop')),
+            ],
+            options={
+                'db_table': 'shop_search_grams',
+                'unique_together': {('gram', 'shop')},
+            },
+        ),
+    ]
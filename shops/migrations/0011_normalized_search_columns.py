@@ -0,0 +1,53 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:25
+
+from django.db import migrations, models
+
+from shops.normalize import normalize_phone, normalize_text
+
+
+def populate_normalized_columns(apps, schema_editor):
+    Shop = apps.get_model('shops', 'Shop')
+    Category = apps.get_model('shops', 'Category')
+
+    shops = list(Shop.objects.only('name', 'address', 'phone_number'))
+    for shop in shops:
+        shop.name_normalized = normalize_text(shop.name)[:100]
+        shop.address_normalized = normalize_text(shop.address)[:255]
+        shop.phone_digits = normalize_phone(shop.phone_number)[:15]
+    Shop.objects.bulk_update(shops, ['name_normalized', 'address_normalized', 'phone_digits'], batch_size=500)
+
+    categories = list(Category.objects.only('name'))
+    for category in categories:
+        category.name_normalized = normalize_text(category.name)[:50]
+    Category.objects.bulk_update(categories, ['name_normalized'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0010_shop_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='name_normalized',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='address_normalized',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='name_normalized',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='phone_digits',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=15),
+        ),
+        migrations.RunPython(populate_normalized_columns, migrations.RunPython.noop),
+    ]
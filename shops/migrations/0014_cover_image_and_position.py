@@ -0,0 +1,56 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_positions_and_covers(apps, schema_editor):
+    Shop = apps.get_model('shops', 'Shop')
+    Image = apps.get_model('shops', 'Image')
+
+    images = list(Image.objects.order_by('shop_id', 'id'))
+    covers = {}
+    position = 0
+    previous_shop_id = None
+    for image in images:
+        if image.shop_id != previous_shop_id:
+            position = 0
+            previous_shop_id = image.shop_id
+            covers[image.shop_id] = image.pk
+        image.position = position
+        position += 1
+    Image.objects.bulk_update(images, ['position'], batch_size=500)
+
+    shops = list(Shop.objects.filter(pk__in=list(covers)).only('pk'))
+    for shop in shops:
+        shop.cover_image_id = covers[shop.pk]
+    Shop.objects.bulk_update(shops, ['cover_image'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0013_image_variants'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='image',
+            options={'ordering': ['position', 'id']},
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='position',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='cover_image',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='shops.image'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['shop', 'position'], name='images_shop_position_idx'),
+        ),
+        migrations.RunPython(populate_positions_and_covers, migrations.RunPython.noop),
+    ]
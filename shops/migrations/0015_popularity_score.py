@@ -0,0 +1,86 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:39
+
+import math
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.utils import timezone
+
+# shops/popularity.py の初版の計算（移行時点の値で固定）
+HALF_LIFE_DAYS = 30
+HORIZON_HALF_LIVES = 8
+FAVORITE_WEIGHT = 1.0
+REVIEW_WEIGHT = 2.0
+RESERVATION_WEIGHT = 1.5
+REVIEW_RATING_FACTOR = 0.25
+# 既存のお気に入りの登録日時は分からないので、人気度の計算対象期間より十分古い日時にしておく
+# （移行時刻にすると過去のお気に入りが全て「今日の」お気に入りとして満点の重みになる）
+FAVORITE_BACKFILL_AT = datetime(2000, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def backfill_favorite_created_at(apps, schema_editor):
+    Favorite = apps.get_model('shops', 'Favorite')
+    Favorite.objects.filter(created_at__isnull=True).update(created_at=FAVORITE_BACKFILL_AT)
+
+
+def populate_popularity(apps, schema_editor):
+    ShopStats = apps.get_model('shops', 'ShopStats')
+    Favorite = apps.get_model('shops', 'Favorite')
+    Review = apps.get_model('shops', 'Review')
+    History = apps.get_model('shops', 'History')
+
+    now = timezone.now()
+    since = now - timedelta(days=HALF_LIFE_DAYS * HORIZON_HALF_LIVES)
+    scores = {}
+
+    def add(shop_id, created_at, weight):
+        age_days = max((now - created_at).total_seconds(), 0) / 86400
+        scores[shop_id] = scores.get(shop_id, 0.0) + weight * math.exp(-math.log(2) * age_days / HALF_LIFE_DAYS)
+
+    for shop_id, created_at in Favorite.objects.filter(created_at__gte=since).values_list('shop_id', 'created_at'):
+        add(shop_id, created_at, FAVORITE_WEIGHT)
+    reviews = Review.objects.filter(created_at__gte=since, is_visible=True).values_list('shop_id', 'created_at', 'rating')
+    for shop_id, created_at, rating in reviews:
+        add(shop_id, created_at, REVIEW_WEIGHT * (1 + REVIEW_RATING_FACTOR * (rating - 3)))
+    for shop_id, created_at in History.objects.filter(created_at__gte=since).values_list('shop_id', 'created_at'):
+        add(shop_id, created_at, RESERVATION_WEIGHT)
+
+    to_update = []
+    for stats in ShopStats.objects.filter(shop_id__in=scores):
+        stats.popularity_score = round(scores[stats.shop_id], 6)
+        stats.popularity_updated_at = now
+        to_update.append(stats)
+    ShopStats.objects.bulk_update(to_update, ['popularity_score', 'popularity_updated_at'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0014_cover_image_and_position'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='favorite',
+            name='created_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(backfill_favorite_created_at, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='favorite',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='shopstats',
+            name='popularity_score',
+            field=models.FloatField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='shopstats',
+            name='popularity_updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(populate_popularity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0015_popularity_score'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShopSimilarity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField()),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similarities', to='shops.shop')),
+                ('similar_shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='shops.shop')),
+            ],
+            options={
+                'db_table': 'shop_similarities',
+                'ordering': ['shop', 'rank'],
+                'constraints': [models.UniqueConstraint(fields=('shop', 'rank'), name='shop_similarities_shop_rank_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:42
+
+from django.db import migrations, models
+from django.db.models import Case, ExpressionWrapper, F, FloatField, Sum, Value, When
+
+# shops/stats.py の初版の計算（移行時点の値で固定）
+DEFAULT_PRIOR_MEAN = 3.0
+PRIOR_WEIGHT = 5.0
+
+
+def populate_bayesian_ratings(apps, schema_editor):
+    ShopStats = apps.get_model('shops', 'ShopStats')
+    totals = ShopStats.objects.aggregate(ratings=Sum('rating_sum'), reviews=Sum('review_count'))
+    mean = totals['ratings'] / totals['reviews'] if totals['reviews'] else DEFAULT_PRIOR_MEAN
+    ShopStats.objects.update(bayesian_rating=Case(
+        When(review_count__gt=0, then=ExpressionWrapper(
+            (Value(PRIOR_WEIGHT * mean) + F('rating_sum')) / (Value(PRIOR_WEIGHT) + F('review_count')),
+            output_field=FloatField(),
+        )),
+        default=Value(0.0),
+        output_field=FloatField(),
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0016_shop_similarities'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shopstats',
+            name='bayesian_rating',
+            field=models.FloatField(db_index=True, default=0),
+        ),
+        migrations.RunPython(populate_bayesian_ratings, migrations.RunPython.noop),
+    ]
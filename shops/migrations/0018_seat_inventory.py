@@ -0,0 +1,29 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0017_bayesian_rating'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeatInventory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('seat_count', models.PositiveIntegerField()),
+                ('remaining', models.PositiveIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='seat_inventories', to='shops.shop')),
+            ],
+            options={
+                'db_table': 'seat_inventories',
+                'constraints': [models.UniqueConstraint(fields=('shop', 'date'), name='seat_inventories_shop_date_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:17
+
+from django.db import migrations, models
+from django.db.models import Case, ExpressionWrapper, F, FloatField, Sum, Value, When
+
+# 移行時点の値で固定（以降は shops.stats.update_rating_prior が更新する）
+DEFAULT_PRIOR_MEAN = 3.0
+PRIOR_WEIGHT = 5.0
+
+
+def populate_rating_prior(apps, schema_editor):
+    """全体平均を1行に保存し、全店舗の bayesian_rating をその値で揃える"""
+    ShopStats = apps.get_model('shops', 'ShopStats')
+    RatingPrior = apps.get_model('shops', 'RatingPrior')
+    totals = ShopStats.objects.aggregate(ratings=Sum('rating_sum'), reviews=Sum('review_count'))
+    mean = totals['ratings'] / totals['reviews'] if totals['reviews'] else DEFAULT_PRIOR_MEAN
+    RatingPrior.objects.create(pk=1, mean=mean, weight=PRIOR_WEIGHT)
+    ShopStats.objects.update(bayesian_rating=Case(
+        When(review_count__gt=0, then=ExpressionWrapper(
+            (Value(PRIOR_WEIGHT * mean) + F('rating_sum')) / (Value(PRIOR_WEIGHT) + F('review_count')),
+            output_field=FloatField(),
+        )),
+        default=Value(0.0),
+        output_field=FloatField(),
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0018_seat_inventory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingPrior',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mean', models.FloatField()),
+                ('weight', models.FloatField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'rating_prior',
+            },
+        ),
+        migrations.RunPython(populate_rating_prior, migrations.RunPython.noop),
+    ]
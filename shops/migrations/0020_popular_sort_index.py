@@ -0,0 +1,65 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:39
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+# 移行時点の値で固定（shops.stats の DEFAULT_PRIOR_MEAN / RATING_PRIOR_WEIGHT）
+DEFAULT_PRIOR_MEAN = 3.0
+PRIOR_WEIGHT = 5.0
+
+
+def create_missing_shop_stats(apps, schema_editor):
+    """集計行の無い店舗（bulk_create / loaddata で作られた店舗）の行を実データから作る。
+    人気順/評価順は集計行のカラムで並べるため、全店舗に行がある前提にする。
+    popularity_score は 0 で作り、recompute_popularity の次の実行で埋まる
+    """
+    Shop = apps.get_model('shops', 'Shop')
+    ShopStats = apps.get_model('shops', 'ShopStats')
+    Favorite = apps.get_model('shops', 'Favorite')
+    Review = apps.get_model('shops', 'Review')
+    RatingPrior = apps.get_model('shops', 'RatingPrior')
+
+    missing = list(Shop.objects.filter(stats__isnull=True).values_list('pk', flat=True))
+    if not missing:
+        return
+    prior = RatingPrior.objects.filter(pk=1).values_list('mean', 'weight').first()
+    mean, weight = prior or (DEFAULT_PRIOR_MEAN, PRIOR_WEIGHT)
+
+    for start in range(0, len(missing), 500):
+        shop_ids = missing[start:start + 500]
+        rows = {shop_id: ShopStats(shop_id=shop_id) for shop_id in shop_ids}
+        favorites = (Favorite.objects.filter(shop_id__in=shop_ids)
+                     .values('shop_id').annotate(total=Count('id')).order_by())
+        for row in favorites:
+            rows[row['shop_id']].favorite_count = row['total']
+        rating_counts = {f'rating_{i}': Count('id', filter=Q(rating=i)) for i in range(1, 6)}
+        reviews = (Review.objects.filter(shop_id__in=shop_ids).values('shop_id')
+                   .annotate(total=Count('id'), rating_total=Sum('rating'), **rating_counts).order_by())
+        for row in reviews:
+            stats = rows[row['shop_id']]
+            stats.review_count = row['total']
+            stats.rating_sum = row['rating_total'] or 0
+            for i in range(1, 6):
+                setattr(stats, f'rating_{i}', row[f'rating_{i}'])
+            stats.bayesian_rating = (weight * mean + stats.rating_sum) / (weight + stats.review_count)
+        ShopStats.objects.bulk_create(rows.values(), batch_size=500, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0019_rating_prior'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_missing_shop_stats, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='shopstats',
+            name='popularity_score',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='shopstats',
+            index=models.Index(fields=['-popularity_score', 'shop'], name='shop_stats_popular_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0020_popular_sort_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='shopstats',
+            name='bayesian_rating',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='shopstats',
+            index=models.Index(fields=['-bayesian_rating', 'shop'], name='shop_stats_rating_idx'),
+        ),
+    ]
@@ -3,6 +3,23 @@ from accounts.models import User
 from django.utils import timezone
 from django.db.models import Sum
 
+from .geo import encode_geohash
+from .normalize import normalize_text, normalize_phone
+
+
+def fill_normalized_fields(instance, update_fields=None):
+    """NORMALIZED_FIELDS に従って正規化カラムを元の値から計算する。
+    update_fields 指定時は、元カラムに対応する正規化カラムも保存対象に加えて返す。
+    """
+    if update_fields is not None:
+        update_fields = set(update_fields)
+    for target, (source, normalize) in instance.NORMALIZED_FIELDS.items():
+        value = normalize(getattr(instance, source))
+        setattr(instance, target, value[:instance._meta.get_field(target).max_length])
+        if update_fields is not None and source in update_fields:
+            update_fields.add(target)
+    return update_fields
+
 # Create your models here.
 class Shop(models.Model):
     name = models.CharField(max_length=100, null=False, blank=False)
@@ -10,6 +27,23 @@ class Shop(models.Model):
     seat_count = models.PositiveIntegerField(null=False, blank=False)
     phone_number = models.CharField(max_length=15, null=True, blank=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=False, blank=False)
+    # 検索用の正規化済みカラム（save() で更新。既存行は backfill_normalized_columns で補完）
+    name_normalized = models.CharField(max_length=100, blank=True, default='', db_index=True, editable=False)
+    address_normalized = models.CharField(max_length=255, blank=True, default='', db_index=True, editable=False)
+    phone_digits = models.CharField(max_length=15, blank=True, default='', db_index=True, editable=False)
+    # 位置情報（geocode_shops でガゼッティアから一括登録）。geohash は近傍検索の絞り込み用
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    geohash = models.CharField(max_length=12, blank=True, default='', db_index=True, editable=False)
+    # 一覧で表示する代表画像（画像の追加/削除時に signals で維持する）
+    cover_image = models.ForeignKey('Image', related_name='+', null=True, blank=True,
+                                    on_delete=models.SET_NULL, editable=False)
+
+    NORMALIZED_FIELDS = {
+        'name_normalized': ('name', normalize_text),
+        'address_normalized': ('address', normalize_text),
+        'phone_digits': ('phone_number', normalize_phone),
+    }
 
     class Meta:
         db_table = 'shops'
@@ -17,8 +51,29 @@ class Shop(models.Model):
     def __str__(self):
         return f"{self.name}（{self.address}）"
 
+    def save(self, *args, **kwargs):
+        update_fields = fill_normalized_fields(self, kwargs.get('update_fields'))
+        self.geohash = self.compute_geohash()
+        if update_fields is not None and update_fields & {'latitude', 'longitude'}:
+            update_fields.add('geohash')
+        kwargs['update_fields'] = update_fields
+        super().save(*args, **kwargs)
+
+    def compute_geohash(self):
+        if self.latitude is None or self.longitude is None:
+            return ''
+        return encode_geohash(self.latitude, self.longitude)
+
     # 追加: 指定日の残席数を計算
     def remaining_seats_on(self, on_date):
+        # 予約のあった日は在庫行の値（予約ごとに原子的に減算済み）
+        remaining = self.seat_inventories.filter(date=on_date).values_list('remaining', flat=True).first()
+        if remaining is not None:
+            return remaining
+        return self.booked_remaining_seats_on(on_date)
+
+    def booked_remaining_seats_on(self, on_date):
+        """予約履歴を集計した残席数（在庫行の初期値に使う）"""
         booked = self.histories.filter(date=on_date).aggregate(total=Sum('number_of_people'))['total'] or 0
         remaining = self.seat_count - booked
         return remaining if remaining > 0 else 0
@@ -26,12 +81,48 @@ class Shop(models.Model):
 class Image(models.Model):
     shop = models.ForeignKey(Shop, related_name='images', on_delete=models.CASCADE)
     image = models.ImageField(upload_to='images/')
+    # サイズ別の派生画像（WebP/JPEG）のストレージ上の名前。保存時に signals から生成する
+    variants = models.JSONField(default=dict, blank=True, editable=False)
+    # 店舗内での表示順（0始まり・連番）。追加時は末尾、削除時は詰める
+    position = models.PositiveIntegerField(default=0)
 
     class Meta:
         db_table = 'images'
+        ordering = ['position', 'id']
+        indexes = [models.Index(fields=['shop', 'position'], name='images_shop_position_idx')]
 
     def __str__(self):
         return f"Image for {self.shop.name}"
+
+    def variant_url(self, variant, ext='jpeg'):
+        """派生画像のURL（未生成なら元画像のURL）"""
+        name = (self.variants or {}).get(variant, {}).get(ext)
+        return self.image.storage.url(name) if name else self.image.url
+
+    def _srcset(self, ext):
+        entries = sorted((entry for entry in (self.variants or {}).values() if entry.get(ext)),
+                         key=lambda entry: entry['width'])
+        return ', '.join(f"{self.image.storage.url(entry[ext])} {entry['width']}w" for entry in entries)
+
+    @property
+    def thumb_url(self):
+        return self.variant_url('thumb')
+
+    @property
+    def card_url(self):
+        return self.variant_url('card')
+
+    @property
+    def detail_url(self):
+        return self.variant_url('detail')
+
+    @property
+    def srcset(self):
+        return self._srcset('jpeg')
+
+    @property
+    def webp_srcset(self):
+        return self._srcset('webp')
     
 class Review(models.Model):
     shop = models.ForeignKey(Shop, related_name='reviews', on_delete=models.CASCADE)
@@ -60,9 +151,27 @@ class History(models.Model):
     class Meta:
         db_table = 'histories'
 
+class SeatInventory(models.Model):
+    """店舗・日付ごとの残席数。予約時に条件付き UPDATE で減らし、キャンセルで戻す（shops/inventory.py）"""
+    shop = models.ForeignKey(Shop, related_name='seat_inventories', on_delete=models.CASCADE)
+    date = models.DateField()
+    seat_count = models.PositiveIntegerField()
+    remaining = models.PositiveIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'seat_inventories'
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'date'], name='seat_inventories_shop_date_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.shop_id} {self.date}: {self.remaining}/{self.seat_count}"
+
 class Favorite(models.Model):
     shop = models.ForeignKey(Shop, related_name='favorites', on_delete=models.CASCADE)
     user = models.ForeignKey(User, related_name='favorites', on_delete=models.CASCADE)
+    created_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
         db_table = 'favorites'
@@ -73,10 +182,19 @@ class Favorite(models.Model):
 
 class Category(models.Model):
     name = models.CharField(max_length=50, unique=True)
+    name_normalized = models.CharField(max_length=50, blank=True, default='', db_index=True, editable=False)
+
+    NORMALIZED_FIELDS = {
+        'name_normalized': ('name', normalize_text),
+    }
 
     class Meta:
         db_table = 'categories'
 
+    def save(self, *args, **kwargs):
+        kwargs['update_fields'] = fill_normalized_fields(self, kwargs.get('update_fields'))
+        super().save(*args, **kwargs)
+
 class ShopCategory(models.Model):
     shop = models.ForeignKey(Shop, related_name='categories', on_delete=models.CASCADE)
     category = models.ForeignKey(Category, related_name='shop_categories', on_delete=models.CASCADE)
@@ -84,3 +202,121 @@ class ShopCategory(models.Model):
     class Meta:
         db_table = 'shop_categories'
         unique_together = ('shop', 'category')
+
+# 店舗ごとの集計値（お気に入り数・レビュー数・評価分布）を非正規化して保持する。
+# Favorite/Review の作成・更新・削除時に signals から差分更新される。
+class ShopStats(models.Model):
+    shop = models.OneToOneField(Shop, related_name='stats', on_delete=models.CASCADE, primary_key=True)
+    favorite_count = models.PositiveIntegerField(default=0)
+    review_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_1 = models.PositiveIntegerField(default=0)
+    rating_2 = models.PositiveIntegerField(default=0)
+    rating_3 = models.PositiveIntegerField(default=0)
+    rating_4 = models.PositiveIntegerField(default=0)
+    rating_5 = models.PositiveIntegerField(default=0)
+    # レビュー件数の少ない店舗を全体平均に寄せた評価（レビュー書き込み時に更新。レビュー無しは0）
+    bayesian_rating = models.FloatField(default=0)
+    # 時間減衰付きの人気度（recompute_popularity コマンドで定期的に再計算する）
+    popularity_score = models.FloatField(default=0)
+    popularity_updated_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'shop_stats'
+        indexes = [
+            # 人気順の一覧（popularity_score 降順 -> shop_id 昇順）をこの順のまま読む
+            models.Index(fields=['-popularity_score', 'shop'], name='shop_stats_popular_idx'),
+            # 評価順の一覧（bayesian_rating 降順 -> shop_id 昇順）
+            models.Index(fields=['-bayesian_rating', 'shop'], name='shop_stats_rating_idx'),
+        ]
+
+    def __str__(self):
+        return f"Stats for shop {self.shop_id}"
+
+    @property
+    def avg_rating(self):
+        if not self.review_count:
+            return 0
+        return self.rating_sum / self.review_count
+
+    @property
+    def rating_distribution(self):
+        """{評価: {'count': 件数, 'percentage': 割合}} を返す"""
+        distribution = {}
+        for rating in range(1, 6):
+            count = getattr(self, f'rating_{rating}')
+            distribution[rating] = {
+                'count': count,
+                'percentage': (count * 100 / self.review_count) if self.review_count > 0 else 0,
+            }
+        return distribution
+
+class ShopSimilarity(models.Model):
+    """店舗ごとの類似店舗（上位K件）。build_shop_similarities コマンドで作り直す"""
+    shop = models.ForeignKey(Shop, related_name='similarities', on_delete=models.CASCADE)
+    similar_shop = models.ForeignKey(Shop, related_name='+', on_delete=models.CASCADE)
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        db_table = 'shop_similarities'
+        ordering = ['shop', 'rank']
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'rank'], name='shop_similarities_shop_rank_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.shop_id} -> {self.similar_shop_id} ({self.score:.3f})"
+
+# ベイズ平均の事前分布（サイト全体で1行。全店舗の bayesian_rating はこの値で計算する）
+# shops.stats.update_rating_prior でだけ更新し、同時に全店舗の bayesian_rating を計算し直す
+class RatingPrior(models.Model):
+    SINGLETON_ID = 1
+
+    mean = models.FloatField()
+    weight = models.FloatField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'rating_prior'
+
+    def __str__(self):
+        return f"prior mean={self.mean:.3f} weight={self.weight:g}"
+
+# キャッシュ無効化用のバージョン番号（全ワーカーで共有するためDBに保持）
+# name: 'catalog'（店舗/画像/カテゴリ）, 'popularity'（お気に入り等の人気指標）
+class CatalogVersion(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'catalog_versions'
+
+    def __str__(self):
+        return f"{self.name}: {self.version}"
+
+# 店舗検索用 n-gram 転置インデックス
+# ShopSearchDocument: 正規化済みの検索対象テキスト（候補の検証と順位付けに使う）
+# ShopSearchGram: n-gram ごとのポスティング（gram -> 店舗）
+class ShopSearchDocument(models.Model):
+    shop = models.OneToOneField(Shop, related_name='search_document', on_delete=models.CASCADE, primary_key=True)
+    name = models.CharField(max_length=255, blank=True, default='')
+    categories = models.TextField(blank=True, default='')
+    address = models.CharField(max_length=255, blank=True, default='')
+    phone = models.CharField(max_length=50, blank=True, default='')
+    index_version = models.PositiveSmallIntegerField(default=0)
+    indexed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'shop_search_documents'
+
+
+class ShopSearchGram(models.Model):
+    gram = models.CharField(max_length=3)
+    shop = models.ForeignKey(Shop, related_name='+', on_delete=models.CASCADE)
+
+    class Meta:
+        db_table = 'shop_search_grams'
+        unique_together = ('gram', 'shop')
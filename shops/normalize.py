@@ -0,0 +1,46 @@
+"""
+検索用の文字列正規化
+全角/半角・大文字/小文字・カタカナ/ひらがなの違いを吸収し、索引と検索語で同じ表記に揃える。
+"""
+import re
+import unicodedata
+
+_WHITESPACE = re.compile(r'\s+')
+_NON_DIGIT = re.compile(r'\D')
+# 電話番号らしい入力（数字・ハイフン・括弧・+・空白のみ）
+_PHONE_LIKE = re.compile(r'^[\d\-()+ ]*\d[\d\-()+ ]*$')
+
+# カタカナ(ァ〜ヶ) -> ひらがな(ぁ〜ゖ)
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+
+
+def to_hiragana(value):
+    return value.translate(_KATAKANA_TO_HIRAGANA)
+
+
+def normalize_text(value):
+    """NFKC正規化 + 小文字化 + カタカナのひらがな化 + 連続空白の圧縮"""
+    if not value:
+        return ''
+    value = to_hiragana(unicodedata.normalize('NFKC', str(value)).casefold())
+    return _WHITESPACE.sub(' ', value).strip()
+
+
+def normalize_phone(value):
+    """電話番号を数字のみにする（全角数字もNFKCで半角化してから抽出）"""
+    if not value:
+        return ''
+    return _NON_DIGIT.sub('', unicodedata.normalize('NFKC', str(value)))
+
+
+def is_phone_like(value):
+    return bool(_PHONE_LIKE.match(unicodedata.normalize('NFKC', value or '')))
+
+
+def split_terms(query):
+    """検索語を空白で分割し、正規化済みの語のリストを返す（重複除去・順序維持）"""
+    terms = []
+    for term in normalize_text(query).split(' '):
+        if term and term not in terms:
+            terms.append(term)
+    return terms
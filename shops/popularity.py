@@ -0,0 +1,96 @@
+"""
+店舗の人気度（時間減衰付き）の一括計算
+- お気に入り・レビュー（評価で重み付け）・予約の各イベントに exp(-ln2 * 経過日数 / 半減期) の重みを付けて合計する
+- 店舗ごとの集計は numpy の bincount でまとめて行い、ShopStats.popularity_score に保存する
+- migration 0015 より前のお気に入りは登録日時が不明なため 2000-01-01 としており、計算対象の期間外になる
+- 一覧/検索の「人気順」はこのカラムの降順（初期値は migration 0015 で計算し、以降は Procfile の popularity
+  （recompute_popularity --interval 3600）が1時間ごとに更新する）
+"""
+import math
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .catalog import POPULARITY, bump_version
+from .models import Favorite, History, Review, Shop, ShopStats
+from .stats import rebuild_shop_stats
+
+# イベント1件あたりの重み
+FAVORITE_WEIGHT = 1.0
+REVIEW_WEIGHT = 2.0
+RESERVATION_WEIGHT = 1.5
+# 評価3を基準に、評価5のレビューは1.5倍、評価1のレビューは0.5倍
+REVIEW_RATING_FACTOR = 0.25
+# 半減期の何倍より古いイベントは読み込まない（重みが0.4%未満になるため）
+HORIZON_HALF_LIVES = 8
+
+
+def half_life_days():
+    return getattr(settings, 'POPULARITY_HALF_LIFE_DAYS', 30)
+
+
+def decay_weights(created_at, now, half_life):
+    """各イベントの減衰後の重み（numpy 配列）"""
+    ages = np.array([(now - value).total_seconds() for value in created_at], dtype=float) / 86400
+    return np.exp(-math.log(2) * np.maximum(ages, 0) / half_life)
+
+
+def compute_popularity(now=None):
+    """全店舗の人気度を (shop_ids, scores) の numpy 配列で返す"""
+    now = now or timezone.now()
+    half_life = half_life_days()
+    since = now - timedelta(days=half_life * HORIZON_HALF_LIVES)
+
+    shop_ids = np.array(sorted(Shop.objects.values_list('pk', flat=True)), dtype=np.int64)
+    scores = np.zeros(len(shop_ids))
+    if not len(shop_ids):
+        return shop_ids, scores
+
+    def accumulate(rows, weight, factors=None):
+        if not rows:
+            return
+        ids, created_at = zip(*rows)
+        positions = np.searchsorted(shop_ids, np.asarray(ids, dtype=np.int64))
+        weights = weight * decay_weights(created_at, now, half_life)
+        if factors is not None:
+            weights *= factors
+        scores[:] += np.bincount(positions, weights=weights, minlength=len(shop_ids))
+
+    accumulate(list(Favorite.objects.filter(created_at__gte=since).values_list('shop_id', 'created_at')),
+               FAVORITE_WEIGHT)
+    reviews = list(Review.objects.filter(created_at__gte=since, is_visible=True)
+                   .values_list('shop_id', 'created_at', 'rating'))
+    accumulate([row[:2] for row in reviews], REVIEW_WEIGHT,
+               1 + REVIEW_RATING_FACTOR * (np.array([row[2] for row in reviews], dtype=float) - 3))
+    accumulate(list(History.objects.filter(created_at__gte=since).values_list('shop_id', 'created_at')),
+               RESERVATION_WEIGHT)
+    return shop_ids, np.round(scores, 6)
+
+
+def recompute_popularity(now=None):
+    """人気度を再計算して ShopStats に保存する。値が変わった行数を返す。"""
+    now = now or timezone.now()
+    shop_ids, scores = compute_popularity(now)
+    score_by_shop = dict(zip(shop_ids.tolist(), scores.tolist()))
+
+    # 集計行の無い店舗は先に作っておく
+    missing = set(score_by_shop) - set(ShopStats.objects.values_list('shop_id', flat=True))
+    if missing:
+        rebuild_shop_stats(list(missing))
+
+    to_update = []
+    for stats in ShopStats.objects.only('shop_id', 'popularity_score'):
+        score = score_by_shop.get(stats.shop_id)
+        if score is not None and stats.popularity_score != score:
+            stats.popularity_score = score
+            stats.popularity_updated_at = now
+            to_update.append(stats)
+    with transaction.atomic():
+        ShopStats.objects.bulk_update(to_update, ['popularity_score', 'popularity_updated_at'], batch_size=500)
+        if to_update:
+            # 人気順の一覧キャッシュを作り直すため
+            bump_version(POPULARITY)
+    return len(to_update)
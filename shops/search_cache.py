@@ -0,0 +1,140 @@
+"""
+店舗検索の結果キャッシュ
+- 正規化した検索条件 -> 並び順どおりの店舗IDリスト + カテゴリ別件数 をキャッシュする
+- キーにカタログのバージョンを含めるため、店舗/カテゴリの変更で自動的に無効になる
+- 件数とページの切り出しはキャッシュしたIDリストから行い、表示するページ分だけDBから取得する
+- 現在地検索は条件が利用者ごとに異なるためキャッシュしない
+- 人気順/評価順(sort='popular'/'rating')は人気度のバージョンもキーに含める
+"""
+import hashlib
+import json
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .bitmaps import get_category_bitmaps
+from .catalog import CATALOG, POPULARITY, get_version
+from .geo import nearby_shop_distances
+from .models import Shop, ShopStats
+from .normalize import split_terms
+from .search_index import fallback_filter, search_shop_ids
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'bypass': 0}
+
+
+def _timeout():
+    return getattr(settings, 'SEARCH_RESULT_CACHE_TIMEOUT', 300)
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def search_cache_stats():
+    """このワーカーでのキャッシュ利用状況"""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else None
+    return stats
+
+
+SORTS = ('relevance', 'popular', 'rating')
+# 並び替えに使う集計行のカラム（インデックス付き）
+STATS_ORDER_FIELDS = {'popular': 'popularity_score', 'rating': 'bayesian_rating'}
+
+
+def normalize_sort(sort):
+    return sort if sort in SORTS else 'relevance'
+
+
+def search_cache_key(query, category_ids, category_op, sort='relevance'):
+    criteria = {
+        'q': split_terms(query),
+        'c': sorted(category_ids),
+        'op': category_op if len(category_ids) > 1 else 'or',
+    }
+    version = get_version(CATALOG)
+    if sort in STATS_ORDER_FIELDS:
+        criteria['s'] = sort
+        version = f'{version}.{get_version(POPULARITY)}'
+    digest = hashlib.md5(json.dumps(criteria, ensure_ascii=False).encode('utf-8')).hexdigest()
+    return f'search_result:{version}:{digest}'
+
+
+def _stats_order(ids, field):
+    """店舗IDを集計行のカラムの降順(同値はid昇順)に並べ替える。読むのは一致した店舗の集計行だけ"""
+    values = {}
+    for start in range(0, len(ids), 1000):
+        values.update(ShopStats.objects
+                      .filter(shop_id__in=ids[start:start + 1000])
+                      .values_list('shop_id', field))
+    ranked = sorted(values, key=lambda shop_id: (-values[shop_id], shop_id))
+    # 集計行の無い店舗は末尾
+    return ranked + [shop_id for shop_id in ids if shop_id not in values]
+
+
+def run_search(query, category_ids, category_op='or', near=None, sort='relevance'):
+    """検索を実行して {'ids': [...], 'facets': {category_id: count}, 'distances': {shop_id: km}} を返す。
+    sort='popular' は人気度順、'rating' は評価(ベイズ平均)順、'relevance' はキーワードの一致度順（キーワード無しは id 順）。
+    現在地指定時は常に距離順。
+    """
+    qs = Shop.objects.all()
+    ranked_ids = None  # 並び順付きの候補ID（None は id 順）
+    distances = {}
+
+    if query:
+        # n-gram インデックスでスコア順の店舗IDを取得（索引が使えない場合は None）
+        ranked_ids = search_shop_ids(query)
+        if ranked_ids is not None:
+            qs = qs.filter(pk__in=ranked_ids)
+        else:
+            qs = qs.filter(fallback_filter(query))
+
+    if near:
+        # 近くのお店: geohash 近傍セルで絞り込んだ候補を距離順に並べる
+        nearby = nearby_shop_distances(qs, *near)
+        distances = dict(nearby)
+        ranked_ids = [shop_id for shop_id, _ in nearby]
+
+    # カテゴリの AND/OR 絞り込みとファセット件数はビットマップで計算する
+    bitmaps = get_category_bitmaps()
+    if ranked_ids is not None:
+        base = bitmaps.from_ids(ranked_ids)
+    elif query:
+        base = bitmaps.from_ids(qs.values_list('pk', flat=True))
+    else:
+        base = bitmaps.universe
+    selected = bitmaps.select(category_ids, category_op) if category_ids else bitmaps.universe
+    # AND は選択済みカテゴリとの組み合わせ件数、OR は追加で選んだ場合の件数
+    facets = bitmaps.facet_counts(base & selected if category_op == 'and' else base)
+
+    matched = base & selected
+    if ranked_ids is not None:
+        ids = [shop_id for shop_id in ranked_ids if bitmaps.contains(matched, shop_id)]
+    else:
+        ids = bitmaps.to_ids(matched)
+    if sort in STATS_ORDER_FIELDS and not near:
+        ids = _stats_order(ids, STATS_ORDER_FIELDS[sort])
+    return {'ids': ids, 'facets': facets, 'distances': distances}
+
+
+def get_search_result(query, category_ids, category_op='or', near=None, sort='relevance'):
+    """キャッシュ済みの検索結果を返す（無ければ検索してキャッシュする）"""
+    sort = normalize_sort(sort)
+    if near:
+        _count('bypass')
+        return run_search(query, category_ids, category_op, near, sort)
+
+    key = search_cache_key(query, category_ids, category_op, sort)
+    result = cache.get(key)
+    if result is not None:
+        _count('hits')
+        return result
+    _count('misses')
+    result = run_search(query, category_ids, category_op, sort=sort)
+    cache.set(key, result, _timeout())
+    return result
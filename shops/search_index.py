@@ -0,0 +1,202 @@
+"""
+店舗検索用 n-gram(bigram) 転置インデックス
+- 店舗/カテゴリの保存時に対象店舗だけを再索引する（signals から schedule_reindex）
+- 検索はポスティングリストの積集合で候補を絞り、正規化テキストで検証して順位付けする
+- 索引が未構築/古い場合は None を返し、呼び出し側で正規化カラムへのORM検索(fallback_filter)にフォールバックする
+"""
+import threading
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+
+from .catalog import CATALOG, get_version
+from .models import Shop, ShopCategory, ShopSearchDocument, ShopSearchGram
+from .normalize import is_phone_like, normalize_phone, normalize_text, split_terms
+
+GRAM_SIZE = 2
+# 正規化ルールや索引の形式を変えたら上げる（古い索引は stale 扱いになる）
+INDEX_VERSION = 2
+
+# 一致したフィールドの重み（店名 > カテゴリ > 住所 > 電話番号）
+FIELD_WEIGHTS = {'name': 8, 'categories': 4, 'address': 2, 'phone': 1}
+NAME_PREFIX_BONUS = 4
+
+_pending = threading.local()
+
+
+def make_grams(text):
+    """空白で区切った語ごとの n-gram 集合（n文字未満の語はそのまま1件）"""
+    grams = set()
+    for word in text.split():
+        if len(word) <= GRAM_SIZE:
+            grams.add(word)
+            continue
+        for i in range(len(word) - GRAM_SIZE + 1):
+            grams.add(word[i:i + GRAM_SIZE])
+    return grams
+
+
+def build_document(shop):
+    """索引対象の正規化テキスト。categories は prefetch 済みを想定"""
+    return {
+        'name': normalize_text(shop.name),
+        'categories': '\n'.join(normalize_text(sc.category.name) for sc in shop.categories.all()),
+        'address': normalize_text(shop.address),
+        'phone': normalize_phone(shop.phone_number),
+    }
+
+
+def index_shops(shop_ids):
+    """指定店舗の文書とポスティングを作り直す。削除済みの店舗は無視する。"""
+    shop_ids = list(shop_ids)
+    if not shop_ids:
+        return 0
+    shops = Shop.objects.filter(pk__in=shop_ids).prefetch_related('categories__category')
+    documents = []
+    grams = []
+    for shop in shops:
+        fields = build_document(shop)
+        documents.append(ShopSearchDocument(shop_id=shop.pk, index_version=INDEX_VERSION, **fields))
+        shop_grams = set()
+        for text in fields.values():
+            shop_grams |= make_grams(text)
+        grams.extend(ShopSearchGram(gram=gram, shop_id=shop.pk) for gram in shop_grams)
+
+    with transaction.atomic():
+        ShopSearchGram.objects.filter(shop_id__in=shop_ids).delete()
+        ShopSearchDocument.objects.filter(shop_id__in=shop_ids).delete()
+        ShopSearchDocument.objects.bulk_create(documents, batch_size=500)
+        ShopSearchGram.objects.bulk_create(grams, batch_size=1000)
+    return len(documents)
+
+
+def rebuild_index(batch_size=200):
+    """全店舗を索引し直す。索引した店舗数を返す。"""
+    total = 0
+    shop_ids = list(Shop.objects.order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(shop_ids), batch_size):
+        total += index_shops(shop_ids[start:start + batch_size])
+    return total
+
+
+def _flush_pending():
+    shop_ids = _pending.__dict__.pop('shop_ids', None)
+    if shop_ids:
+        index_shops(shop_ids)
+
+
+def schedule_reindex(shop_ids):
+    """コミット後に再索引する。同一トランザクション内の重複はまとめて1回にする。"""
+    _pending.__dict__.setdefault('shop_ids', set()).update(shop_ids)
+    transaction.on_commit(_flush_pending)
+
+
+def schedule_category_reindex(category_id):
+    """カテゴリ名の変更時、そのカテゴリに属する店舗を再索引する"""
+    def _reindex():
+        index_shops(ShopCategory.objects.filter(category_id=category_id).values_list('shop_id', flat=True))
+    transaction.on_commit(_reindex)
+
+
+def index_is_fresh():
+    """全店舗が現行バージョンで索引済みか（カタログ版ごとに短時間キャッシュ）"""
+    key = f'search_index_fresh:{get_version(CATALOG)}'
+    fresh = cache.get(key)
+    if fresh is None:
+        indexed = ShopSearchDocument.objects.filter(index_version=INDEX_VERSION).count()
+        fresh = indexed == Shop.objects.count()
+        cache.set(key, fresh, 60)
+    return fresh
+
+
+def term_variants(term):
+    """検索語の照合形。電話番号らしい語は数字のみの形も加える（052-123 と 052123 を同一視）"""
+    variants = [term]
+    if is_phone_like(term):
+        digits = normalize_phone(term)
+        if digits and digits != term:
+            variants.append(digits)
+    return variants
+
+
+def _score(document, terms):
+    score = 0
+    for term in terms:
+        term_score = 0
+        for variant in term_variants(term):
+            for field, weight in FIELD_WEIGHTS.items():
+                if variant in getattr(document, field):
+                    term_score = max(term_score, weight)
+            if term_score and document.name.startswith(variant):
+                term_score += NAME_PREFIX_BONUS
+                break
+        if not term_score:
+            return 0
+        score += term_score
+    return score
+
+
+def search_shop_ids(query):
+    """検索語に一致する店舗IDをスコア順で返す。索引を使えない場合は None。
+    複数語は AND 条件。
+    """
+    terms = split_terms(query)
+    if not terms or not index_is_fresh():
+        return None
+    variants = {term: [v for v in term_variants(term) if len(v) >= GRAM_SIZE] for term in terms}
+    if not all(variants.values()):
+        return None
+
+    query_grams = set()
+    for term in terms:
+        for variant in variants[term]:
+            query_grams |= make_grams(variant)
+
+    postings = {}
+    for gram, shop_id in ShopSearchGram.objects.filter(gram__in=query_grams).values_list('gram', 'shop_id'):
+        postings.setdefault(gram, set()).add(shop_id)
+
+    def matching(variant):
+        # 短いポスティングから順に積集合をとる
+        grams = sorted(make_grams(variant), key=lambda g: len(postings.get(g, ())))
+        result = None
+        for gram in grams:
+            result = postings.get(gram, set()) if result is None else result & postings.get(gram, set())
+            if not result:
+                return set()
+        return result
+
+    # 語ごとに (照合形の和集合) をとり、語同士は積集合（AND）
+    candidates = None
+    for term in terms:
+        matched = set().union(*(matching(variant) for variant in variants[term]))
+        candidates = matched if candidates is None else candidates & matched
+        if not candidates:
+            return []
+
+    # n-gram の積集合は連続性を保証しないため、正規化テキストで検証しつつ採点する
+    scored = []
+    for document in ShopSearchDocument.objects.filter(shop_id__in=candidates):
+        score = _score(document, terms)
+        if score:
+            scored.append((-score, document.shop_id))
+    scored.sort()
+    return [shop_id for _, shop_id in scored]
+
+
+def fallback_filter(query):
+    """索引を使えない場合の検索条件。正規化カラムに対して語ごとに AND で照合する。
+    カテゴリ名は前方一致、電話番号は数字のみで前方一致（いずれもインデックスを使える）。
+    カテゴリは Exists で判定し、JOIN による重複行(distinct)を避ける。
+    """
+    condition = Q()
+    for term in split_terms(query):
+        term_q = (Q(name_normalized__contains=term)
+                  | Q(address_normalized__contains=term)
+                  | Exists(ShopCategory.objects.filter(
+                        shop=OuterRef('pk'), category__name_normalized__startswith=term)))
+        if is_phone_like(term):
+            term_q |= Q(phone_digits__startswith=normalize_phone(term))
+        condition &= term_q
+    return condition
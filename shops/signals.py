@@ -0,0 +1,176 @@
+"""
+shopsアプリのシグナル受信処理
+- Favorite/Review の書き込みに合わせて ShopStats を差分更新する
+- 店舗/画像/カテゴリ/お気に入りの変更でキャッシュ用バージョンを進める
+- 店舗/カテゴリの変更で検索インデックスを再索引する
+- 画像の保存時にサイズ別の派生画像を生成し、削除時に片付ける
+- 画像の追加/削除に合わせて表示順と店舗の代表画像を維持する
+- 座席数の変更を今日以降の残席在庫に反映する
+"""
+from django.db import transaction
+from django.db.models.signals import post_init, pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .catalog import CATALOG, POPULARITY, bump_version
+from .models import Shop, ShopStats, Favorite, Review, Image, Category, ShopCategory
+from .covers import assign_cover_if_missing, close_position_gap, next_position
+from .image_variants import delete_variants, refresh_image_variants
+from .inventory import adjust_capacity
+from .search_index import schedule_category_reindex, schedule_reindex
+from .stats import apply_favorite_delta, apply_review_change
+
+
+def _review_snapshot(review):
+    if review.shop_id is None or review.rating is None:
+        return None
+    return (review.shop_id, int(review.rating))
+
+
+@receiver(post_save, sender=Shop)
+def create_shop_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        ShopStats.objects.get_or_create(shop=instance)
+
+
+@receiver(post_init, sender=Shop)
+def remember_seat_count(sender, instance, **kwargs):
+    instance._original_seat_count = instance.__dict__.get('seat_count') if instance.pk else None
+
+
+@receiver(post_save, sender=Shop)
+def shop_capacity_changed(sender, instance, created, raw=False, **kwargs):
+    previous = getattr(instance, '_original_seat_count', None)
+    if not created and not raw and previous is not None and previous != instance.seat_count:
+        adjust_capacity(instance.pk, previous, instance.seat_count, timezone.localdate())
+    instance._original_seat_count = instance.seat_count
+
+
+@receiver(post_save, sender=Favorite)
+def favorite_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        apply_favorite_delta(instance.shop_id, 1)
+
+
+@receiver(post_delete, sender=Favorite)
+def favorite_deleted(sender, instance, **kwargs):
+    # 店舗削除のカスケード中に集計行を作り直さないよう、削除時は行の新規作成をしない
+    apply_favorite_delta(instance.shop_id, -1, create_missing=False)
+
+
+@receiver(post_init, sender=Review)
+def remember_review_rating(sender, instance, **kwargs):
+    # 編集前の (店舗, 評価) を保持し、保存時の差分計算に使う
+    instance._stats_snapshot = _review_snapshot(instance) if instance.pk else None
+
+
+@receiver(post_save, sender=Review)
+def review_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    current = _review_snapshot(instance)
+    previous = None if created else getattr(instance, '_stats_snapshot', None)
+    apply_review_change(previous, current)
+    instance._stats_snapshot = current
+
+
+@receiver(post_delete, sender=Review)
+def review_deleted(sender, instance, **kwargs):
+    previous = getattr(instance, '_stats_snapshot', None) or _review_snapshot(instance)
+    apply_review_change(previous, None, create_missing=False)
+
+
+@receiver(post_save, sender=Shop)
+@receiver(post_delete, sender=Shop)
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=ShopCategory)
+@receiver(post_delete, sender=ShopCategory)
+def catalog_changed(sender, raw=False, **kwargs):
+    if not raw:
+        bump_version(CATALOG)
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_delete, sender=Favorite)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def popularity_changed(sender, raw=False, **kwargs):
+    if not raw:
+        bump_version(POPULARITY)
+
+
+@receiver(post_save, sender=Shop)
+def shop_search_reindex(sender, instance, raw=False, **kwargs):
+    if not raw:
+        schedule_reindex([instance.pk])
+
+
+@receiver(post_save, sender=ShopCategory)
+@receiver(post_delete, sender=ShopCategory)
+def shop_category_search_reindex(sender, instance, raw=False, **kwargs):
+    if not raw:
+        schedule_reindex([instance.shop_id])
+
+
+@receiver(post_save, sender=Category)
+def category_search_reindex(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        schedule_category_reindex(instance.pk)
+
+
+@receiver(post_init, sender=Image)
+def remember_image_name(sender, instance, **kwargs):
+    instance._original_image_name = instance.image.name if instance.pk else None
+
+
+@receiver(post_save, sender=Image)
+def image_saved(sender, instance, created, raw=False, **kwargs):
+    if raw or not instance.image:
+        return
+    if created or instance.image.name != instance._original_image_name or not instance.variants:
+        image_id = instance.pk
+
+        def _generate():
+            # 生成に失敗しても保存自体は成功させる（未生成の間は元画像を表示する）
+            try:
+                refresh_image_variants([image_id])
+            except Exception as e:
+                print(f"Image variant generation failed (image {image_id}): {e}")
+        transaction.on_commit(_generate)
+    instance._original_image_name = instance.image.name
+
+
+@receiver(post_delete, sender=Image)
+def image_deleted(sender, instance, **kwargs):
+    variants = instance.variants
+    name = instance.image.name
+    storage = instance.image.storage
+
+    def _cleanup():
+        # 同じ元画像を使う行が残っている場合は派生画像も共有しているため消さない
+        if not Image.objects.filter(image=name).exists():
+            delete_variants(variants, storage)
+    transaction.on_commit(_cleanup)
+
+
+@receiver(pre_save, sender=Image)
+def place_new_image_last(sender, instance, raw=False, **kwargs):
+    # 表示順を指定せずに追加された画像は末尾に置く
+    if not raw and instance._state.adding and not instance.position:
+        instance.position = next_position(instance.shop_id)
+
+
+@receiver(post_save, sender=Image)
+def image_cover_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        Shop.objects.filter(pk=instance.shop_id, cover_image__isnull=True).update(cover_image=instance.pk)
+
+
+@receiver(post_delete, sender=Image)
+def image_cover_deleted(sender, instance, **kwargs):
+    # 代表画像だった場合は on_delete=SET_NULL で外れているため、残りの先頭を代表にする
+    close_position_gap(instance.shop_id, instance.position)
+    assign_cover_if_missing(instance.shop_id)
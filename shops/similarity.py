@@ -0,0 +1,121 @@
+"""
+類似店舗（アイテム間協調フィルタリング）
+- お気に入り・レビュー（評価で重み付け）・予約から ユーザー×店舗 の疎行列を作る
+- 店舗ベクトルを正規化し、コサイン類似度の上位K件を店舗のチャンク単位で計算して ShopSimilarity に保存する
+- 画面では保存済みの近傍を (shop, rank) のインデックスで1クエリで読む
+"""
+import numpy as np
+from django.db import transaction
+from django.db.models import Sum
+from scipy import sparse
+
+from .models import Favorite, History, Review, Shop, ShopSimilarity
+
+TOP_K = 10
+CHUNK_SIZE = 256
+MIN_SCORE = 0.01
+
+FAVORITE_WEIGHT = 1.0
+RESERVATION_WEIGHT = 1.0
+# 評価2以下のレビューは好みの根拠にしない（評価5で1.0）
+REVIEW_WEIGHTS = {1: 0.0, 2: 0.0, 3: 1 / 3, 4: 2 / 3, 5: 1.0}
+
+
+def interaction_matrix():
+    """(matrix, shop_ids) を返す。matrix は ユーザー×店舗 の CSC 行列（列が shop_ids の順）"""
+    shop_ids = np.array(sorted(Shop.objects.values_list('pk', flat=True)), dtype=np.int64)
+    users, shops, weights = [], [], []
+    for user_id, shop_id in Favorite.objects.values_list('user_id', 'shop_id'):
+        users.append(user_id)
+        shops.append(shop_id)
+        weights.append(FAVORITE_WEIGHT)
+    for user_id, shop_id, rating in Review.objects.filter(user__isnull=False).values_list('user_id', 'shop_id', 'rating'):
+        weight = REVIEW_WEIGHTS.get(rating, 0.0)
+        if weight:
+            users.append(user_id)
+            shops.append(shop_id)
+            weights.append(weight)
+    for user_id, shop_id in History.objects.values_list('user_id', 'shop_id'):
+        users.append(user_id)
+        shops.append(shop_id)
+        weights.append(RESERVATION_WEIGHT)
+
+    if not users or not len(shop_ids):
+        return sparse.csc_matrix((0, len(shop_ids))), shop_ids
+    user_index, rows = np.unique(np.asarray(users, dtype=np.int64), return_inverse=True)
+    cols = np.searchsorted(shop_ids, np.asarray(shops, dtype=np.int64))
+    matrix = sparse.coo_matrix((np.asarray(weights), (rows, cols)),
+                               shape=(len(user_index), len(shop_ids))).tocsc()
+    matrix.sum_duplicates()
+    # 同じ店舗への繰り返しの利用は逓減させる
+    matrix.data = np.log1p(matrix.data)
+    return matrix, shop_ids
+
+
+def top_k_similar(matrix, top_k=TOP_K, chunk_size=CHUNK_SIZE, min_score=MIN_SCORE):
+    """列(店舗)ごとのコサイン類似度上位K件を {列番号: [(列番号, score), ...]} で返す"""
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    inverse = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    normalized = (matrix @ sparse.diags(inverse)).tocsc()
+    transposed = normalized.T.tocsr()
+
+    result = {}
+    n_shops = matrix.shape[1]
+    for start in range(0, n_shops, chunk_size):
+        end = min(start + chunk_size, n_shops)
+        # チャンク内の店舗 × 全店舗 の類似度（密行列はチャンク分だけ）
+        scores = (transposed[start:end] @ normalized).toarray()
+        scores[np.arange(end - start), np.arange(start, end)] = 0.0
+        k = min(top_k, n_shops - 1)
+        if k <= 0:
+            break
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        for offset, row in enumerate(candidates):
+            row_scores = scores[offset, row]
+            order = np.lexsort((row, -row_scores))
+            neighbours = [(int(row[i]), float(row_scores[i])) for i in order if row_scores[i] >= min_score]
+            if neighbours:
+                result[start + offset] = neighbours
+    return result
+
+
+def build_shop_similarities(top_k=TOP_K, chunk_size=CHUNK_SIZE, min_score=MIN_SCORE):
+    """類似店舗テーブルを作り直す。保存した行数を返す。"""
+    matrix, shop_ids = interaction_matrix()
+    neighbours = top_k_similar(matrix, top_k, chunk_size, min_score) if matrix.nnz else {}
+    rows = [
+        ShopSimilarity(shop_id=int(shop_ids[column]), similar_shop_id=int(shop_ids[other]),
+                       rank=rank, score=round(score, 6))
+        for column, items in neighbours.items()
+        for rank, (other, score) in enumerate(items, start=1)
+    ]
+    with transaction.atomic():
+        ShopSimilarity.objects.all().delete()
+        ShopSimilarity.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def similar_shops(shop_id, limit=6):
+    """保存済みの類似店舗を類似度順に返す（1クエリ）"""
+    similarities = (ShopSimilarity.objects
+                    .filter(shop_id=shop_id, rank__lte=limit)
+                    .select_related('similar_shop__stats', 'similar_shop__cover_image')
+                    .order_by('rank'))
+    return [similarity.similar_shop for similarity in similarities]
+
+
+def recommended_shops_for_user(user, limit=6):
+    """ユーザーが利用した店舗の類似店舗を類似度の合計順に返す（利用済みの店舗は除く）"""
+    used_ids = set(Favorite.objects.filter(user=user).values_list('shop_id', flat=True))
+    used_ids.update(History.objects.filter(user=user).values_list('shop_id', flat=True))
+    if not used_ids:
+        return []
+    ranked = list(ShopSimilarity.objects
+                  .filter(shop_id__in=used_ids)
+                  .exclude(similar_shop_id__in=used_ids)
+                  .values('similar_shop_id')
+                  .annotate(total=Sum('score'))
+                  .order_by('-total', 'similar_shop_id')
+                  .values_list('similar_shop_id', flat=True)[:limit])
+    shops = Shop.objects.filter(pk__in=ranked).select_related('stats', 'cover_image').in_bulk()
+    return [shops[shop_id] for shop_id in ranked if shop_id in shops]
@@ -0,0 +1,197 @@
+"""
+店舗集計テーブル(ShopStats)の差分更新・再構築ユーティリティ
+一覧/検索/詳細で毎回 Count/Avg を集計しないよう、書き込み時に集計値を更新する。
+評価順の並び替えには、件数の少ない店舗の平均を全体平均に寄せたベイズ平均(bayesian_rating)を使う。
+全体平均（事前分布）は RatingPrior の1行に保存し、全店舗で同じ値を使う（update_rating_prior でだけ更新する）。
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, ExpressionWrapper, F, FloatField, Q, Sum, Value, When
+from django.utils import timezone
+
+from .models import Shop, ShopStats, Favorite, RatingPrior, Review
+
+RATING_FIELDS = [f'rating_{i}' for i in range(1, 6)]
+DEFAULT_PRIOR_MEAN = 3.0
+
+
+def get_shop_stats(shop):
+    """店舗の集計行を返す。select_related('stats')済みなら追加クエリなし。
+    集計行が未作成の店舗には、保存しない空の集計を返す。
+    """
+    try:
+        return shop.stats
+    except ShopStats.DoesNotExist:
+        return ShopStats(shop_id=shop.pk)
+
+
+def _increment(field, amount=1):
+    return F(field) + amount
+
+
+def _decrement(field, amount=1):
+    # ずれが生じていても負数(UNSIGNED違反)にならないよう0で止める
+    return Case(When(**{f'{field}__gte': amount}, then=F(field) - amount), default=0)
+
+
+def _apply(shop_id, updates, create_missing=True):
+    """集計行をF式で原子的に更新する。行が無ければ実データから作り直す。"""
+    if not updates:
+        return
+    updated = ShopStats.objects.filter(shop_id=shop_id).update(updated_at=timezone.now(), **updates)
+    if not updated and create_missing:
+        rebuild_shop_stats([shop_id])
+
+
+def apply_favorite_delta(shop_id, delta, create_missing=True):
+    """お気に入りの追加(+1)/削除(-1)を集計へ反映"""
+    if delta > 0:
+        _apply(shop_id, {'favorite_count': _increment('favorite_count', delta)}, create_missing)
+    elif delta < 0:
+        _apply(shop_id, {'favorite_count': _decrement('favorite_count', -delta)}, create_missing)
+
+
+def rating_prior_weight():
+    """全体平均に寄せる強さ（レビュー何件分の重みを全体平均に与えるか）"""
+    return getattr(settings, 'RATING_PRIOR_WEIGHT', 5)
+
+
+def rating_prior():
+    """保存済みの事前分布 (全体平均, 重み)。未保存なら (DEFAULT_PRIOR_MEAN, RATING_PRIOR_WEIGHT)"""
+    prior = (RatingPrior.objects
+             .filter(pk=RatingPrior.SINGLETON_ID)
+             .values_list('mean', 'weight')
+             .first())
+    return prior or (DEFAULT_PRIOR_MEAN, float(rating_prior_weight()))
+
+
+def bayesian_rating_expression(mean, weight):
+    """(C * 全体平均 + 評価合計) / (C + 件数)。レビュー無しは0"""
+    return Case(
+        When(review_count__gt=0, then=ExpressionWrapper(
+            (Value(weight * mean) + F('rating_sum')) / (Value(weight) + F('review_count')),
+            output_field=FloatField(),
+        )),
+        default=Value(0.0),
+        output_field=FloatField(),
+    )
+
+
+def refresh_bayesian_ratings(shop_ids=None):
+    """集計行の件数/合計から保存済みの事前分布で bayesian_rating を計算し直す（UPDATE 1回）"""
+    qs = ShopStats.objects.all()
+    if shop_ids is not None:
+        qs = qs.filter(shop_id__in=list(shop_ids))
+    return qs.update(bayesian_rating=bayesian_rating_expression(*rating_prior()))
+
+
+def update_rating_prior():
+    """全店舗のレビューから全体平均を計算し直して保存し、全店舗の bayesian_rating をその値で揃える"""
+    with transaction.atomic():
+        totals = ShopStats.objects.aggregate(ratings=Sum('rating_sum'), reviews=Sum('review_count'))
+        mean = totals['ratings'] / totals['reviews'] if totals['reviews'] else DEFAULT_PRIOR_MEAN
+        RatingPrior.objects.update_or_create(
+            pk=RatingPrior.SINGLETON_ID, defaults={'mean': mean, 'weight': float(rating_prior_weight())})
+        refresh_bayesian_ratings()
+    return mean
+
+
+def apply_review_change(old, new, create_missing=True):
+    """レビューの変更を集計へ反映する。
+    old/new は (shop_id, rating) または None（新規作成時は old=None、削除時は new=None）。
+    """
+    if old == new:
+        return
+    if old and new and old[0] == new[0]:
+        # 同一店舗内での評価変更: 件数は変えず分布と合計のみ更新
+        shop_id, old_rating = old
+        new_rating = new[1]
+        updates = {
+            f'rating_{old_rating}': _decrement(f'rating_{old_rating}'),
+            f'rating_{new_rating}': _increment(f'rating_{new_rating}'),
+        }
+        if new_rating > old_rating:
+            updates['rating_sum'] = _increment('rating_sum', new_rating - old_rating)
+        else:
+            updates['rating_sum'] = _decrement('rating_sum', old_rating - new_rating)
+        _apply(shop_id, updates, create_missing)
+        refresh_bayesian_ratings([shop_id])
+        return
+
+    if old:
+        shop_id, rating = old
+        _apply(shop_id, {
+            'review_count': _decrement('review_count'),
+            'rating_sum': _decrement('rating_sum', rating),
+            f'rating_{rating}': _decrement(f'rating_{rating}'),
+        }, create_missing)
+    if new:
+        shop_id, rating = new
+        _apply(shop_id, {
+            'review_count': _increment('review_count'),
+            'rating_sum': _increment('rating_sum', rating),
+            f'rating_{rating}': _increment(f'rating_{rating}'),
+        }, create_missing)
+    refresh_bayesian_ratings({change[0] for change in (old, new) if change})
+
+
+def compute_shop_stats(shop_ids=None):
+    """Favorite/Review から集計値を作り直し {shop_id: {field: value}} で返す（GROUP BY 2回）"""
+    shops = Shop.objects.all()
+    favorites = Favorite.objects.all()
+    reviews = Review.objects.all()
+    if shop_ids is not None:
+        shops = shops.filter(pk__in=shop_ids)
+        favorites = favorites.filter(shop_id__in=shop_ids)
+        reviews = reviews.filter(shop_id__in=shop_ids)
+
+    empty = {'favorite_count': 0, 'review_count': 0, 'rating_sum': 0}
+    empty.update({field: 0 for field in RATING_FIELDS})
+    result = {shop_id: dict(empty) for shop_id in shops.values_list('pk', flat=True)}
+
+    for row in favorites.values('shop_id').annotate(total=Count('id')):
+        if row['shop_id'] in result:
+            result[row['shop_id']]['favorite_count'] = row['total']
+
+    rating_counts = {f'rating_{i}': Count('id', filter=Q(rating=i)) for i in range(1, 6)}
+    for row in reviews.values('shop_id').annotate(total=Count('id'), rating_total=Sum('rating'), **rating_counts):
+        values = result.get(row['shop_id'])
+        if values is None:
+            continue
+        values['review_count'] = row['total']
+        values['rating_sum'] = row['rating_total'] or 0
+        for field in RATING_FIELDS:
+            values[field] = row[field]
+    return result
+
+
+def rebuild_shop_stats(shop_ids=None):
+    """集計行を実データから再構築する。変更/作成した行数を返す。"""
+    fields = ['favorite_count', 'review_count', 'rating_sum'] + RATING_FIELDS
+    with transaction.atomic():
+        computed = compute_shop_stats(shop_ids)
+        existing = ShopStats.objects.select_for_update()
+        if shop_ids is not None:
+            existing = existing.filter(shop_id__in=list(computed))
+        now = timezone.now()
+        to_update = []
+        for stats in existing:
+            values = computed.pop(stats.shop_id, None)
+            if values is None:
+                continue
+            if any(getattr(stats, field) != values[field] for field in fields):
+                for field in fields:
+                    setattr(stats, field, values[field])
+                stats.updated_at = now
+                to_update.append(stats)
+        to_create = [ShopStats(shop_id=shop_id, **values) for shop_id, values in computed.items()]
+        if to_update:
+            ShopStats.objects.bulk_update(to_update, fields + ['updated_at'], batch_size=500)
+        if to_create:
+            ShopStats.objects.bulk_create(to_create, batch_size=500, ignore_conflicts=True)
+        if shop_ids is None:
+            # 全件の再構築時は全体平均も計算し直す（全店舗の bayesian_rating も更新される）
+            update_rating_prior()
+        else:
+            refresh_bayesian_ratings(shop_ids)
+    return len(to_update) + len(to_create)
@@ -0,0 +1,110 @@
+"""
+検索ボックスの入力補完（ワーカー内メモリの辞書）
+- 店舗名・カテゴリ名の正規化済み表記をソート済み配列に保持し、bisect で前方一致範囲を引く
+- 1〜2文字の短い接頭辞は候補が多いため、上位N件を構築時に計算しておく
+- カタログのバージョンが変わるか SUGGEST_MAX_AGE 秒（人気度の反映）経ったら作り直す
+"""
+import bisect
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Count
+from django.urls import reverse
+
+from .catalog import CATALOG, get_version
+from .models import Category, Shop
+from .normalize import normalize_text
+from .stats import get_shop_stats
+
+MAX_SUGGESTIONS = 10
+PRECOMPUTED_PREFIX_LENGTH = 2
+
+_lock = threading.Lock()
+_state = {'version': None, 'built_at': 0.0, 'index': None}
+
+
+class SuggestIndex:
+    def __init__(self, entries):
+        # entries: [(key, -weight, label, payload)]。key 昇順 -> 人気順
+        entries.sort(key=lambda entry: (entry[0], entry[1], entry[2]))
+        self.keys = [entry[0] for entry in entries]
+        self.entries = entries
+        self.top = self._precompute(entries)
+
+    @staticmethod
+    def _precompute(entries):
+        top = {}
+        for entry in entries:
+            key = entry[0]
+            for length in range(1, min(len(key), PRECOMPUTED_PREFIX_LENGTH) + 1):
+                top.setdefault(key[:length], []).append(entry)
+        for prefix, items in top.items():
+            top[prefix] = _rank(items, MAX_SUGGESTIONS)
+        return top
+
+    @classmethod
+    def build(cls):
+        entries = []
+        shops = Shop.objects.select_related('stats').only('pk', 'name', 'stats__popularity_score')
+        for shop in shops:
+            key = normalize_text(shop.name)
+            if key:
+                payload = {'type': 'shop', 'id': shop.pk, 'label': shop.name,
+                           'url': reverse('shops:shop_detail', args=[shop.pk])}
+                entries.append((key, -get_shop_stats(shop).popularity_score, shop.name, payload))
+        for category in Category.objects.annotate(shop_count=Count('shop_categories')):
+            key = normalize_text(category.name)
+            if key:
+                payload = {'type': 'category', 'id': category.pk, 'label': category.name,
+                           'url': f"{reverse('shops:search')}?category={category.pk}"}
+                entries.append((key, -category.shop_count, category.name, payload))
+        return cls(entries)
+
+    def suggest(self, prefix, limit=MAX_SUGGESTIONS):
+        prefix = normalize_text(prefix)
+        if not prefix:
+            return []
+        if len(prefix) <= PRECOMPUTED_PREFIX_LENGTH and limit <= MAX_SUGGESTIONS:
+            return [entry[3] for entry in self.top.get(prefix, [])[:limit]]
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + '\U0010ffff', lo=start)
+        return [entry[3] for entry in _rank(self.entries[start:end], limit)]
+
+
+def _rank(entries, limit):
+    """人気順(weight降順) -> 表記順で上位 limit 件"""
+    return sorted(entries, key=lambda entry: (entry[1], entry[0], entry[2]))[:limit]
+
+
+def _max_age():
+    return getattr(settings, 'SUGGEST_MAX_AGE', 300)
+
+
+def get_suggest_index():
+    """現在のカタログバージョンの補完辞書を返す。
+    作り直しは1スレッドだけが行い、その間ほかのリクエストは古い辞書で応答する。
+    """
+    version = get_version(CATALOG)
+    index = _state['index']
+    if index is not None and _state['version'] == version and time.monotonic() - _state['built_at'] < _max_age():
+        return index
+    if not _lock.acquire(blocking=index is None):
+        return index
+    try:
+        if (_state['index'] is None or _state['version'] != version
+                or time.monotonic() - _state['built_at'] >= _max_age()):
+            _state['index'] = SuggestIndex.build()
+            _state['version'] = version
+            _state['built_at'] = time.monotonic()
+        return _state['index']
+    finally:
+        _lock.release()
+
+
+def warm_up():
+    """ワーカー起動時に辞書を作っておく（DBに接続できない場合は初回リクエスト時に作る）"""
+    try:
+        get_suggest_index()
+    except Exception as e:
+        print(f"Suggest index warm-up skipped: {e}")
@@ -10,19 +10,26 @@ def main_image_url(shop):
     prefetch_related('images')が適用されている場合、
     追加のDBクエリなしで画像を取得
     """
-    if hasattr(shop, '_prefetched_objects_cache') and 'images' in shop._prefetched_objects_cache:
-        # prefetch_relatedされている場合、キャッシュから取得
-        images = list(shop._prefetched_objects_cache['images'])
-        if images:
-            return images[0].image.url
-    else:
-        # fallback: 従来通りの取得方法
-        first_image = shop.images.first()
-        if first_image:
-            return first_image.image.url
-    
+    image = _main_image(shop)
+    if image:
+        return image.card_url
     return '/static/images/no-image.jpg'  # デフォルト画像のパス
 
+@register.simple_tag
+def main_image_srcset(shop, ext='jpeg'):
+    """
+    店舗のメイン画像の srcset（派生画像が未生成なら空文字）
+    ext='webp' で <source type="image/webp"> 用の srcset を返す
+    """
+    image = _main_image(shop)
+    if not image:
+        return ''
+    return image.webp_srcset if ext == 'webp' else image.srcset
+
+def _main_image(shop):
+    # 代表画像（select_related('cover_image') 済みなら追加クエリなし）
+    return shop.cover_image
+
 @register.simple_tag
 def shop_categories(shop):
     """
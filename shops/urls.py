@@ -16,6 +16,12 @@ urlpatterns = [
     path('favorite/toggle/<int:shop_id>/', views.toggle_favorite, name='toggle_favorite'),
     # 追加読み込み機能
     path('api/load-more-shops/', views.load_more_shops, name='load_more_shops'),
+    # 近くのお店（距離順）
+    path('api/nearby/', views.nearby_shops, name='nearby_shops'),
+    # 検索ボックスの入力補完
+    path('api/suggest/', views.suggest, name='suggest'),
+    # 予約カレンダー（月間の空席状況）
+    path('api/shop_<int:pk>/availability/', views.shop_availability, name='shop_availability'),
     # 予約作成
     path('reserve/', views.create_reservation, name='create_reservation'),
 ]
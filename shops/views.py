@@ -1,8 +1,24 @@
 from django.shortcuts import render, get_object_or_404, redirect
-from .models import Shop, Review, Favorite, Category, ShopCategory, History
+from .models import Shop, Review, Favorite, Category, History, ShopStats
+from .stats import get_shop_stats
+from .list_cache import (
+    shop_list_queryset, get_shop_list_count, get_shop_list_page, overlay_favorites, next_cursor_for_page,
+    normalize_list_sort,
+)
+from .keyset import keyset_page, InvalidCursor
+from .geo import nearby_shop_distances, parse_point
+from .bitmaps import get_category_bitmaps
+from .similarity import similar_shops
+from .inventory import InsufficientSeats, reserve_seats
+from .availability import get_month_availability, parse_month
+from .search_cache import get_search_result, normalize_sort as normalize_search_sort
+from .covers import sub_images, with_cover_images
+from .suggest import get_suggest_index, MAX_SUGGESTIONS
 from django.views.generic import ListView, DetailView
-from django.db.models import Q, Avg, Count, Exists, OuterRef, Prefetch, Case, When, IntegerField
-from django.http import JsonResponse
+from django.db.models import Exists, OuterRef, Prefetch
+from django.http import JsonResponse, Http404, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+from django.core.paginator import Paginator, InvalidPage
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
 from django.views.decorators.http import require_POST
@@ -10,19 +26,16 @@ from django.template.loader import render_to_string
 from django.middleware.csrf import get_token
 from datetime import datetime
 from django.db import transaction
-from django.core.cache import cache
 from django.contrib import messages
-from accounts.decorators import subscription_required
+from accounts.decorators import idempotent, subscription_required
 from accounts.models import Subscription
-from accounts.email_utils import send_reservation_mail
-from django.core.cache import cache
+from accounts.email_utils import enqueue_reservation_mail
 
 class ShopListView(ListView):
     model = Shop
     template_name = 'shops/shop_list.html'
     context_object_name = 'shops'
     paginate_by = 10
-    ordering = ['id']  # ページネーション警告を解決するための順序指定
     
     def dispatch(self, request, *args, **kwargs):
         # CSRFトークンを確実に生成
@@ -30,82 +43,32 @@ class ShopListView(ListView):
         return super().dispatch(request, *args, **kwargs)
     
     def get_queryset(self):
-        """一覧用QuerySetに集計と関連データを事前付与し、人気順(お気に入り数降順)で返す。"""
-        # キャッシュキーを生成
-        cache_key = f"shop_list_user_{self.request.user.id if self.request.user.is_authenticated else 'anonymous'}"
-        cached_result = cache.get(cache_key)
-        
-        if cached_result:
-            return cached_result
-            
-        # 最適化されたクエリ
-        qs = (Shop.objects
-              .select_related('user')
-              .prefetch_related(
-                  'images',
-                  'categories__category'
-              ))
-        
-        # 集計データを一回で取得
-        qs = qs.annotate(
-            favorite_count=Count('favorites', distinct=True),
-            review_count=Count('reviews', distinct=True)
-        )
-        
-        # ログインユーザーのお気に入り状態
-        if self.request.user.is_authenticated:
-            fav_sub = Favorite.objects.filter(user=self.request.user, shop=OuterRef('pk'))
-            qs = qs.annotate(is_favorited=Exists(fav_sub))
-        
-        # 人気順 -> 同数時はid昇順で安定
-        qs = qs.order_by('-favorite_count', 'id')
-        
-        # 結果をキャッシュ（5分間）
-        cache.set(cache_key, qs, 300)
-        return qs
+        """人気順/評価順のQuerySet。描画データはページ単位で共通キャッシュする。"""
+        self.sort = normalize_list_sort(self.request.GET.get('sort'))
+        return shop_list_queryset(self.sort)
+
+    def paginate_queryset(self, queryset, page_size):
+        """件数とページの描画データをキャッシュから取得する（ユーザー共通）"""
+        paginator = Paginator(range(get_shop_list_count()), page_size,
+                              allow_empty_first_page=self.get_allow_empty())
+        page_number = self.kwargs.get(self.page_kwarg) or self.request.GET.get(self.page_kwarg) or 1
+        if page_number == 'last':
+            page_number = paginator.num_pages
+        try:
+            page = paginator.page(page_number)
+        except InvalidPage:
+            raise Http404('ページが見つかりません。')
+        page.object_list = get_shop_list_page(page.number, page_size, self.sort)
+        return paginator, page, page.object_list, page.has_other_pages()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-
-        shops_with_favorites = []
-        for shop in context['shops']:
-            # annotateで付与済みならそれを利用 / 無ければ従来通りフォールバック（安全）
-            favorite_count = getattr(shop, 'favorite_count', None)
-            if favorite_count is None:
-                favorite_count = shop.favorites.count()
-            if self.request.user.is_authenticated:
-                is_favorited = getattr(shop, 'is_favorited', None)
-                if is_favorited is None:
-                    is_favorited = Favorite.objects.filter(shop=shop, user=self.request.user).exists()
-            else:
-                is_favorited = False
-
-            # カテゴリーはprefetch済み
-            categories_list = []
-            for shop_category in shop.categories.all():
-                categories_list.append(shop_category.category)
-            
-            # メイン画像をprefetch済みデータから取得（N+1問題を回避）
-            main_image_url = None
-            if hasattr(shop, '_prefetched_objects_cache') and 'images' in shop._prefetched_objects_cache:
-                images = shop._prefetched_objects_cache['images']
-                if images:
-                    main_image_url = images[0].image.url
-            else:
-                # fallback
-                first_image = shop.images.first()
-                if first_image:
-                    main_image_url = first_image.image.url
-
-            shops_with_favorites.append({
-                'shop': shop,
-                'is_favorited': is_favorited,
-                'favorite_count': favorite_count,
-                'categories': categories_list,
-                'main_image_url': main_image_url,
-            })
-
-        context['shops_with_favorites'] = shops_with_favorites
+        # 共通キャッシュの行データにログインユーザーのお気に入り状態を重ねる
+        context['shops_with_favorites'] = overlay_favorites(context['shops'], self.request.user)
+        # 「さらに読み込む」は同じ並び順のカーソルで続きを取得する
+        page = context.get('page_obj')
+        context['next_cursor'] = next_cursor_for_page(context['shops'], self.sort) if page and page.has_next() else None
+        context['sort'] = self.sort
         context['categories'] = Category.objects.all()
         return context
 
@@ -129,20 +92,14 @@ class ShopDetailView(DetailView):
         if pk is None:
             raise ValueError("Shop ID is required")
         
-        # 全ての関連データを一度に取得し、集計も含める
+        # 全ての関連データを一度に取得（集計値は shop_stats から）
         try:
             shop = (Shop.objects
-                    .select_related('user')
+                    .select_related('user', 'stats', 'cover_image')
                     .prefetch_related(
                         'images',
                         'categories__category',
                         Prefetch('reviews', queryset=Review.objects.select_related('user').order_by('-created_at')),
-                        'favorites'
-                    )
-                    .annotate(
-                        favorite_count=Count('favorites', distinct=True),
-                        review_count=Count('reviews', distinct=True),
-                        avg_rating=Avg('reviews__rating')
                     )
                     .get(pk=pk))
             return shop
@@ -154,10 +111,11 @@ class ShopDetailView(DetailView):
         context = super().get_context_data(**kwargs)
         shop = context['shop']  # get_object()は既に呼ばれている
         
-        # アノテーション済みデータを使用（追加クエリなし）
-        context['favorite_count'] = getattr(shop, 'favorite_count', 0)
-        context['review_count'] = getattr(shop, 'review_count', 0)
-        avg_rating = getattr(shop, 'avg_rating', 0) or 0
+        # 集計テーブルの値を使用（追加クエリなし）
+        stats = get_shop_stats(shop)
+        context['favorite_count'] = stats.favorite_count
+        context['review_count'] = stats.review_count
+        avg_rating = stats.avg_rating
         context['avg_rating'] = round(avg_rating, 1)
         context['avg_rating_int'] = int(avg_rating)
         
@@ -167,10 +125,10 @@ class ShopDetailView(DetailView):
         
         # ログインユーザー関連：効率化
         if self.request.user.is_authenticated:
-            # prefetch済みお気に入りデータから検索
-            context['is_favorited'] = any(
-                fav.user_id == self.request.user.id for fav in shop.favorites.all()
-            )
+            # お気に入り全件は読み込まず、自分の1件の有無のみ確認
+            context['is_favorited'] = Favorite.objects.filter(
+                shop=shop, user=self.request.user
+            ).exists()
             # prefetch済みレビューから検索
             context['user_review'] = next(
                 (r for r in reviews if r.user_id == self.request.user.id), None
@@ -182,6 +140,9 @@ class ShopDetailView(DetailView):
         # 店舗カテゴリ情報（prefetch済み）
         context['shop_categories'] = shop.categories.all()
 
+        # 類似店舗（事前計算済みの近傍を1クエリで取得）
+        context['similar_shops'] = similar_shops(shop.pk)
+
         # サブスクリプション状態（予約フォームの表示制御に使用）
         can_reserve = False
         if self.request.user.is_authenticated:
@@ -209,27 +170,58 @@ class ShopSearchView(ListView):
         return super().dispatch(request, *args, **kwargs)
 
     def get_queryset(self):
-        # GETパラメーターから検索キーワード/カテゴリー
-        query = self.request.GET.get('q')
-        category_id = self.request.GET.get('category')
-
-        qs = Shop.objects.all().prefetch_related('images', 'categories__category')
-
-        if category_id:
-            qs = qs.filter(categories__category_id=category_id)
-        elif query and query.strip():
-            q = query.strip()
-            qs = qs.filter(
-                Q(name__icontains=q) |
-                Q(address__icontains=q) |
-                Q(phone_number__icontains=q) |
-                Q(categories__category__name__icontains=q)
-            )
-
-        qs = qs.order_by('id').distinct()
+        """並び順どおりの店舗IDリスト（検索結果キャッシュから取得）。店舗はページ分だけ取得する。"""
+        # GETパラメーターから検索キーワード/カテゴリー(複数可)/現在地
+        query = (self.request.GET.get('q') or '').strip()
+        self.category_ids = self._category_ids()
+        self.category_op = 'and' if self.request.GET.get('category_op') == 'and' else 'or'
+        self.near = self._near_point()
+        self.sort = normalize_search_sort(self.request.GET.get('sort'))
+
+        result = get_search_result(query, self.category_ids, self.category_op, self.near, self.sort)
+        self.facet_counts = result['facets']
+        self.distances = result['distances']
+        return result['ids']
+
+    def paginate_queryset(self, queryset, page_size):
+        """件数とページの切り出しはIDリストで行い、表示するページの店舗だけをDBから取得する"""
+        paginator = Paginator(queryset, page_size, allow_empty_first_page=self.get_allow_empty())
+        page_number = self.kwargs.get(self.page_kwarg) or self.request.GET.get(self.page_kwarg) or 1
+        if page_number == 'last':
+            page_number = paginator.num_pages
+        try:
+            page = paginator.page(page_number)
+        except InvalidPage:
+            raise Http404('ページが見つかりません。')
+        page.object_list = self._fetch_shops(page.object_list)
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def _fetch_shops(self, shop_ids):
+        qs = with_cover_images(Shop.objects.filter(pk__in=shop_ids).select_related('stats'), thumbnails=4)
+        qs = qs.prefetch_related('categories__category')
+        shops = {shop.pk: shop for shop in self._annotate_favorites(qs)}
+        return [shops[shop_id] for shop_id in shop_ids if shop_id in shops]
+
+    def _category_ids(self):
+        category_ids = []
+        for value in self.request.GET.getlist('category'):
+            if value.isdigit() and int(value) not in category_ids:
+                category_ids.append(int(value))
+        return category_ids
+
+    def _near_point(self):
+        """lat/lng(/radius km) 指定時は (lat, lng, radius_km)。未指定・不正値なら None"""
+        lat = self.request.GET.get('lat')
+        lng = self.request.GET.get('lng')
+        if not lat or not lng:
+            return None
+        try:
+            return parse_point(lat, lng, self.request.GET.get('radius'))
+        except ValueError:
+            return None
 
-        # 共通最適化: お気に入り数 & ログイン済み判定
-        qs = qs.annotate(favorite_count=Count('favorites'))
+    def _annotate_favorites(self, qs):
+        # 共通最適化: ログイン済み判定（お気に入り数は shop_stats から）
         if self.request.user.is_authenticated:
             fav_sub = Favorite.objects.filter(user=self.request.user, shop=OuterRef('pk'))
             qs = qs.annotate(is_favorited=Exists(fav_sub))
@@ -241,27 +233,29 @@ class ShopSearchView(ListView):
 
         # 検索キーワードとカテゴリーをコンテキストに追加
         query = self.request.GET.get('q', '')
-        category_id = self.request.GET.get('category', '')
         context['query'] = query
-        context['selected_category'] = category_id
-
-        # 検索されたカテゴリー情報を追加
-        if category_id:
-            try:
-                context['category_name'] = Category.objects.get(id=category_id).name
-            except Category.DoesNotExist:
-                context['category_name'] = ''
-
-        # 検索結果の総件数を追加
-        result_count = self.get_queryset().count()
-        context['result_count'] = result_count
+        context['selected_category'] = str(self.category_ids[0]) if self.category_ids else ''
+        context['selected_categories'] = self.category_ids
+        context['category_op'] = self.category_op
+
+        # カテゴリ別件数（ビットマップから計算済み）と検索されたカテゴリー名
+        context['category_facets'] = [
+            {'id': category_id, 'name': name, 'count': self.facet_counts.get(category_id, 0),
+             'selected': category_id in self.category_ids}
+            for category_id, name in get_category_bitmaps().categories
+        ]
+        if self.category_ids:
+            names = [facet['name'] for facet in context['category_facets'] if facet['selected']]
+            context['category_name'] = (' かつ ' if self.category_op == 'and' else '・').join(names)
+
+        # 検索結果の総件数を追加（ページネーターの件数を再利用し、検索を再実行しない）
+        paginator = context.get('paginator')
+        context['result_count'] = paginator.count if paginator else len(context['shops'])
 
         # お気に入り/カテゴリー情報（annotate + prefetch フォールバック対応）
         shops_with_favorites = []
         for shop in context['shops']:
-            favorite_count = getattr(shop, 'favorite_count', None)
-            if favorite_count is None:
-                favorite_count = shop.favorites.count()
+            favorite_count = get_shop_stats(shop).favorite_count
             if self.request.user.is_authenticated:
                 is_favorited = getattr(shop, 'is_favorited', None)
                 if is_favorited is None:
@@ -269,25 +263,23 @@ class ShopSearchView(ListView):
             else:
                 is_favorited = False
                 
-            # メイン画像をprefetch済みデータから取得
-            main_image_url = None
-            if hasattr(shop, '_prefetched_objects_cache') and 'images' in shop._prefetched_objects_cache:
-                images = shop._prefetched_objects_cache['images']
-                if images:
-                    main_image_url = images[0].image.url
-            else:
-                first_image = shop.images.first()
-                if first_image:
-                    main_image_url = first_image.image.url
-                    
+            # 代表画像は JOIN 済み、サムネイルは先頭数枚のみ取得済み
+            main_image = shop.cover_image
+
             shops_with_favorites.append({
                 'shop': shop,
                 'is_favorited': is_favorited,
                 'favorite_count': favorite_count,
                 'categories': shop.categories.all(),
-                'main_image_url': main_image_url,
+                'main_image': main_image,
+                'main_image_url': main_image.card_url if main_image else None,
+                'sub_images': sub_images(shop, 4),
+                'image_count': shop.image_count,
+                'distance_km': self.distances.get(shop.pk),
             })
         context['shops_with_favorites'] = shops_with_favorites
+        context['near'] = self.near
+        context['sort'] = self.sort
         context['categories'] = Category.objects.all()
 
         return context
@@ -306,14 +298,12 @@ class ReviewListView(ListView):
         if shop_id:
             return (Review.objects
                     .filter(shop_id=shop_id)
-                    .select_related('user', 'shop')
-                    .prefetch_related('shop__images')
+                    .select_related('user', 'shop__cover_image')
                     .order_by('-created_at'))
         
         # 全店舗のレビュー一覧（最適化済み）
         return (Review.objects
-                .select_related('user', 'shop')
-                .prefetch_related('shop__images')
+                .select_related('user', 'shop__cover_image')
                 .order_by('-created_at'))
 
     def get_context_data(self, **kwargs):
@@ -322,17 +312,9 @@ class ReviewListView(ListView):
         # 現在のページのレビューのみを処理（ページネーション対応）
         reviews_with_images = []
         for review in context['reviews']:  # ページネーション済みレビュー
-            # shop画像をprefetch済みデータから効率的に取得
-            main_image_url = None
-            if hasattr(review.shop, '_prefetched_objects_cache') and 'images' in review.shop._prefetched_objects_cache:
-                images = review.shop._prefetched_objects_cache['images']
-                if images:
-                    main_image_url = images[0].image.url
-            else:
-                # fallback（通常は不要）
-                first_image = review.shop.images.first()
-                if first_image:
-                    main_image_url = first_image.image.url
+            # 店舗の代表画像（JOIN済み）のサムネイル
+            cover = review.shop.cover_image
+            main_image_url = cover.thumb_url if cover else None
             
             reviews_with_images.append({
                 'review': review,
@@ -345,51 +327,18 @@ class ReviewListView(ListView):
         shop_id = self.kwargs.get('shop_pk')
         if shop_id:
             try:
-                # 店舗情報を効率的に取得
+                # 店舗情報と集計行を効率的に取得
                 shop = (Shop.objects
-                        .select_related('user')
-                        .prefetch_related('images')
+                        .select_related('user', 'stats', 'cover_image')
                         .get(pk=shop_id))
                 context['shop'] = shop
-                
-                # 統計情報を効率的に計算（該当店舗のレビューのみ）
-                review_stats = (Review.objects
-                                .filter(shop_id=shop_id)
-                                .aggregate(
-                                    total_count=Count('id'),
-                                    average_rating=Avg('rating'),
-                                    rating_1=Count(Case(When(rating=1, then=1))),
-                                    rating_2=Count(Case(When(rating=2, then=1))),
-                                    rating_3=Count(Case(When(rating=3, then=1))),
-                                    rating_4=Count(Case(When(rating=4, then=1))),
-                                    rating_5=Count(Case(When(rating=5, then=1)))
-                                ))
-                
+
+                # 統計情報は集計テーブルから取得（レビュー全件の集計はしない）
+                stats = get_shop_stats(shop)
                 context['review_stats'] = {
-                    'total_count': review_stats['total_count'] or 0,
-                    'average_rating': review_stats['average_rating'] or 0,
-                    'rating_distribution': {
-                        1: {
-                            'count': review_stats['rating_1'],
-                            'percentage': (review_stats['rating_1'] * 100 / review_stats['total_count']) if review_stats['total_count'] > 0 else 0
-                        },
-                        2: {
-                            'count': review_stats['rating_2'],
-                            'percentage': (review_stats['rating_2'] * 100 / review_stats['total_count']) if review_stats['total_count'] > 0 else 0
-                        },
-                        3: {
-                            'count': review_stats['rating_3'], 
-                            'percentage': (review_stats['rating_3'] * 100 / review_stats['total_count']) if review_stats['total_count'] > 0 else 0
-                        },
-                        4: {
-                            'count': review_stats['rating_4'],
-                            'percentage': (review_stats['rating_4'] * 100 / review_stats['total_count']) if review_stats['total_count'] > 0 else 0
-                        },
-                        5: {
-                            'count': review_stats['rating_5'],
-                            'percentage': (review_stats['rating_5'] * 100 / review_stats['total_count']) if review_stats['total_count'] > 0 else 0
-                        }
-                    }
+                    'total_count': stats.review_count,
+                    'average_rating': stats.avg_rating,
+                    'rating_distribution': stats.rating_distribution,
                 }
                 
             except Shop.DoesNotExist:
@@ -406,6 +355,7 @@ class ReviewListView(ListView):
 @login_required
 @subscription_required
 @require_POST
+@idempotent
 def submit_review(request):
     try:
         # POSTデータの取得
@@ -569,6 +519,7 @@ def delete_review(request, review_id):
 @login_required
 @subscription_required
 @require_POST
+@idempotent
 def toggle_favorite(request, shop_id):
     """お気に入りの追加・削除を切り替える"""
     print(f"toggle_favorite called: user={request.user.email}, shop_id={shop_id}")
@@ -607,8 +558,11 @@ def toggle_favorite(request, shop_id):
                         is_favorited = True
                         message = 'お気に入りに追加しました。'
                     
-                    # お気に入り数を取得
-                    favorite_count = shop.favorites.count()
+                    # お気に入り数を取得（signalで更新済みの集計行から）
+                    favorite_count = (ShopStats.objects
+                                      .filter(shop=shop)
+                                      .values_list('favorite_count', flat=True)
+                                      .first()) or 0
                     print(f"Favorite count: {favorite_count}")
                     
                     # 成功した場合、ループを抜ける
@@ -645,42 +599,41 @@ def toggle_favorite(request, shop_id):
         }, status=500)
 
 def load_more_shops(request):
-    """追加の店舗データを読み込むAJAXエンドポイント (N+1最適化版)"""
-    print(f"load_more_shops called with request: {request.method}")
-    print(f"GET params: {request.GET}")
+    """追加の店舗データを読み込むAJAXエンドポイント
+    - cursor / sort 指定時: キーセット方式（OFFSET/COUNTなし）。sort は popular / rating / id
+    - offset 指定時: 従来のオフセット方式（id順、後方互換用）
+    """
+    limit = 10
+    cursor = request.GET.get('cursor')
+    sort = request.GET.get('sort')
     try:
-        offset = int(request.GET.get('offset', 0))
-        limit = 10
-        print(f"Offset: {offset}, Limit: {limit}")
-
-        base_qs = (Shop.objects
-                    .all()
-                    .order_by('id')
-                    .prefetch_related('images'))
-        # 集計
-        base_qs = base_qs.annotate(favorite_count=Count('favorites'))
+        base_qs = Shop.objects.select_related('stats', 'cover_image')
         if request.user.is_authenticated:
             fav_sub = Favorite.objects.filter(user=request.user, shop=OuterRef('pk'))
             base_qs = base_qs.annotate(is_favorited=Exists(fav_sub))
 
-        shops = list(base_qs[offset:offset + limit])
-        print(f"Found {len(shops)} shops")
+        response_data = {'success': True}
+        if cursor or sort:
+            try:
+                shops, next_cursor = keyset_page(base_qs, sort, cursor, limit)
+            except InvalidCursor as e:
+                return JsonResponse({'success': False, 'message': str(e)}, status=400)
+            response_data['has_more'] = next_cursor is not None
+            response_data['next_cursor'] = next_cursor
+        else:
+            offset = int(request.GET.get('offset', 0))
+            shops = list(base_qs.order_by('id')[offset:offset + limit])
+            total_count = Shop.objects.count()
+            response_data['has_more'] = total_count > offset + limit
+            response_data['total_count'] = total_count
 
         shops_data = []
         for shop in shops:
-            favorite_count = getattr(shop, 'favorite_count', shop.favorites.count())
-            if request.user.is_authenticated:
-                is_favorited = getattr(shop, 'is_favorited', Favorite.objects.filter(shop=shop, user=request.user).exists())
-            else:
-                is_favorited = False
+            favorite_count = get_shop_stats(shop).favorite_count
+            is_favorited = bool(getattr(shop, 'is_favorited', False))
 
-            # 画像（prefetch済み）
-            images = list(shop.images.all())
-            image_url = ''
-            if images:
-                image_url = images[0].image.url
-                if image_url.startswith('/media/'):
-                    image_url = image_url.replace('/media/', '/static/')
+            # 代表画像（JOIN済み）
+            image_url = shop.cover_image.card_url if shop.cover_image else ''
 
             shops_data.append({
                 'id': shop.pk,
@@ -692,23 +645,79 @@ def load_more_shops(request):
                 'favorite_count': favorite_count,
             })
 
-        total_count = Shop.objects.count()
-        has_more = total_count > offset + limit
-        response_data = {
-            'success': True,
-            'shops': shops_data,
-            'has_more': has_more,
-            'total_count': total_count,
-        }
-        print(f"Returning response: {response_data}")
+        response_data['shops'] = shops_data
         return JsonResponse(response_data)
     except Exception as e:
         print(f"Error in load_more_shops: {e}")
         return JsonResponse({'success': False, 'message': 'データの読み込みに失敗しました。'}, status=500)
 
+def suggest(request):
+    """検索ボックスの入力補完(JSON)。ワーカー内の辞書から前方一致で人気順に返す
+    GET: q（入力中の文字列）, limit（既定8・最大10）
+    """
+    query = request.GET.get('q', '')
+    try:
+        limit = min(max(int(request.GET.get('limit', 8)), 1), MAX_SUGGESTIONS)
+    except ValueError:
+        limit = 8
+    suggestions = get_suggest_index().suggest(query, limit) if query.strip() else []
+    response = JsonResponse({'query': query, 'suggestions': suggestions})
+    response['Cache-Control'] = 'public, max-age=60'
+    return response
+
+def shop_availability(request, pk):
+    """月間の日別残席数(JSON)。GET: month=YYYY-MM（既定は今月）
+    ETag が一致すれば 304 を返す
+    """
+    try:
+        year, month = parse_month(request.GET.get('month'))
+    except ValueError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+    shop = get_object_or_404(Shop.objects.only('pk', 'seat_count'), pk=pk)
+
+    payload, etag = get_month_availability(shop, year, month)
+    etag = quote_etag(etag)
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse(dict(payload, success=True))
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age=30'
+    return response
+
+def nearby_shops(request):
+    """現在地から近い順の店舗一覧(JSON)
+    GET: lat, lng（必須）, radius（km、既定1km・最大50km）, limit（既定20・最大50）
+    """
+    try:
+        lat, lng, radius_km = parse_point(request.GET.get('lat'), request.GET.get('lng'), request.GET.get('radius'))
+        limit = min(max(int(request.GET.get('limit', 20)), 1), 50)
+    except (TypeError, ValueError):
+        return JsonResponse({'success': False, 'message': '緯度/経度/半径の値が不正です。'}, status=400)
+
+    nearby = nearby_shop_distances(Shop.objects.all(), lat, lng, radius_km)
+    page = nearby[:limit]
+    shops = Shop.objects.select_related('stats').in_bulk([shop_id for shop_id, _ in page])
+    shops_data = []
+    for shop_id, distance_km in page:
+        shop = shops.get(shop_id)
+        if shop is None:
+            continue
+        shops_data.append({
+            'id': shop.pk,
+            'name': shop.name,
+            'address': shop.address,
+            'latitude': shop.latitude,
+            'longitude': shop.longitude,
+            'distance_km': round(distance_km, 3),
+            'favorite_count': get_shop_stats(shop).favorite_count,
+        })
+    return JsonResponse({'success': True, 'total_count': len(nearby), 'shops': shops_data})
+
 @login_required
 @subscription_required
 @require_POST
+@idempotent
 def create_reservation(request):
     """予約作成: フォーム送信/ AJAX 両対応。残席不足ならエラー、成功で履歴作成。"""
     def is_ajax(req):
@@ -747,29 +756,25 @@ def create_reservation(request):
             messages.error(request, '人数は1以上の整数で入力してください。')
             return redirect('shops:shop_detail', pk=shop.id)
 
-        # 残席チェックと作成をトランザクションで
-        with transaction.atomic():
-            remaining = shop.remaining_seats_on(reserve_date)
-            if people > remaining:
-                if is_ajax(request):
-                    return JsonResponse({'success': False, 'message': f'指定日の残席が不足しています。（残り {remaining} 席）'}, status=400)
-                messages.error(request, f'指定日の残席が不足しています。（残り {remaining} 席）')
-                return redirect('shops:shop_detail', pk=shop.id)
-
-            # 予約保存
-            History.objects.create(
-                shop=shop,
-                user=request.user,
-                date=reserve_date,
-                number_of_people=people,
-            )
-
-        # メール送信（失敗してもフロー継続）
-        if request.user.email:
-            send_reservation_mail(request.user, shop, reserve_date, people)
+        # 残席の減算（条件付きUPDATE）と予約の作成を同じトランザクションで
+        try:
+            with transaction.atomic():
+                new_remaining = reserve_seats(shop, reserve_date, people)
+                History.objects.create(
+                    shop=shop,
+                    user=request.user,
+                    date=reserve_date,
+                    number_of_people=people,
+                )
+                # 予約確認メールは送信待ちに積むだけ（予約と一緒にコミット、送信はワーカー）
+                enqueue_reservation_mail(request.user, shop, reserve_date, people)
+        except InsufficientSeats as e:
+            if is_ajax(request):
+                return JsonResponse({'success': False, 'message': f'指定日の残席が不足しています。（残り {e.remaining} 席）'}, status=400)
+            messages.error(request, f'指定日の残席が不足しています。（残り {e.remaining} 席）')
+            return redirect('shops:shop_detail', pk=shop.id)
 
         if is_ajax(request):
-            new_remaining = shop.remaining_seats_on(reserve_date)
             return JsonResponse({'success': True, 'message': '予約を受け付けました。', 'remaining_seats': new_remaining})
 
         messages.success(request, '予約を受け付けました。')